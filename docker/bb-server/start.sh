@@ -93,6 +93,13 @@ else
     check_retcode
 fi
 
+set +e
+CMD='bagbunker admin sync-listing'
+$CMD
+RETCODE=$?
+set -e
+check_retcode
+
 
 if [ "$1" = "apache2" ]; then
     echo "Running apache2 on ${BB_LISTEN} in foreground, press Ctrl-C to end."
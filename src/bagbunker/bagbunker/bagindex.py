@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Read bag header, connection and chunk info records of ROS bags
+
+Only the index section at the end of a bag is parsed; chunks and their
+message data are not touched. Bags are accessed via mmap, so only the
+pages holding the records are read.
+
+read_messages uses the index to read only chunks holding messages of
+wanted connections.
+"""
+
+from __future__ import absolute_import, division
+
+import bz2
+import mmap
+import struct
+from collections import namedtuple
+
+
+MAGIC = '#ROSBAG V2.0\n'
+
+OP_MSG_DATA = 0x02
+OP_BAG_HEADER = 0x03
+OP_CHUNK = 0x05
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+Connection = namedtuple('Connection', ('id', 'topic', 'msg_type', 'md5sum', 'msg_def'))
+ChunkInfo = namedtuple('ChunkInfo', ('pos', 'start_time', 'end_time', 'counts'))
+
+
+class BagIndexError(Exception):
+    """Bag cannot be read via its index, e.g. unindexed or version 1.2"""
+
+
+class BagIndex(object):
+    """Connections and chunk infos of a bag
+
+    Times are seconds since epoch as floats, like
+    rosbag.Bag.get_start_time returns them.
+    """
+    def __init__(self, connections, chunks, index_pos=None):
+        self.connections = connections
+        self.chunks = chunks
+        self.index_pos = index_pos
+
+    @property
+    def chunk_sizes(self):
+        """Bytes per chunk including its index records, in order of chunks"""
+        positions = [x.pos for x in self.chunks] + [self.index_pos]
+        return [y - x for x, y in zip(positions, positions[1:])]
+
+    @property
+    def start_time(self):
+        return min(x.start_time for x in self.chunks) if self.chunks else None
+
+    @property
+    def end_time(self):
+        return max(x.end_time for x in self.chunks) if self.chunks else None
+
+    @property
+    def topics(self):
+        """Message count per (topic, msg_type)"""
+        topics = dict(((x.topic, x.msg_type), 0) for x in self.connections.values())
+        for chunk in self.chunks:
+            for conn_id, count in chunk.counts.items():
+                conn = self.connections[conn_id]
+                topics[conn.topic, conn.msg_type] += count
+        return topics
+
+
+def _parse_fields(buf, pos, end):
+    """Return dict of name=value fields stored between pos and end"""
+    fields = {}
+    while pos < end:
+        size, = struct.unpack_from('<I', buf, pos)
+        pos += 4
+        name, sep, value = buf[pos:pos + size].partition('=')
+        if not sep:
+            raise BagIndexError('Invalid header field at {}'.format(pos))
+        fields[name] = value
+        pos += size
+    return fields
+
+
+def _read_header(buf, pos):
+    """Return header fields and position after header"""
+    size, = struct.unpack_from('<I', buf, pos)
+    end = pos + 4 + size
+    if end > len(buf):
+        raise BagIndexError('Truncated record header at {}'.format(pos))
+    return _parse_fields(buf, pos + 4, end), end
+
+
+def _read_record(buf, pos, op):
+    """Return header fields, data position and end of record of type op"""
+    header, pos = _read_header(buf, pos)
+    if header.get('op') != chr(op):
+        raise BagIndexError('Expected op {:#04x} at {}'.format(op, pos))
+    size, = struct.unpack_from('<I', buf, pos)
+    return header, pos + 4, pos + 4 + size
+
+
+def _time(value):
+    secs, nsecs = struct.unpack('<II', value)
+    return secs + nsecs * 1e-9
+
+
+def parse_index(buf):
+    """Parse bag index from buffer holding a complete bag"""
+    if buf[:len(MAGIC)] != MAGIC:
+        raise BagIndexError('Not a version 2.0 bag')
+    header, _, _ = _read_record(buf, len(MAGIC), OP_BAG_HEADER)
+    index_pos, = struct.unpack('<Q', header['index_pos'])
+    conn_count, = struct.unpack('<I', header['conn_count'])
+    chunk_count, = struct.unpack('<I', header['chunk_count'])
+    if not index_pos:
+        raise BagIndexError('Bag is not indexed')
+
+    pos = index_pos
+    connections = {}
+    for _ in range(conn_count):
+        header, data, pos = _read_record(buf, pos, OP_CONNECTION)
+        fields = _parse_fields(buf, data, pos)
+        conn_id, = struct.unpack('<I', header['conn'])
+        connections[conn_id] = Connection(conn_id, header['topic'],
+                                          fields['type'], fields['md5sum'],
+                                          fields['message_definition'])
+
+    chunks = []
+    for _ in range(chunk_count):
+        header, data, pos = _read_record(buf, pos, OP_CHUNK_INFO)
+        chunk_pos, = struct.unpack('<Q', header['chunk_pos'])
+        count, = struct.unpack('<I', header['count'])
+        counts = dict(struct.unpack_from('<II', buf, data + 8 * i)
+                      for i in range(count))
+        chunks.append(ChunkInfo(chunk_pos, _time(header['start_time']),
+                                _time(header['end_time']), counts))
+    return BagIndex(connections, chunks, index_pos)
+
+
+def _decompress(compression, data):
+    if compression == 'none':
+        return data
+    if compression == 'bz2':
+        return bz2.decompress(data)
+    if compression == 'lz4':
+        import roslz4
+        return roslz4.decompress(data)
+    raise BagIndexError('Unknown compression {}'.format(compression))
+
+
+def _read_chunk(buf, pos, conn_ids):
+    """Return messages of wanted connections in chunk at pos sorted by time"""
+    header, data_pos, end = _read_record(buf, pos, OP_CHUNK)
+    data = _decompress(header['compression'], buf[data_pos:end])
+    msgs = []
+    offset = 0
+    while offset < len(data):
+        header, offset = _read_header(data, offset)
+        size, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        if header.get('op') == chr(OP_MSG_DATA):
+            conn_id, = struct.unpack('<I', header['conn'])
+            if conn_id in conn_ids:
+                time = struct.unpack('<II', header['time'])
+                msgs.append((time, conn_id, data[offset:offset + size], (pos, offset)))
+        offset += size
+    msgs.sort(key=lambda x: x[0])
+    return msgs
+
+
+class ReadStats(object):
+    """Chunks and bytes read and skipped by read_messages"""
+    def __init__(self):
+        self.chunks_read = 0
+        self.chunks_skipped = 0
+        self.bytes_read = 0
+        self.bytes_skipped = 0
+
+    def __repr__(self):
+        return '<{} chunks {}/{} bytes {}/{}>'.format(
+            self.__class__.__name__,
+            self.chunks_read, self.chunks_read + self.chunks_skipped,
+            self.bytes_read, self.bytes_read + self.bytes_skipped)
+
+
+def _mmap(f):
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        raise BagIndexError('Empty file')
+
+
+def _parse_index(buf):
+    try:
+        return parse_index(buf)
+    except KeyError as e:
+        raise BagIndexError('Missing header field {}'.format(e))
+    except struct.error as e:
+        raise BagIndexError('Truncated record: {}'.format(e))
+
+
+def read_index(path):
+    """Read index of bag at path"""
+    with open(path, 'rb') as f:
+        buf = _mmap(f)
+        try:
+            return _parse_index(buf)
+        finally:
+            buf.close()
+
+
+def _iter_messages(buf, index, chunks, topics, start_time, end_time, stats):
+    # Messages of chunks overlapping in time are merged, chunks not
+    # reached as iteration stops early are accounted as skipped
+    chunks = sorted(chunks, key=lambda x: x[0].start_time)
+    i = 0
+    try:
+        while i < len(chunks):
+            # topics may have shrunk meanwhile
+            conn_ids = set(x.id for x in index.connections.values()
+                           if topics is None or x.topic in topics)
+            if not conn_ids:
+                return
+            group = [chunks[i]]
+            group_end = chunks[i][0].end_time
+            i += 1
+            while i < len(chunks) and chunks[i][0].start_time <= group_end:
+                group_end = max(group_end, chunks[i][0].end_time)
+                group.append(chunks[i])
+                i += 1
+            skipped = [x for x in group if not conn_ids.intersection(x[0].counts)]
+            group = [x for x in group if conn_ids.intersection(x[0].counts)]
+            if stats is not None:
+                stats.chunks_read += len(group)
+                stats.bytes_read += sum(size for _, size in group)
+                stats.chunks_skipped += len(skipped)
+                stats.bytes_skipped += sum(size for _, size in skipped)
+            msgs = [msg for chunk, _ in group
+                    for msg in _read_chunk(buf, chunk.pos, conn_ids)]
+            if len(group) > 1:
+                msgs.sort(key=lambda x: x[0])
+            for time, conn_id, data, position in msgs:
+                conn = index.connections[conn_id]
+                if topics is not None and conn.topic not in topics:
+                    if not topics:
+                        return
+                    continue
+                secs = time[0] + time[1] * 1e-9
+                if start_time is not None and secs < start_time:
+                    continue
+                if end_time is not None and secs > end_time:
+                    return
+                yield conn, time, data, position
+    finally:
+        buf.close()
+        if stats is not None:
+            stats.chunks_skipped += len(chunks) - i
+            stats.bytes_skipped += sum(size for _, size in chunks[i:])
+
+
+def read_messages(path, topics=None, stats=None, start_time=None, end_time=None):
+    """Return iterator over connection, time, data and position of messages
+
+    Messages on the given topics, all if None, between start_time and
+    end_time, seconds since epoch, are yielded in time order; time is
+    a (secs, nsecs) tuple. Only chunks holding messages of the topics'
+    connections within the time window are read and decompressed;
+    stats, if given, is updated with the chunks and bytes read and
+    skipped. Topics may be a set the caller removes topics from while
+    iterating; chunks holding no messages of the remaining topics are
+    skipped then, and iteration stops once no topics remain.
+    BagIndexError is raised right away in case the bag cannot be read
+    via its index.
+    """
+    with open(path, 'rb') as f:
+        buf = _mmap(f)
+    try:
+        index = _parse_index(buf)
+    except:
+        buf.close()
+        raise
+    conn_ids = set(x.id for x in index.connections.values()
+                   if topics is None or x.topic in topics)
+    chunks = []
+    for chunk, size in zip(index.chunks, index.chunk_sizes):
+        if conn_ids.intersection(chunk.counts) and \
+           (start_time is None or chunk.end_time >= start_time) and \
+           (end_time is None or chunk.start_time <= end_time):
+            chunks.append((chunk, size))
+        elif stats is not None:
+            stats.chunks_skipped += 1
+            stats.bytes_skipped += size
+    return _iter_messages(buf, index, chunks, topics, start_time, end_time, stats)
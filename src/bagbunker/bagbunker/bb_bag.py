@@ -23,29 +23,235 @@
 from __future__ import absolute_import, division
 
 import click
+import os
 from marv.widgeting import make_parameter
 from marv.job import JobInput
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from .bagindex import BagIndexError, Connection, read_index
+from .bagindex import read_messages as read_indexed_messages
 
 
 BagMessage = namedtuple('BagMessage', ['topic', 'msg', 'timestamp'])
 
+# What a job gets as msg of its messages
+MSG = 'msg'        # deserialized message
+HEADER = 'header'  # std_msgs/Header of message, None for messages without
+RAW = 'raw'        # (datatype, data, md5sum, position, pytype) as read by rosbag
+
+
+def deserialize(raw_msg, decode=MSG):
+    """Deserialize raw message read by rosbag as much as needed for decode"""
+    if decode == RAW:
+        return raw_msg
+    pytype = raw_msg[-1]
+    if decode == HEADER:
+        if not pytype._has_header:
+            return None
+        from std_msgs.msg import Header
+        msg = Header()
+    else:
+        msg = pytype()
+    # Header is at the start of the data, the remainder is ignored
+    msg.deserialize(raw_msg[1])
+    return msg
+
+
+def read_raw_messages(paths, topics=None, stats=None, start_time=None,
+                      end_time=None):
+    """Yield topic, raw message and timestamp of messages on topics in bags
+
+    Like rosbag.Bag.read_messages(topics=topics, raw=True) with times
+    in seconds since epoch, but chunks without messages on the topics
+    within the time window are not read, see bagindex.read_messages.
+    Bags not readable via their index are read with rosbag and
+    accounted in stats as read completely. Topics may be a set the
+    caller removes topics from while iterating, reading stops once no
+    topics remain.
+    """
+    pytypes = {}
+    for path in paths:
+        if topics is not None and not topics:
+            break
+        import genpy.dynamic
+        import rospy
+        try:
+            msgs = read_indexed_messages(path, topics, stats, start_time, end_time)
+        except BagIndexError:
+            import rosbag
+            if stats is not None:
+                stats.bytes_read += os.path.getsize(path)
+            rbag = rosbag.Bag(path)
+            for msg in rbag.read_messages(
+                    topics=None if topics is None else list(topics), raw=True,
+                    start_time=None if start_time is None else rospy.Time(start_time),
+                    end_time=None if end_time is None else rospy.Time(end_time)):
+                if topics is not None and msg[0] not in topics:
+                    if not topics:
+                        break
+                    continue
+                yield msg
+            rbag.close()
+            continue
+
+        for conn, (secs, nsecs), data, position in msgs:
+            key = conn.msg_type, conn.md5sum
+            pytype = pytypes.get(key)
+            if pytype is None:
+                pytype = pytypes[key] = genpy.dynamic.generate_dynamic(
+                    conn.msg_type, conn.msg_def)[conn.msg_type]
+            yield (conn.topic, (conn.msg_type, data, conn.md5sum, position, pytype),
+                   rospy.Time(secs, nsecs))
+
+
+def read_start_time(paths):
+    """Return start time of consecutive bags in seconds since epoch"""
+    try:
+        return read_index(paths[0]).start_time
+    except BagIndexError:
+        import rosbag
+        rbag = rosbag.Bag(paths[0])
+        try:
+            return rbag.get_start_time()
+        finally:
+            rbag.close()
+
+
+class MessageFilter(object):
+    """Select messages by time window, and first limit and stride per topic
+
+    Messages are expected in time order. The filter is done, once no
+    more messages would be selected: past end_time or, in case topics
+    is given, once limit messages of each topic were selected.
+    """
+    def __init__(self, start_time=None, end_time=None, limit=None, stride=None,
+                 topics=None):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.limit = limit
+        self.stride = stride or 1
+        self.pending = None if topics is None or limit is None else set(topics)
+        self.done = self.pending is not None and not self.pending
+        self.counts = defaultdict(int)
+        self.selected = defaultdict(int)
+
+    def wants(self, topic):
+        """Whether messages of topic may still be selected"""
+        return not self.done and (self.pending is None or topic in self.pending)
+
+    def __call__(self, topic, timestamp):
+        if self.start_time is not None or self.end_time is not None:
+            secs = timestamp.to_sec()
+            if self.start_time is not None and secs < self.start_time:
+                return False
+            if self.end_time is not None and secs > self.end_time:
+                self.done = True
+                return False
+        idx = self.counts[topic]
+        self.counts[topic] += 1
+        if idx % self.stride or \
+           self.limit is not None and self.selected[topic] >= self.limit:
+            return False
+        self.selected[topic] += 1
+        if self.pending is not None and self.selected[topic] == self.limit:
+            self.pending.discard(topic)
+            self.done = not self.pending
+        return True
+
+
+def ship(topic, raw_msg, timestamp):
+    """Return picklable form of raw message for a job process"""
+    datatype, data, md5sum = raw_msg[:3]
+    return topic, datatype, data, md5sum, timestamp.secs, timestamp.nsecs
+
+
+def read_message_definitions(paths):
+    """Return message definition by datatype of connections in bags"""
+    defs = {}
+    for path in paths:
+        try:
+            connections = read_index(path).connections.values()
+        except BagIndexError:
+            import rosbag
+            rbag = rosbag.Bag(path)
+            connections = [Connection(None, x.topic, x.datatype, x.md5sum, x.msg_def)
+                           for x in rbag._connections.values()]
+            rbag.close()
+        defs.update((x.msg_type, x.msg_def) for x in connections)
+    return defs
+
+
+def make_unshipper(msg_defs, decode=MSG):
+    """Return function turning shipped messages into BagMessages
+
+    Message classes are generated from msg_defs on first use like
+    rosbag does it, so message packages need not be installed.
+    """
+    pytypes = {}
+
+    def unship(shipped):
+        import genpy
+        import genpy.dynamic
+        topic, datatype, data, md5sum, secs, nsecs = shipped
+        pytype = pytypes.get(datatype)
+        if pytype is None:
+            pytype = pytypes[datatype] = \
+                genpy.dynamic.generate_dynamic(datatype, msg_defs[datatype])[datatype]
+        msg = deserialize((datatype, data, md5sum, None, pytype), decode)
+        return BagMessage(topic, msg, genpy.Time(secs, nsecs))
+    return unship
+
 
 @click.argument('bags', nargs=-1, required=True,
                 type=click.Path(exists=True, dir_okay=False))
 class Messages(JobInput):
-    def __init__(self, topics, **kw):
+    """Messages of a fileset on topics
+
+    Jobs may limit their messages to a time window of start to end
+    seconds relative to the start of the fileset, the first limit
+    messages and/or every stride-th message of each topic. Reading
+    stops as soon as no more messages would be selected.
+    """
+    def __init__(self, topics, decode=MSG, start=None, end=None, limit=None,
+                 stride=None, **kw):
         super(Messages, self).__init__(**kw)
         if type(topics) not in [tuple, list]:
             topics = (topics,)
+        assert decode in (MSG, HEADER, RAW), decode
         self.topics = topics
+        self.decode = decode
+        self.start = start
+        self.end = end
+        self.limit = limit
+        self.stride = stride
+
+    @property
+    def windowed(self):
+        return self.start is not None or self.end is not None
+
+    def make_filter(self, start_time, topics=None):
+        """Return MessageFilter for fileset starting at start_time, or None"""
+        if not self.windowed and self.limit is None and self.stride is None:
+            return None
+        return MessageFilter(
+            start_time=None if self.start is None else start_time + self.start,
+            end_time=None if self.end is None else start_time + self.end,
+            limit=self.limit, stride=self.stride, topics=topics)
 
     def __call__(self, bags):
-        import rosbag
-        for bag in bags:
-            rbag = rosbag.Bag(bag)
-            for x in (BagMessage(*x) for x in rbag.read_messages(topics=self.topics)):
-                yield x
+        msg_filter = self.make_filter(read_start_time(bags) if self.windowed else 0,
+                                      topics=self.topics)
+        kw = {}
+        if msg_filter:
+            kw = dict(start_time=msg_filter.start_time, end_time=msg_filter.end_time)
+        for topic, raw_msg, timestamp in read_raw_messages(bags, self.topics, **kw):
+            if msg_filter:
+                if not msg_filter(topic, timestamp):
+                    if msg_filter.done:
+                        break
+                    continue
+            yield BagMessage(topic, deserialize(raw_msg, self.decode), timestamp)
+            if msg_filter and msg_filter.done:
+                break
 
 
 messages = make_parameter('messages', Messages)
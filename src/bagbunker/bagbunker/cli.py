@@ -36,25 +36,37 @@ import flask
 import logging
 import os
 import shutil
-from collections import OrderedDict
+import time
+from collections import OrderedDict, defaultdict
 from functools import partial
-from threading import Thread
+from multiprocessing.pool import ThreadPool
+from sqlalchemy.exc import OperationalError
+from threading import BoundedSemaphore, Event, Thread
 from werkzeug import release_local
-from marv import create_app, load_formats, load_jobs
+from marv import create_app, jobqueue, load_formats, load_jobs
 from marv.globals import _job_ctx_stack
-from marv.listing import populate_listing_cache, trigger_update_listing_entries
+from marv.listing import sync_listing_cache, trigger_update_listing_entries
 from marv.log import loglevel_option
-from marv.model import db, Fileset, Jobfile, Jobrun
+from marv.model import db, File, Fileset, Jobfile, Jobrun
 from marv.storage import Storage
+from marv.verify import DEFAULT_JOBS as DEFAULT_VERIFY_JOBS, MD5Verifier
 
 from marv.registry import JOB
-from marv._utils import make_async_job, async_job_milker, Done
+from marv._utils import DEFAULT_QUEUE_SIZE, Done, async_job_milker, make_async_job
+from marv._utils import JobProcessPool, Slots, make_process_job, put_message
+from .bagindex import ReadStats
+from .bb_bag import BagMessage, MSG, deserialize, make_unshipper, ship
+from .bb_bag import read_message_definitions, read_raw_messages, read_start_time
+from .model import BagTopic, BagTopics
 
 
 load_formats()
 load_jobs()
 
 
+SHIPPED = 'shipped'
+
+
 def config_option(key):
     def callback(ctx, param, value):
         ctx.params.setdefault('config', dict())[key] = value
@@ -180,6 +192,17 @@ def initdb(ctx):
     STORAGE = Storage.new_storage()
 
 
+@admin.command('sync-listing')
+@click.pass_context
+def sync_listing(ctx):
+    """Sync listing cache, rebuilding it if needed
+
+    Run before starting web server processes, they only sync changes.
+    """
+    count = sync_listing_cache()
+    click.utils.echo('Synced {} listing entries'.format(count))
+
+
 # @admin.command('purge-jobruns')
 # @click.confirmation_option(help='Are you sure you want to purge old jobruns?')
 def purge_jobruns():
@@ -247,12 +270,29 @@ def purge_jobruns():
               help='Read pending filesets after scan')
 @click.option('--run-all-jobs/--no-run-all-jobs',
               help='Run all jobs on new filesets')
+@click.option('--full/--no-full',
+              help='Rescan all directories and files, ignoring the scan index')
+@click.option('--verify-jobs', type=click.IntRange(1), default=DEFAULT_VERIFY_JOBS,
+              show_default=True, help='Number of files to verify md5 in parallel')
 @click.argument('directories', nargs=-1, required=True,
                 type=click.Path(exists=True, file_okay=False, resolve_path=True))
 @click.pass_context
-def scan(ctx, directories, read_pending, run_all_jobs):
-    """Scan one or more base directories for filesets"""
-    STORAGE.scan_all(directories)
+def scan(ctx, directories, read_pending, run_all_jobs, full, verify_jobs):
+    """Scan one or more base directories for filesets
+
+    Directories and files unchanged since the last scan are skipped,
+    use --full to notice files that were rewritten in place.
+    """
+    logger = logging.getLogger('bagbunker.scan')
+    STORAGE.verifier = verifier = MD5Verifier(jobs=verify_jobs)
+    try:
+        STORAGE.scan_all(directories, use_index=True, full=full)
+    finally:
+        verifier.close()
+    if verifier.bytes:
+        logger.info('Verified %.1f MiB in %.1fs (%.1f MiB/s)',
+                    verifier.bytes / 2**20, verifier.seconds,
+                    verifier.throughput / 2**20)
     if read_pending:
         ctx.invoke(_read_pending)
     if run_all_jobs:
@@ -260,9 +300,11 @@ def scan(ctx, directories, read_pending, run_all_jobs):
 
 
 @bagbunker.command(name='read-pending')
-def _read_pending():
+@click.option('--workers', type=click.IntRange(1), default=1, show_default=True,
+              help='Number of processes reading filesets in parallel')
+def _read_pending(workers):
     """Read pending filesets"""
-    STORAGE.read_pending()
+    STORAGE.read_pending(workers=workers)
 
 
 # The future
@@ -279,14 +321,236 @@ class RunJobs(click.MultiCommand):
         return click.Command(name=name, callback=job, params=params)
 
 
+def plan_jobs(filesets, cmdlist, force):
+    """Yield fileset, topics and cmds for filesets having jobs to run
+
+    filesets is a query, cmdlist is a list of (topics, cmd) of jobs to
+    consider. Topics and finished jobruns of all filesets are fetched
+    with one query each instead of per fileset.
+    """
+    ids = filesets.with_entities(Fileset.id).order_by(None).subquery()
+    ids = db.select([ids.c.id])
+
+    fileset_topics = {}
+    wanted = set(x for cmdtopics, _ in cmdlist for x in cmdtopics)
+    if wanted:
+        query = db.session.query(BagTopics.bag_id, BagTopic.name)\
+                          .join(BagTopics.topic)\
+                          .filter(BagTopics.bag_id.in_(ids))
+        if '*' not in wanted:
+            query = query.filter(BagTopic.name.in_(wanted))
+        for fileset_id, name in query:
+            fileset_topics.setdefault(fileset_id, set()).add(name)
+
+    # jobruns may be aborted - in this case they neither succeeded not failed
+    # We could create them as failed
+    # We could not add them to the DB until they are done
+    uptodate = set()
+    if not force:
+        uptodate.update(
+            db.session.query(Jobrun.fileset_id, Jobrun.name)
+            .filter(Jobrun.fileset_id.in_(ids))
+            .filter(Jobrun.succeeded.is_(True) | Jobrun.failed.is_(True))
+            .filter(db.or_(*[(Jobrun.name == cmd.name) &
+                             (Jobrun.version >= cmd.callback.version)
+                             for _, cmd in cmdlist]))
+            .distinct())
+
+    for fileset in filesets:
+        topics = set()
+        cmds = []
+        available = fileset_topics.get(fileset.id, set())
+        for cmdtopics, cmd in cmdlist:
+            if (fileset.id, cmd.name) in uptodate:
+                continue
+
+            # XXX: hack for jobs that don't want messages
+            if not cmdtopics:
+                cmds.append(((), cmd))
+                continue
+
+            if '*' in cmdtopics:
+                topics = topics.union(available)
+                cmds.append((available, cmd))
+                continue
+
+            intersect = available.intersection(cmdtopics)
+            if intersect:
+                topics = topics.union(intersect)
+                cmds.append((cmdtopics, cmd))
+        if cmds:
+            yield fileset, topics, cmds
+
+
+def start_job_processes(ctx, commands, size):
+    """Return pool of size processes to run jobs with --backend process
+
+    To be called before any threads are started, see JobProcessPool.
+    """
+    def resolve(spec):
+        name, msg_defs, decode = spec
+        return (partial(ctx.invoke, commands.get_command(ctx, name)),
+                make_unshipper(msg_defs, decode))
+    return JobProcessPool(ctx.obj, size, resolve)
+
+
+def run_fileset_jobs(ctx, fileset, topics, cmds, jobconfig, backend='thread',
+                     queue_size=DEFAULT_QUEUE_SIZE, reader_slots=None, logger=None,
+                     pool=None):
+    """Run jobs for fileset feeding them its messages, return jobrun ids by job
+
+    All jobs are started in parallel - at this point we know that
+    topics a job wants do exist. The process backend runs them in
+    pool, see start_job_processes.
+    """
+    app = ctx.obj
+    logger = logger or logging.getLogger('bagbunker.run-jobs')
+    decode = {cmd.name: getattr(JOB[cmd.name].inputs[0], 'decode', MSG)
+              for _, cmd in cmds}
+    logger.info('Starting job run for fileset %s', fileset.name)
+    if backend == 'process':
+        # Job processes get raw message data and deserialize themselves
+        msg_defs = read_message_definitions([x.path for x in fileset.files]) \
+            if topics else {}
+        make_job = lambda cmd, **kw: make_process_job(
+            pool, spec=(cmd.name, msg_defs, decode[cmd.name]), **kw)
+    else:
+        make_job = lambda cmd, **kw: make_async_job(
+            app=app, job=partial(ctx.invoke, cmd), **kw)
+    async_jobs = [make_job(cmd, name=cmd.name,
+                           topics=cmdtopics,
+                           group=cmd.callback.namespace,
+                           version=cmd.callback.version,
+                           fileset_id=fileset.id,
+                           config=jobconfig.get(cmd.name, {}),
+                           queue_size=queue_size)
+                  for cmdtopics, cmd in cmds]
+    logger.info('Created %ss for: %s', backend, [x.name for x in async_jobs])
+    milkers = {}
+    for async_job in async_jobs:
+        name = async_job.thread.name
+        thread = Thread(target=async_job_milker, name=name,
+                        args=(app, async_job,))
+        thread.daemon = True
+        thread.start()
+        milkers[name] = thread
+
+    # Jobs may select messages by time window, count and stride; the
+    # bags are read for the union of their time windows
+    paths = [x.path for x in fileset.files] if topics else []
+    inputs = {x.name: JOB[x.name].inputs[0] for x in async_jobs}
+    start_time = read_start_time(paths) \
+        if paths and any(getattr(x, 'windowed', False) for x in inputs.values()) \
+        else 0
+    filters = {x.name: inputs[x.name].make_filter(start_time, x.topics)
+               if hasattr(inputs[x.name], 'make_filter') else None
+               for x in async_jobs}
+    windows = [(x.start_time, x.end_time) if x else (None, None)
+               for x in filters.values()]
+    read_start = None if any(x is None for x, _ in windows) else \
+        min(x for x, _ in windows)
+    read_end = None if any(x is None for _, x in windows) else \
+        max(x for _, x in windows)
+
+    # Per topic the names of jobs still reading it. Topics without
+    # subscribers are not read anymore, reading stops once none remain.
+    jobs = OrderedDict((x.name, x) for x in async_jobs)
+    subscribers = defaultdict(set)
+    for async_job in async_jobs:
+        for topic in async_job.topics:
+            subscribers[topic].add(async_job.name)
+    wanted = set(topics)
+
+    def unsubscribe(name, topics):
+        for topic in topics:
+            subscribers[topic].discard(name)
+            if not subscribers[topic]:
+                wanted.discard(topic)
+
+    # Messages are deserialized only as far as needed by jobs
+    # subscribed to their topic, at most once and shared by them
+    stats = ReadStats()
+    messages = read_raw_messages(paths, wanted, stats, read_start, read_end)
+    with reader_slots or BoundedSemaphore():
+        for topic, raw_msg, timestamp in messages:
+            for name in [x for x, y in jobs.items()
+                         if not milkers[y.thread.name].is_alive()]:
+                unsubscribe(name, jobs.pop(name).topics)
+            if not wanted:
+                break
+            msgs = {}
+            finished = []
+            for name in list(subscribers[topic]):
+                msg_filter = filters[name]
+                if msg_filter is not None:
+                    selected = msg_filter(topic, timestamp)
+                    if msg_filter.done:
+                        finished.append(name)
+                    elif not msg_filter.wants(topic):
+                        unsubscribe(name, [topic])
+                    if not selected:
+                        continue
+                what = SHIPPED if backend == 'process' else decode[name]
+                if what is SHIPPED and what not in msgs:
+                    msgs[what] = ship(topic, raw_msg, timestamp)
+                elif what not in msgs:
+                    msgs[what] = BagMessage(topic, deserialize(raw_msg, what),
+                                            timestamp)
+                put_message(jobs[name], msgs[what])
+
+            # Jobs not selecting any more messages are done
+            for name in finished:
+                async_job = jobs.pop(name)
+                unsubscribe(name, async_job.topics)
+                put_message(async_job, Done)
+        messages.close()
+
+    for async_job in jobs.values():
+        put_message(async_job, Done)
+
+    for milker in milkers.values():
+        milker.join()
+
+    logger.info('Read %d of %d chunks, %d bytes read, %d bytes skipped',
+                stats.chunks_read, stats.chunks_read + stats.chunks_skipped,
+                stats.bytes_read, stats.bytes_skipped)
+    for async_job in async_jobs:
+        queue = async_job.msg_queue
+        logger.info('%s: queue peak %d/%d, reading stalled %d times for %.1fs',
+                    async_job.name, queue.peak, queue.maxsize,
+                    queue.stalls, queue.stalled)
+
+    trigger_update_listing_entries([fileset.id])
+    return {x.name: x.jobrun_id for x in async_jobs}
+
+
 @bagbunker.command(name='run-jobs', cls=RunJobs, invoke_without_command=True)
 @click.option('--all/--no-all')
 @click.option('--force/--no-force')
 @click.option('--fileset', multiple=True,
               help='Only run job(s) for specific fileset (name/md5)')
 @click.option('--job', multiple=True, help='Specify job, may be used multiple times.')
+@click.option('--queue-size', type=click.IntRange(1), default=DEFAULT_QUEUE_SIZE,
+              show_default=True,
+              help='Messages queued per job before reading blocks')
+@click.option('--backend', type=click.Choice(['thread', 'process']), default='thread',
+              show_default=True,
+              help='Run jobs in threads or each in its own process')
+@click.option('--parallel', type=click.IntRange(1), default=1, show_default=True,
+              help='Number of filesets to run jobs for concurrently')
+@click.option('--max-jobs', type=click.IntRange(1),
+              help='Maximum number of jobs running concurrently  [default: unlimited]')
+@click.option('--max-readers', type=click.IntRange(1),
+              help='Maximum number of filesets read concurrently  [default: parallel]')
+@click.option('--order', type=click.Choice(['id', 'newest', 'smallest']), default='id',
+              show_default=True, help='Order in which filesets are run')
+@click.option('--enqueue/--no-enqueue',
+              help='Queue jobs for workers instead of running them')
+@click.option('--plan-only/--no-plan-only',
+              help='Only print the jobs that would be run per fileset')
 @click.pass_context
-def run_jobs(ctx, all, force, fileset, job):
+def run_jobs(ctx, all, force, fileset, job, queue_size, backend, parallel,
+             max_jobs, max_readers, order, enqueue, plan_only):
     """Run jobs for read filesets - slower
     """
     logger = logging.getLogger('bagbunker.run-jobs')
@@ -314,7 +578,6 @@ def run_jobs(ctx, all, force, fileset, job):
         print "No jobs to run"
         ctx.exit()
 
-    MATRIX = OrderedDict()
     filesets = storage.active_intact_filesets\
                       .filter(Fileset.read_succeeded.is_(True))
     if fileset:
@@ -323,99 +586,221 @@ def run_jobs(ctx, all, force, fileset, job):
             for x in fileset   # multiple
         ))
         filesets = filesets.filter(fileset_filter)
-    for fileset in filesets:
-        bag = fileset.bag
-        if bag is None:
-            fileset_topics = set()
-        else:
-            fileset_topics = set([x.topic.name for x in bag.topics])
-        topics = set()
-        cmds = []
-        jobruns = Jobrun.query.filter(Jobrun.fileset == fileset)
-        # jobruns may be aborted - in this case they neither succeeded not failed
-        # We could create them as failed
-        # We could not add them to the DB until they are done
-        latest = dict(jobruns.with_entities(Jobrun.name, db.func.max(Jobrun.version))
-                      .filter(Jobrun.succeeded.is_(True) | Jobrun.failed.is_(True))
-                      .group_by(Jobrun.name))
-        for cmdtopics, cmd in cmdlist:
-            if not force and cmd.name in latest and \
-               cmd.callback.version <= latest[cmd.name]:
-                continue
-
-            # XXX: hack for jobs that don't want messages
-            if not cmdtopics:
-                cmds.append(((), cmd))
-                continue
-
-            if '*' in cmdtopics:
-                topics = topics.union(fileset_topics)
-                cmds.append((fileset_topics, cmd))
-                continue
-
-            intersect = fileset_topics.intersection(cmdtopics)
-            if intersect:
-                topics = topics.union(intersect)
-                cmds.append((cmdtopics, cmd))
-        if cmds:
-            MATRIX[fileset] = topics, cmds
+    if order == 'newest':
+        filesets = filesets.order_by(Fileset.time_added.desc(), Fileset.id.desc())
+    elif order == 'smallest':
+        size = db.session.query(File.fileset_id, db.func.sum(File.size).label('size'))\
+                         .group_by(File.fileset_id).subquery()
+        filesets = filesets.join(size, size.c.fileset_id == Fileset.id)\
+                           .order_by(size.c.size, Fileset.id)
+    else:
+        filesets = filesets.order_by(Fileset.id)
+    MATRIX = OrderedDict((fileset, (topics, cmds)) for fileset, topics, cmds
+                         in plan_jobs(filesets, cmdlist, force))
 
     if not MATRIX:
         ctx.exit()
 
-    # for each fileset, start all registered jobs in parallel - at
-    # this point we know that topics a job wants do exist
-    for fileset, (topics, cmds) in MATRIX.items():
-        logger.info('Starting job run for fileset %s', fileset.name)
-        async_jobs = [make_async_job(app=app, name=cmd.name,
-                                     topics=cmdtopics,
-                                     job=partial(ctx.invoke, cmd),
-                                     group=cmd.callback.namespace,
-                                     version=cmd.callback.version,
-                                     fileset_id=fileset.id,
-                                     config=jobconfig.get(cmd.name, {}))
-                      for cmdtopics, cmd in cmds]
-        logger.info('Created threads for: %s', [x.name for x in async_jobs])
-        milkers = {}
-        for async_job in async_jobs:
-            name = async_job.thread.name
-            thread = Thread(target=async_job_milker, name=name,
-                            args=(app, async_job,))
-            thread.daemon = True
-            thread.start()
-            milkers[name] = thread
-
-        def messages():
-            if not topics:
-                return
-            import rosbag
-            for file in fileset.files:
-                rbag = rosbag.Bag(file.path)
-                for msg in rbag.read_messages(topics=topics):
-                    yield msg
-
-        for msg in messages():
-            async_jobs = [x for x in async_jobs if milkers[x.thread.name].is_alive()]
-            if not async_jobs:
-                break
-            for async_job in async_jobs:
-                # XXX: replace with namedtuple
-                topic, _, _ = msg
-                if topic in async_job.topics:
-                    async_job.msg_queue.put(msg)
-
-        for async_job in async_jobs:
-            async_job.msg_queue.put(Done)
+    if plan_only:
+        for x, (_, cmds) in MATRIX.items():
+            click.echo('{} {}: {}'.format(x.md5, x.name,
+                                          ' '.join(cmd.name for _, cmd in cmds)))
+        logger.info('%d jobs for %d filesets', sum(len(x[1]) for x in MATRIX.values()),
+                    len(MATRIX))
+        ctx.exit()
 
-        for milker in milkers.values():
-            milker.join()
+    if enqueue:
+        count = jobqueue.enqueue([(x.id, cmd.name, cmd.callback.version)
+                                  for x, (_, cmds) in MATRIX.items()
+                                  for _, cmd in cmds], reset=force)
+        logger.info('Queued %d jobs', count)
+        ctx.exit()
 
-        trigger_update_listing_entries([fileset.id])
+    job_slots = Slots(max_jobs or sum(len(x[1]) for x in MATRIX.values()))
+    reader_slots = BoundedSemaphore(max_readers or parallel)
+    job_processes = start_job_processes(ctx, ctx.command, min(
+        job_slots.size, parallel * max(len(x[1]) for x in MATRIX.values()))) \
+        if backend == 'process' else None
+
+    def run_fileset(item):
+        fileset_id, (topics, cmds) = item
+        with app.app_context():
+            try:
+                fileset = Fileset.query.get(fileset_id)
+                acquired = job_slots.acquire(len(cmds))
+                try:
+                    run_fileset_jobs(ctx, fileset, topics, cmds, jobconfig,
+                                     backend=backend, queue_size=queue_size,
+                                     reader_slots=reader_slots, logger=logger,
+                                     pool=job_processes)
+                finally:
+                    job_slots.release(acquired)
+            except:
+                import traceback
+                logger.error('Job run for fileset %s failed\n%s',
+                             fileset_id, traceback.format_exc())
+            finally:
+                db.session.remove()
+
+    pool = ThreadPool(parallel)
+    try:
+        pool.map(run_fileset, [(x.id, y) for x, y in MATRIX.items()], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        if job_processes is not None:
+            job_processes.close()
 
     # Never call subcommand directly
     ctx.exit()
 
 
+@bagbunker.command()
+@click.option('--lease', type=click.IntRange(10), default=jobqueue.DEFAULT_LEASE,
+              show_default=True,
+              help='Seconds a claimed job is reserved, renewed while running')
+@click.option('--poll', type=click.IntRange(1), default=10, show_default=True,
+              help='Seconds to wait before looking for jobs again')
+@click.option('--once/--no-once', help='Exit once no jobs are queued')
+@click.option('--queue-size', type=click.IntRange(1), default=DEFAULT_QUEUE_SIZE,
+              show_default=True,
+              help='Messages queued per job before reading blocks')
+@click.option('--backend', type=click.Choice(['thread', 'process']), default='thread',
+              show_default=True,
+              help='Run jobs in threads or each in its own process')
+@click.pass_context
+def worker(ctx, lease, poll, once, queue_size, backend):
+    """Run jobs queued with run-jobs --enqueue
+
+    Any number of workers, also on several hosts sharing database and
+    bag storage, may drain the queue together.
+    """
+    logger = logging.getLogger('bagbunker.worker')
+    logger.setLevel(logging.INFO)
+    app = ctx.obj
+    db.create_all()
+    jobconfig = read_config(os.path.join(ctx.obj.instance_path, 'job.cfg'))
+    owner = jobqueue.default_owner()
+    runjobs = RunJobs()
+    logger.info('Worker %s started', owner)
+
+    def heartbeat(ids, stop):
+        with app.app_context():
+            try:
+                while not stop.wait(lease / 3):
+                    try:
+                        if jobqueue.heartbeat(ids, owner, lease) < len(ids):
+                            logger.warn('Lost lease of some of %r', ids)
+                    except OperationalError:
+                        # lease is long enough to survive a missed beat
+                        db.session.rollback()
+                        import traceback
+                        logger.warn('Heartbeat for %r failed\n%s',
+                                    ids, traceback.format_exc())
+            finally:
+                db.session.remove()
+
+    def release(ids):
+        """Return uncompleted items to the queue, their leases expire otherwise"""
+        try:
+            db.session.rollback()
+            jobqueue.release(ids, owner)
+        except OperationalError:
+            db.session.rollback()
+            logger.warn('Could not release %r, leases will expire', ids)
+
+    def run_claimed(items, pending):
+        """Run claimed items, removing completed ones from pending"""
+        fileset = items[0].fileset
+        logger.info('Claimed %r', items)
+        for item in items:
+            if item.name not in JOB:
+                # no worker will know it better, retrying is futile
+                logger.error('Unknown job %s', item.name)
+                jobqueue.complete(item.id, owner, succeeded=False, retry=False)
+                pending.remove(item.id)
+            elif JOB[item.name].version != item.version:
+                logger.warn('Running %s version %s for queued version %s',
+                            item.name, JOB[item.name].version, item.version)
+        items = [x for x in items if x.name in JOB]
+        cmdlist = [(JOB[x.name].inputs[0].topics, runjobs.get_command(ctx, x.name))
+                   for x in items]
+        jobruns = {}
+        crashed = False
+        stop = Event()
+        thread = Thread(target=heartbeat, args=([x.id for x in items], stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            for fileset, topics, cmds in plan_jobs(
+                    Fileset.query.filter(Fileset.id == fileset.id), cmdlist,
+                    force=True):
+                jobruns = run_fileset_jobs(ctx, fileset, topics, cmds, jobconfig,
+                                           backend=backend, queue_size=queue_size,
+                                           logger=logger, pool=job_processes)
+        except KeyboardInterrupt:
+            raise
+        except:
+            import traceback
+            logger.error('Job run for fileset %s failed\n%s',
+                         fileset.id, traceback.format_exc())
+            crashed = True
+            db.session.rollback()
+        finally:
+            stop.set()
+            thread.join()
+
+        # jobruns were finished by the milkers' sessions
+        db.session.expire_all()
+        for item in items:
+            jobrun_id = jobruns.get(item.name)
+            if jobrun_id is not None:
+                succeeded = bool(Jobrun.query.get(jobrun_id).succeeded)
+            else:
+                # not planned as fileset lacks the job's topics
+                succeeded = not crashed
+            jobqueue.complete(item.id, owner, succeeded=succeeded,
+                              jobrun_id=jobrun_id)
+            pending.remove(item.id)
+
+    # Queued items of a fileset are at most one per job
+    job_processes = start_job_processes(ctx, runjobs, len(JOB)) \
+        if backend == 'process' else None
+    try:
+        while True:
+            try:
+                items = jobqueue.claim(owner, lease)
+            except OperationalError:
+                db.session.rollback()
+                import traceback
+                logger.error('Claiming jobs failed, retrying in %ds\n%s',
+                             poll, traceback.format_exc())
+                time.sleep(poll)
+                continue
+
+            if not items:
+                if once:
+                    break
+                time.sleep(poll)
+                continue
+
+            pending = [x.id for x in items]
+            try:
+                run_claimed(items, pending)
+            except OperationalError:
+                import traceback
+                logger.error('Running %r failed, retrying in %ds\n%s',
+                             pending, poll, traceback.format_exc())
+                release(pending)
+                time.sleep(poll)
+            except:
+                release(pending)
+                raise
+    finally:
+        if job_processes is not None:
+            job_processes.close()
+
+
 @bagbunker.command('webserver')
 @click.option('--cors/--no-cors', default=True)
 @click.option('--wdb/--no-wdb', default=False)
@@ -438,7 +823,7 @@ def webserver(app, cors, wdb, public, verbose_request_logging):
     if verbose_request_logging:
         app.logger.setLevel(logging.DEBUG)
         app.config['LOG_REQUESTS'] = True
-    populate_listing_cache()
+    sync_listing_cache()
     app.run(reloader_type='watchdog', **kw)
 
 
@@ -22,6 +22,10 @@
 
 from __future__ import absolute_import, division
 
+import weakref
+from threading import RLock
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from marv import bb, db
 
 
@@ -59,3 +63,82 @@ class BagTopics(db.Model):
         return '<{}.{} topic="{}" msg_type="{}" msg_count={}>'.format(
             self.__module__, self.__class__.__name__,
             self.topic.name, self.msg_type.name, self.msg_count)
+
+
+class NameCache(object):
+    """Interning cache resolving names of a dimension table to ids
+
+    All rows are loaded with one query on first use per engine. Rows
+    for unknown names are created in bulk within the current session
+    and become visible to other sessions once it commits; they are
+    forgotten if it rolls back.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.lock = RLock()
+        self._engine = None
+        self._ids = None
+        self._pending = weakref.WeakKeyDictionary()
+        NAME_CACHES.add(self)
+
+    def _after_commit(self, session):
+        with self.lock:
+            pending = self._pending.pop(session, None)
+            if pending and self._ids is not None:
+                self._ids.update(pending)
+
+    def _after_rollback(self, session):
+        with self.lock:
+            self._pending.pop(session, None)
+
+    def resolve(self, names):
+        """Return dict mapping names to ids, creating missing rows"""
+        model = self.model
+        session = db.session()
+        with self.lock:
+            engine = self._engine and self._engine()
+            if self._ids is None or engine is not db.engine:
+                self._engine = weakref.ref(db.engine)
+                self._ids = dict((name, id) for id, name in
+                                 session.query(model.id, model.name))
+                self._pending.clear()
+            pending = self._pending.setdefault(session, {})
+            ids = {}
+            missing = set()
+            for name in names:
+                id = self._ids.get(name) or pending.get(name)
+                if id is None:
+                    missing.add(name)
+                else:
+                    ids[name] = id
+            if not missing:
+                return ids
+
+            # Created by others since loaded
+            for id, name in session.query(model.id, model.name)\
+                                   .filter(model.name.in_(list(missing))):
+                self._ids[name] = ids[name] = id
+                missing.discard(name)
+            if missing:
+                session.execute(model.__table__.insert(),
+                                [{'name': x} for x in missing])
+                for id, name in session.query(model.id, model.name)\
+                                       .filter(model.name.in_(list(missing))):
+                    pending[name] = ids[name] = id
+            return ids
+
+
+# Live caches, notified by session listeners registered once for all
+NAME_CACHES = weakref.WeakSet()
+
+
+@event.listens_for(Session, 'after_commit')
+def _name_caches_after_commit(session):
+    for cache in list(NAME_CACHES):
+        cache._after_commit(session)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _name_caches_after_rollback(session):
+    for cache in list(NAME_CACHES):
+        cache._after_rollback(session)
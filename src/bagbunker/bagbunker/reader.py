@@ -23,57 +23,39 @@
 from __future__ import absolute_import, division
 
 import cPickle as pickle
-from marv import bb, db
+from marv import bb
 from collections import OrderedDict, defaultdict
 from datetime import datetime
 from functools import partial
 from logging import getLogger
-from .model import Bag, BagMsgType, BagTopic, BagTopics
+from .bagindex import BagIndexError, read_index
+from .bb_bag import MessageFilter, read_raw_messages
+from .model import Bag, BagMsgType, BagTopic, BagTopics, NameCache
+
+
+MSG_TYPE_IDS = NameCache(BagMsgType)
+TOPIC_IDS = NameCache(BagTopic)
 
 
 @bb.reader(Bag)
-def reader(fileset):
+def reader(fileset, info=None):
     logger = getLogger('{}.{}'.format(__name__, fileset.name))
     logger.debug('start')
-    import rosbag
-    starttime = None
-    endtime = None
-    topics = defaultdict(int)
-    for file in fileset.files:
-        logger.debug('opening %s', file.path)
-        rbag = rosbag.Bag(file.path)
-
-        # We are assuming the timestamps are in local time
-        if not starttime:
-            starttime = datetime.fromtimestamp(rbag.get_start_time())
-        endtime = datetime.fromtimestamp(rbag.get_end_time())
+    if info is None:
+        info = read_info([x.path for x in fileset.files])
 
-        logger.debug('reading topic info %s', file.path)
-        info = rbag.get_type_and_topic_info()
-        for tname, topic in info.topics.items():
-            topics[tname, topic.msg_type] += topic.message_count
-
-        rbag.close()
-
-    logger.debug('topic info %r', topics)
+    # We are assuming the timestamps are in local time
+    starttime = datetime.fromtimestamp(info['starttime'])
+    endtime = datetime.fromtimestamp(info['endtime'])
     # We assume that files of a set are meant to be consecutive
     duration = endtime - starttime
 
-    # Create missing msg_types/topics and assemble lists
-    bag_topics = []
-    for (name, msg_type_name), count in topics.items():
-        topic = db.session.query(BagTopic).filter(BagTopic.name == name).first()
-        if topic is None:
-            topic = BagTopic(name=name)
-            db.session.add(topic)
-
-        msg_type = db.session.query(BagMsgType) \
-                             .filter(BagMsgType.name == msg_type_name).first()
-        if msg_type is None:
-            msg_type = BagMsgType(name=msg_type_name)
-            db.session.add(msg_type)
-
-        bag_topics.append(BagTopics(msg_count=count, msg_type=msg_type, topic=topic))
+    # Resolve msg_types/topics, creating missing ones, and assemble lists
+    topic_ids = TOPIC_IDS.resolve(x[0] for x in info['topics'])
+    msg_type_ids = MSG_TYPE_IDS.resolve(x[1] for x in info['topics'])
+    bag_topics = [BagTopics(msg_count=count, topic_id=topic_ids[name],
+                            msg_type_id=msg_type_ids[msg_type_name])
+                  for name, msg_type_name, count in info['topics']]
 
     logger.debug('done')
     # msecs = ((duration.days * 24 * 3600 + duration.seconds) * 10**6 +
@@ -82,14 +64,77 @@ def reader(fileset):
                duration=duration, topics=bag_topics)
 
 
+@reader.info_reader
+def read_info(paths):
+    """Read start/end time and message count per topic of bag files
+
+    Only the bag header and index records are read; bags without index
+    or of version 1.2 are opened with rosbag.
+    """
+    logger = getLogger(__name__)
+    starttime = None
+    endtime = None
+    topics = defaultdict(int)
+    for path in paths:
+        logger.debug('reading index %s', path)
+        try:
+            index = read_index(path)
+            start, end, counts = index.start_time, index.end_time, index.topics
+        except BagIndexError as e:
+            logger.debug('falling back to rosbag for %s: %s', path, e)
+            start, end, counts = _read_info_rosbag(path)
+
+        if starttime is None:
+            starttime = start
+        endtime = end
+        for key, count in counts.items():
+            topics[key] += count
+
+    logger.debug('topic info %r', topics)
+    return {'starttime': starttime,
+            'endtime': endtime,
+            'topics': [(name, msg_type, count)
+                       for (name, msg_type), count in topics.items()]}
+
+
+def _read_info_rosbag(path):
+    import rosbag
+    rbag = rosbag.Bag(path)
+    try:
+        info = rbag.get_type_and_topic_info()
+        return (rbag.get_start_time(), rbag.get_end_time(),
+                dict(((name, x.msg_type), x.message_count)
+                     for name, x in info.topics.items()))
+    finally:
+        rbag.close()
+
+
+def _arg(value, type, minimum=None):
+    """Return request argument converted to type, first one if several
+
+    Raise ValueError for values not convertible or less than minimum.
+    """
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    if value is None:
+        return None
+    value = type(value)
+    if minimum is not None and value < minimum:
+        raise ValueError('{} is less than {}'.format(value, minimum))
+    return value
+
+
 @reader.http_messages_generator
 def http_messages(fileset, topic=(), msg_type=(), start_time=None,
-                  end_time=None, logger=None, accept_mimetypes=None):
+                  end_time=None, limit=None, stride=None, logger=None,
+                  accept_mimetypes=None):
     """Iterate over fileset's messages, optionally filtered by topic
     and/or message type.
+
+    start_time and end_time are seconds since epoch, limit and stride
+    select the first limit and/or every stride-th message per topic.
     """
     import flask
-    import rosbag
 
     topics = {}
     for x in fileset.bag.topics:
@@ -99,17 +144,27 @@ def http_messages(fileset, topic=(), msg_type=(), start_time=None,
             continue
         topics[x.topic.name] = x.msg_type.name
     meta = {'topics': topics, 'name': fileset.name}
+    try:
+        msg_filter = MessageFilter(start_time=_arg(start_time, float),
+                                   end_time=_arg(end_time, float),
+                                   limit=_arg(limit, int, 1),
+                                   stride=_arg(stride, int, 0),
+                                   topics=topics.keys() or None)
+    except ValueError as e:
+        logger.error('Invalid message selection: %s', e)
+        flask.abort(400)
 
-    def read_messages(**kw):
-        logger.debug('start reading messages %s', kw)
-        for file in fileset.files:
-            logger.debug('opening %s', file.path)
-            rbag = rosbag.Bag(file.path)
-            for x in rbag.read_messages(**kw):
-                yield x
-            rbag.close()
-            logger.debug('closed %s', file.path)
-        logger.debug('done reading messages %s', kw)
+    def read_messages(topics):
+        logger.debug('start reading messages %s', topics)
+        paths = [x.path for x in fileset.files]
+        messages = read_raw_messages(paths, topics, start_time=msg_filter.start_time,
+                                     end_time=msg_filter.end_time)
+        for topic, raw_msg, time in messages:
+            if msg_filter(topic, time):
+                yield topic, raw_msg, time
+            if msg_filter.done:
+                break
+        logger.debug('done reading messages %s', topics)
 
     def x_ros_bag_msgs(raw_messages):
         logger.debug('start streaming')
@@ -142,10 +197,7 @@ def http_messages(fileset, topic=(), msg_type=(), start_time=None,
         flask.abort(400)
 
     # start streaming
-    messages = handler[mimetype](read_messages(topics=topics.keys() or None,
-                                               start_time=start_time,
-                                               end_time=end_time,
-                                               raw=True))
+    messages = handler[mimetype](read_messages(topics.keys() or None))
     mimetype = 'application/x-ros-bag-msgs' if mimetype == '*/*' else mimetype
     return messages, mimetype
 
@@ -60,6 +60,12 @@ class TestCase(FlaskTestCase):
             ('Accept', 'foo/foo')]))
         self.assert400(resp)
 
+    @default_from_self
+    def test_invalid_selection(self, client):
+        for query in ('limit=foo', 'limit=0', 'stride=-1', 'start_time=x'):
+            resp = client.get('/marv/api/messages/{}?{}'.format(MD5, query))
+            self.assert400(resp)
+
     @default_from_self
     def test_all(self, client):
         # default handler
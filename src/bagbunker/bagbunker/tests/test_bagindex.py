@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import, division
+
+import os
+import unittest
+from pkg_resources import resource_filename
+from marv.testing import create_tempdir
+from ..bagindex import BagIndexError, ReadStats, read_index, read_messages
+
+
+BAG = resource_filename(__name__,
+                        os.sep.join(('bags', 'test_2015-02-05-12-59-06_0.bag')))
+
+
+class TestCase(unittest.TestCase):
+    def test_read_index(self):
+        index = read_index(BAG)
+        self.assertEqual(len(index.chunks), 1)
+        self.assertAlmostEqual(index.start_time, 1423137547.25, places=2)
+        self.assertAlmostEqual(index.end_time, 1423137548.22, places=2)
+        self.assertEqual(index.topics, {
+            ('/chatter', 'std_msgs/String'): 8,
+            ('/rosout', 'rosgraph_msgs/Log'): 12,
+            ('/rosout_agg', 'rosgraph_msgs/Log'): 9,
+        })
+
+    def test_read_messages(self):
+        stats = ReadStats()
+        msgs = list(read_messages(BAG, ['/chatter'], stats))
+        self.assertEqual(len(msgs), 8)
+        self.assertEqual(set(x[0].topic for x in msgs), set(['/chatter']))
+        self.assertEqual([x[1] for x in msgs], sorted(x[1] for x in msgs))
+        self.assertTrue(msgs[0][2].endswith('hello world 58 1423137547.42'))
+        self.assertEqual((stats.chunks_read, stats.chunks_skipped), (1, 0))
+
+        size = stats.bytes_read
+        stats = ReadStats()
+        self.assertEqual(list(read_messages(BAG, ['/unknown'], stats)), [])
+        self.assertEqual((stats.chunks_read, stats.chunks_skipped), (0, 1))
+        self.assertEqual((stats.bytes_read, stats.bytes_skipped), (0, size))
+
+    def test_read_messages_window(self):
+        start_time = 1423137547.5
+        msgs = list(read_messages(BAG, ['/chatter'], start_time=start_time,
+                                  end_time=start_time + 0.5))
+        times = [x[1][0] + x[1][1] * 1e-9 for x in msgs]
+        self.assertEqual(len(times), 5)
+        self.assertTrue(all(start_time <= x <= start_time + 0.5 for x in times))
+
+        stats = ReadStats()
+        self.assertEqual(list(read_messages(BAG, None, stats, end_time=0)), [])
+        self.assertEqual((stats.chunks_read, stats.chunks_skipped), (0, 1))
+
+        stats = ReadStats()
+        msgs = read_messages(BAG, None, stats)
+        next(msgs)
+        msgs.close()
+        self.assertEqual((stats.chunks_read, stats.chunks_skipped), (1, 0))
+
+    def test_read_messages_unsubscribe(self):
+        topics = set(['/chatter', '/rosout'])
+        msgs = read_messages(BAG, topics)
+        self.assertEqual(next(msgs)[0].topic, '/rosout')
+        topics.discard('/rosout')
+        self.assertEqual(set(x[0].topic for x in msgs), set(['/chatter']))
+
+        stats = ReadStats()
+        topics = set(['/chatter'])
+        msgs = read_messages(BAG, topics, stats)
+        next(msgs)
+        topics.clear()
+        self.assertEqual(list(msgs), [])
+        self.assertEqual((stats.chunks_read, stats.chunks_skipped), (1, 0))
+
+    def test_invalid(self):
+        path, cleanup = create_tempdir()
+        try:
+            empty = os.path.join(path, 'empty.bag')
+            truncated = os.path.join(path, 'truncated.bag')
+            open(empty, 'wb').close()
+            with open(BAG, 'rb') as f, open(truncated, 'wb') as g:
+                g.write(f.read(100))
+            for x in (empty, truncated, __file__):
+                with self.assertRaises(BagIndexError):
+                    read_index(x)
+        finally:
+            cleanup()
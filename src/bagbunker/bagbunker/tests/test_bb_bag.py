@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+from __future__ import absolute_import, division
+
+import unittest
+from ..bb_bag import MessageFilter
+
+
+class Time(float):
+    def to_sec(self):
+        return float(self)
+
+
+class TestCase(unittest.TestCase):
+    def select(self, msg_filter, msgs):
+        return [(topic, time) for topic, time in msgs
+                if msg_filter(topic, Time(time))]
+
+    def test_limit_stride(self):
+        msgs = [('/a', i) for i in range(10)] + [('/b', i) for i in range(10, 14)]
+        msg_filter = MessageFilter(limit=2, stride=3, topics=['/a', '/b'])
+        self.assertEqual(self.select(msg_filter, msgs[:10]), [('/a', 0), ('/a', 3)])
+        self.assertFalse(msg_filter.done)
+        self.assertFalse(msg_filter.wants('/a'))
+        self.assertTrue(msg_filter.wants('/b'))
+        self.assertEqual(self.select(msg_filter, msgs[10:]), [('/b', 10), ('/b', 13)])
+        self.assertTrue(msg_filter.done)
+
+    def test_window(self):
+        msgs = [('/a', i) for i in range(10)]
+        msg_filter = MessageFilter(start_time=2, end_time=4)
+        self.assertEqual(self.select(msg_filter, msgs[:5]),
+                         [('/a', 2), ('/a', 3), ('/a', 4)])
+        self.assertFalse(msg_filter.done)
+        self.assertEqual(self.select(msg_filter, msgs[5:]), [])
+        self.assertTrue(msg_filter.done)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import, division
+
+import flask_testing
+import gc
+import os
+from flask import Flask
+from sqlalchemy import event
+from marv.model import db
+from ..model import BagTopic, NAME_CACHES, NameCache
+
+
+class TestCase(flask_testing.TestCase):
+    SQLALCHEMY_ECHO = bool(os.environ.get('SQLALCHEMY_ECHO', False))
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config.from_object(self)
+        db.init_app(app)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        db.session.add(BagTopic(name='/known'))
+        db.session.commit()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_resolve(self):
+        cache = NameCache(BagTopic)
+        names = ['/known'] + ['/topic{}'.format(i) for i in range(300)]
+        ids = cache.resolve(names)
+        self.assertEqual(len(self.statements), 4)
+        self.assertEqual(len(set(ids.values())), 301)
+        self.assertEqual(ids['/known'], 1)
+        db.session.commit()
+        self.assertEqual(dict((x.name, x.id) for x in BagTopic.query), ids)
+
+        del self.statements[:]
+        self.assertEqual(cache.resolve(reversed(names)), ids)
+        self.assertEqual(self.statements, [])
+
+    def test_rollback(self):
+        cache = NameCache(BagTopic)
+        cache.resolve(['/known', '/new'])
+        db.session.rollback()
+        self.assertEqual(BagTopic.query.count(), 1)
+
+        del self.statements[:]
+        ids = cache.resolve(['/known', '/new'])
+        self.assertEqual(len(self.statements), 3)
+        db.session.commit()
+        self.assertEqual(BagTopic.query.get(ids['/new']).name, '/new')
+
+    def test_released_caches_stop_listening(self):
+        count = len(NAME_CACHES)
+        cache = NameCache(BagTopic)
+        self.assertEqual(len(NAME_CACHES), count + 1)
+        del cache
+        gc.collect()
+        self.assertEqual(len(NAME_CACHES), count)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+from __future__ import absolute_import, division
+
+import flask_testing
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import Flask
+from sqlalchemy import event
+from marv.model import db, Fileset, Jobrun
+from ..cli import plan_jobs
+from ..model import Bag, BagMsgType, BagTopic, BagTopics
+
+
+Cmd = namedtuple('Cmd', 'name callback')
+Callback = namedtuple('Callback', 'version')
+
+
+class TestCase(flask_testing.TestCase):
+    SQLALCHEMY_ECHO = bool(os.environ.get('SQLALCHEMY_ECHO', False))
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config.from_object(self)
+        db.init_app(app)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        now = datetime.utcnow()
+        msg_type = BagMsgType(name='std_msgs/String')
+        topics = [BagTopic(name=x) for x in ('/a', '/b')]
+        for i, names in enumerate([['/a'], ['/a', '/b'], []]):
+            fileset = Fileset(storage_id=1, md5='set{}'.format(i),
+                              name='set{}'.format(i), dirpath='', type='bag',
+                              time_added=now, time_updated=now)
+            bag = Bag(fileset=fileset, starttime=now, endtime=now,
+                      duration=timedelta())
+            for topic in topics:
+                if topic.name in names:
+                    db.session.add(BagTopics(bag=bag, topic=topic,
+                                             msg_type=msg_type, msg_count=1))
+            db.session.add(bag)
+        db.session.add(Jobrun(fileset_id=1, name='a', version='2', succeeded=True))
+        db.session.add(Jobrun(fileset_id=2, name='a', version='1', failed=True))
+        db.session.add(Jobrun(fileset_id=2, name='b', version='9'))
+        db.session.commit()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def plan(self, force=False):
+        a = Cmd('a', Callback('2'))
+        b = Cmd('b', Callback('1'))
+        c = Cmd('c', Callback('1'))
+        cmdlist = [(('/a',), a), (('*',), b), ((), c)]
+        filesets = Fileset.query.order_by(Fileset.id)
+        return [(x.name, sorted(topics), [(sorted(t), cmd.name) for t, cmd in cmds])
+                for x, topics, cmds in plan_jobs(filesets, cmdlist, force)]
+
+    def test_plan(self):
+        self.assertEqual(self.plan(), [
+            ('set0', ['/a'], [(['/a'], 'b'), ([], 'c')]),
+            ('set1', ['/a', '/b'], [(['/a'], 'a'), (['/a', '/b'], 'b'), ([], 'c')]),
+            ('set2', [], [([], 'b'), ([], 'c')]),
+        ])
+        self.assertEqual(len(self.statements), 3)
+
+    def test_force(self):
+        self.assertEqual([x[2][0][1] for x in self.plan(force=True)], ['a', 'a', 'b'])
+        self.assertEqual(len(self.statements), 2)
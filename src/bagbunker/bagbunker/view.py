@@ -48,7 +48,7 @@ def dt_from_timestamp(timestamp):
     return datetime.fromtimestamp(timestamp)
 
 
-@bb.listing()
+@bb.listing(load=('bag.topics.topic', 'bag.topics.msg_type'))
 @bb.listing_column('starttime', formatter='date')
 @bb.listing_column('endtime', formatter='date')
 @bb.listing_column('duration', title='Duration (s)', formatter='float', type=db.Float)
@@ -77,7 +77,10 @@ TOPICS = tuple(old_topics + new_topics)
 
 
 def detail_image_view(topic):
-    @bb.detail()
+    @bb.detail(job='deepfield::camera_frames',
+               name='detail_images' + topic.replace("/", "_"),
+               applies=bb.has_jobfiles('deepfield::camera_frames',
+                                         'topic'+topic.replace("/", "_")))
     @bb.gallery_widget(title='Images ' + topic)
     def detail_images(fileset):
         jobrun = fileset.get_latest_jobrun('deepfield::camera_frames')
@@ -32,7 +32,7 @@ __version__ = '0.0.1'
 class CPU_Diagnostics(object):
     data = db.Column(db.Text)
 
-@bb.detail()
+@bb.detail(job='deepfield::cpu_diagnostics')
 @bb.table_widget(title='CPU Diagnostics', sort='name')
 @bb.column('name')
 @bb.column('average load')
@@ -38,7 +38,7 @@ class Diagnostics(object):
     error_count = db.Column(db.Integer)
 
 
-@bb.detail()
+@bb.detail(job='deepfield::diagnostics')
 @bb.table_widget(title='Diagnostics', sort='name')
 @bb.column('name')
 @bb.column('OK count')
@@ -22,22 +22,22 @@
 
 from __future__ import absolute_import, division
 
-from marv import db, bb
+from marv import bb
 from bagbunker import bb_bag
 
-__version__ = '0.0.0'
+__version__ = '0.0.1'
 
 
-@bb.job_model()
+@bb.job_array()
 class Trajectory(object):
-    timestamp = db.Column(db.Integer)
-    x = db.Column(db.Float)
-    y = db.Column(db.Float)
-    z = db.Column(db.Float)
-    qx = db.Column(db.Float)
-    qy = db.Column(db.Float)
-    qz = db.Column(db.Float)
-    qw = db.Column(db.Float)
+    timestamp = bb.array_column('f8')
+    x = bb.array_column('f8')
+    y = bb.array_column('f8')
+    z = bb.array_column('f8')
+    qx = bb.array_column('f8')
+    qy = bb.array_column('f8')
+    qz = bb.array_column('f8')
+    qw = bb.array_column('f8')
 
 
 @bb.job()
@@ -61,3 +61,28 @@ def job(fileset, messages, pose_logging_interval):
                              qy=msg.pose.pose.orientation.y,
                              qz=msg.pose.pose.orientation.z,
                              qw=msg.pose.pose.orientation.w)
+
+
+@bb.detail(job='deepfield::extract_trajectories')
+@bb.table_widget(title='Trajectory')
+@bb.column('samples')
+@bb.column('duration', title='Duration [s]')
+@bb.column('distance', title='Distance [m]')
+def trajectory_detail(fileset):
+    import numpy as np
+    jobrun = fileset.get_latest_jobrun('deepfield::extract_trajectories')
+    if jobrun is None:
+        return None
+
+    samples = Trajectory.load(jobrun)
+    if samples is None or not len(samples):
+        return None
+
+    timestamps = samples['timestamp']
+    steps = np.diff(np.column_stack([samples['x'], samples['y'], samples['z']]),
+                    axis=0)
+    return [{
+        'samples': len(samples),
+        'duration': round(float(timestamps[-1] - timestamps[0]), 1),
+        'distance': round(float(np.sqrt((steps ** 2).sum(axis=1)).sum()), 1),
+    }]
@@ -46,7 +46,11 @@ TOPICS = POSITION_TOPICS + ORIENTATION_TOPICS
 
 
 def detail_image_view(topic, orient_topic):
-    @bb.detail()
+    @bb.detail(job='deepfield::gps_track',
+               name='detail_image{}{}'.format(topic.replace("/", "_"),
+                                              orient_topic.replace("/", "_")),
+               applies=bb.has_jobfiles('deepfield::gps_track',
+                                         topic.replace("/", "_")))
     @bb.image_widget(title='Position plot {}, {}'.format(topic, orient_topic))
     def detail_image(fileset):
         jobrun = fileset.get_latest_jobrun('deepfield::gps_track')
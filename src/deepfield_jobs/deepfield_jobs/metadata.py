@@ -37,11 +37,11 @@ class Metadata(object):
     use_case = db.Column(db.String(126), nullable=False)
 
 
-# XXX: This will receive all messages. What we really want is to
-# receive only /robot_name/name messages, but be called also if there
-# are no messages.
+# XXX: This will receive the first message of each topic. What we
+# really want is to receive only /robot_name/name messages, but be
+# called also if there are no messages.
 @bb.job()
-@bb_bag.messages(topics='*')
+@bb_bag.messages(topics='*', limit=1)
 def job(fileset, messages):
     if not fileset.bag:
         return
@@ -80,7 +80,7 @@ def filter_use_case(query, ListingEntry, use_case):
     return query.filter(ListingEntry.use_case.contains(use_case.val))
 
 
-@bb.listing()
+@bb.listing(load=('jobruns.' + Metadata.__tablename__,))
 @bb.listing_column('robot')
 @bb.listing_column('use_case')
 def listing(fileset):
@@ -88,9 +88,10 @@ def listing(fileset):
     if jobrun is None:
         return {}
 
-    meta = Metadata.query.filter(Metadata.jobrun == jobrun).first()
-    if meta is None:
+    metas = getattr(jobrun, Metadata.__tablename__)
+    if not metas:
         return {}
+    meta = metas[0]
     return {
         'robot': meta.robot_name,
         'use_case': meta.use_case,
@@ -38,7 +38,7 @@ SENSOR_TOPICS = ('/sensor/temperature/onewire/28_4F7FCB060000',
                  '/sensor/temperature/onewire/28_C279CC060000')
 
 
-@bb.detail()
+@bb.detail(job='deepfield::onewire_temperature')
 @bb.image_widget(title='Onewire Temperature')
 def detail_image(fileset):
     jobrun = fileset.get_latest_jobrun('deepfield::onewire_temperature')
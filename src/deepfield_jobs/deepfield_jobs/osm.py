@@ -58,7 +58,7 @@ def job(fileset, messages):
         yield Points(data=json.dumps(points))
 
 
-@bb.detail()
+@bb.detail(job='deepfield::osm')
 @bb.osm_widget(title='Trajectories')
 def osm_detail(fileset):
     jobrun = fileset.get_latest_jobrun('deepfield::osm')
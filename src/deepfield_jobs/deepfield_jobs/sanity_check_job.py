@@ -71,7 +71,7 @@ def extract_module_name(filename):
         return ''
 
 
-@bb.detail()
+@bb.detail(job='deepfield::sanity_check_job')
 @bb.table_widget(title='Sanity Check')
 @bb.column('name')
 @bb.column('value')
@@ -42,12 +42,14 @@ from .frontend import frontend
 from .listing import generate_listing_model, populate_listing_cache
 from .listing import remove_listing_entry, update_listing_entry
 from .listing import remove_listing_entries, update_listing_entries
-from .listing import get_local_listing, set_remote_listing, serialize_listing_entry
+from .listing import get_local_listing, set_remote_listing, stream_listing_entries
+from .listing import DEFAULT_SORT, default_sort, page_listing_entries
 from .logrequest import logrequest
 from .model import db, Comment, File, Fileset, Jobrun, Jobfile, Storage, Tag, User
 
 from .registry import load_formats, load_jobs   # noqa
 from .serializer import fileset_detail, fileset_summary
+from .serializer import fileset_widget, fileset_widgets
 
 
 apimanager = flask.ext.restless.APIManager()
@@ -83,7 +85,12 @@ def create_app(config_obj, **kw):
     if app.config.get('USE_X_SENDFILE'):
         app.use_x_sendfile = True
 
-    app.config['SQLALCHEMY_BINDS'] = {'cache': 'sqlite://'}
+    # Listing cache shared by all processes of an instance, may also be
+    # the main database
+    app.config['SQLALCHEMY_BINDS'] = {
+        'cache': app.config.get('LISTING_CACHE_URI') or
+        'sqlite:///{path}/_listing_cache.sqlite'.format(path=app.instance_path)
+    }
 
     #if not os.path.exists(app.config['FILE_STORAGE_PATH']):
     #    os.makedirs(app.config['FILE_STORAGE_PATH'])
@@ -234,11 +241,43 @@ def create_app(config_obj, **kw):
 
     @app.route('/marv/api/_fileset-listing')
     def fileset_listing_route():
-        return flask.jsonify({
-            'sort': 'endtime',
-            'ascending': False,
-            'rows': [serialize_listing_entry(r) for r in filtered_fileset()]
-        })
+        args = flask.request.args
+        sort = args.get('sort')
+        ascending = args.get('ascending', 'false') == 'true'
+        columns = args.get('columns')
+        columns = columns.split(',') if columns else None
+        head = {'sort': sort or DEFAULT_SORT, 'ascending': ascending}
+        try:
+            offset = int(args.get('offset', 0))
+            limit = args.get('limit')
+            if limit is not None:
+                head.update(offset=offset, limit=int(limit))
+                # pages are cut in the order reported to the client
+                sort = head['sort'] = sort or default_sort()
+            entries = filtered_fileset()
+            if limit is not None:
+                head['total'] = entries.order_by(None).count()
+            entries = page_listing_entries(entries, sort, ascending, columns,
+                                           offset, head.get('limit'))
+        except ValueError:
+            return flask.abort(400)
+        return flask.Response(flask.stream_with_context(
+            stream_listing_entries(entries, columns, **head)),
+            mimetype='application/json')
+
+    @app.route('/marv/api/_fileset-widgets/<int:fileset_id>')
+    def fileset_widgets_route(fileset_id):
+        fileset = Fileset.query.get_or_404(fileset_id)
+        return flask.jsonify(fileset_widgets(fileset))
+
+    @app.route('/marv/api/_fileset-widgets/<int:fileset_id>/<key>')
+    def fileset_widget_route(fileset_id, key):
+        fileset = Fileset.query.get_or_404(fileset_id)
+        try:
+            widget = fileset_widget(fileset, key)
+        except KeyError:
+            return flask.abort(404)
+        return flask.jsonify({'widget': widget})
 
     @app.route('/marv/api/_fileset/<int:fileset_id>', methods=['DELETE'])
     @flask.ext.login.login_required
@@ -25,12 +25,14 @@ from __future__ import absolute_import, division
 import inspect
 import json
 import re
-from Queue import Queue
+import time
+from Queue import Empty, Full, Queue
 from itertools import tee
-from collections import namedtuple
-from threading import Thread
+from collections import OrderedDict, namedtuple
+from multiprocessing import Pipe, Process
+from threading import Condition, Event, Thread
 from .globals import _job_ctx_stack
-from .model import db, Jobrun
+from .model import db, Jobfile, Jobrun
 
 
 def multiplex(inputs, processors, logger=None, dont_catch=False):
@@ -94,15 +96,91 @@ class Failed(object):
 Failed = Failed()
 
 
+DEFAULT_QUEUE_SIZE = 100
+
+# Results of a job are inserted in batches of up to MILK_BATCH_SIZE,
+# at least every MILK_INTERVAL seconds
+MILK_BATCH_SIZE = 1000
+MILK_INTERVAL = 1.
+
+# Seconds between checks whether a job process finished early
+FEED_POLL = 0.1
+
+
+class MeteredQueue(Queue):
+    """Queue recording its peak depth and how long producers stalled"""
+    def __init__(self, maxsize=0):
+        Queue.__init__(self, maxsize)
+        self.peak = 0
+        self.stalls = 0
+        self.stalled = 0.
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self.peak = max(self.peak, len(self.queue))
+
+
+def put_message(async_job, msg, poll=0.1):
+    """Put msg into job's queue, blocking while the queue is full
+
+    Return False without putting msg if the job thread ended, as
+    nobody would consume it anymore.
+    """
+    queue = async_job.msg_queue
+    try:
+        queue.put(msg, block=False)
+        return True
+    except Full:
+        pass
+    queue.stalls += 1
+    start = time.time()
+    try:
+        while async_job.thread.is_alive():
+            try:
+                queue.put(msg, timeout=poll)
+                return True
+            except Full:
+                pass
+        return False
+    finally:
+        queue.stalled += time.time() - start
+
+
+class Slots(object):
+    """Semaphore acquiring several slots at once, all or none
+
+    Acquiring more slots than there are acquires all of them.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.free = size
+        self.cond = Condition()
+
+    def acquire(self, n):
+        """Block until n slots are free, return number acquired"""
+        n = min(n, self.size)
+        with self.cond:
+            while self.free < n:
+                self.cond.wait()
+            self.free -= n
+        return n
+
+    def release(self, n):
+        with self.cond:
+            self.free += n
+            self.cond.notify_all()
+
+
 class EffectiveConfig(object):
     def __init__(self, cfg):
         self.cfg = cfg
 
 
-def make_async_job(app, name, job, topics, group, version, config, fileset_id):
+def make_async_job(app, name, job, topics, group, version, config, fileset_id,
+                   queue_size=DEFAULT_QUEUE_SIZE):
     if config is None:
         config = {}
-    msg_queue = Queue()
+    msg_queue = MeteredQueue(queue_size)
     rv_queue = Queue()
 
     def messages():
@@ -144,32 +222,305 @@ def make_async_job(app, name, job, topics, group, version, config, fileset_id):
                     fileset_id=fileset_id, jobrun_id=jobrun.id)
 
 
-def async_job_milker(app, async_job):
+# Keep database connections and sessions inherited by forked job
+# processes referenced: closing them or rolling back would act on the
+# parent's connections.
+_inherited = []
+
+
+def _forget_inherited_db(app):
+    state = app.extensions['sqlalchemy']
+    _inherited.append((dict(state.connectors), dict(db.session.registry.registry)))
+    state.connectors.clear()
+    db.session.registry.registry.clear()
+
+
+def _job_process(app, resolve, conn):
+    """Run jobs received over conn until told to stop
+
+    Per job its spec, jobrun id and config are received, followed by
+    its messages, terminated by None. Results are sent back, followed
+    by ('done', None). Messages a job did not consume are drained.
+    """
+    with app.app_context():
+        _forget_inherited_db(app)
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            spec, jobrun_id, config = task
+            _run_process_job(app, resolve, spec, jobrun_id, config, conn)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+def _run_process_job(app, resolve, spec, jobrun_id, config, conn):
+    received = {'end': False}
+
+    with app.app_context():
+        try:
+            job, transform = resolve(spec)
+            transform = transform or (lambda x: x)
+
+            def messages():
+                while True:
+                    x = conn.recv()
+                    if x is None:
+                        received['end'] = True
+                        break
+                    yield transform(x)
+
+            cfg, rv_generator = \
+                job(jobrun_id=jobrun_id, messages=messages(), **config)
+            _job_ctx_stack.top.send_jobfile = lambda x: conn.send(('rv', x))
+            conn.send(('config', cfg))
+            for rv in rv_generator:
+                conn.send(('rv', rv))
+        except:
+            import traceback
+            traceback.print_exc()
+            conn.send(('failed', None))
+        finally:
+            _job_ctx_stack.pop()
+            conn.send(('done', None))
+            db.session.remove()
+
+    while not received['end']:
+        received['end'] = conn.recv() is None
+
+
+class JobProcessPool(object):
+    """Processes to run jobs in, forked before any threads are started
+
+    Forking while other threads run copies locks they might be holding
+    into the child, where nobody would ever release them. Create the
+    pool at command start; resolve is inherited by the processes and
+    turns the picklable spec given to make_process_job into the job to
+    run and the transform to apply to its messages (or None).
+    """
+    def __init__(self, app, size, resolve):
+        self.processes = []
+        self.idle = []
+        self.alive = size
+        self.cond = Condition()
+        for i in range(size):
+            conn, child_conn = Pipe()
+            process = Process(target=_job_process, name='job-process-{}'.format(i),
+                              args=(app, resolve, child_conn))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.idle.append(conn)
+
+    def acquire(self):
+        """Block until a process is idle, return connection to it"""
+        with self.cond:
+            while not self.idle:
+                if not self.alive:
+                    raise RuntimeError('All job processes died')
+                self.cond.wait()
+            return self.idle.pop(0)
+
+    def release(self, conn, broken=False):
+        """Return connection of process, broken ones are dropped"""
+        with self.cond:
+            if broken:
+                conn.close()
+                self.alive -= 1
+            else:
+                self.idle.append(conn)
+            self.cond.notify_all()
+
+    def close(self):
+        """Stop processes, to be called once all jobs are done"""
+        with self.cond:
+            for conn in self.idle:
+                try:
+                    conn.send(None)
+                except (EOFError, IOError):
+                    pass
+                conn.close()
+            self.idle = []
+            self.alive = 0
+            self.cond.notify_all()
+        for process in self.processes:
+            process.join()
+
+
+def make_process_job(pool, name, spec, topics, group, version, config, fileset_id,
+                     queue_size=DEFAULT_QUEUE_SIZE):
+    """Like make_async_job, but run job in a process of pool
+
+    The job and the transform applied to its messages, e.g. to
+    deserialize raw message data, are resolved from spec in the job
+    process. Messages are pickled to the process, model instances
+    created by the job, including jobfiles, are pickled back and
+    persisted by async_job_milker in this process. The returned
+    AsyncJob's thread feeds messages to the process.
+    """
+    if config is None:
+        config = {}
+    msg_queue = MeteredQueue(queue_size)
+    rv_queue = Queue()
+
+    jobrun = Jobrun(name=name, version=version, fileset_id=fileset_id)
+    db.session.add(jobrun)
+    db.session.commit()
+    while True:
+        conn = pool.acquire()
+        try:
+            conn.send((spec, jobrun.id, config))
+            break
+        except (EOFError, IOError):
+            pool.release(conn, broken=True)
+
+    # Set once the job is done, it might not consume all messages
+    finished = Event()
+    broken = []
+
+    def feed():
+        try:
+            while not finished.is_set():
+                try:
+                    x = msg_queue.get(timeout=FEED_POLL)
+                except Empty:
+                    continue
+                if x is Done:
+                    break
+                conn.send(x)
+            conn.send(None)
+        except (EOFError, IOError):
+            broken.append(True)  # process died, its receiver reports it
+        finally:
+            finished.wait()
+            pool.release(conn, broken=bool(broken))
+
+    def receive():
+        results = {'config': EffectiveConfig, 'rv': lambda x: x,
+                   'failed': lambda x: Failed}
+        try:
+            while True:
+                kind, x = conn.recv()
+                if kind == 'done':
+                    break
+                rv_queue.put(results[kind](x))
+        except (EOFError, IOError):
+            broken.append(True)
+            rv_queue.put(Failed)
+        finally:
+            rv_queue.put(Done)
+            finished.set()
+
+    thread = Thread(target=feed, name=name)
+    thread.daemon = True
+    thread.start()
+    receiver = Thread(target=receive, name='{}.receive'.format(name))
+    receiver.daemon = True
+    receiver.start()
+
+    return AsyncJob(thread=thread, msg_queue=msg_queue, topics=topics,
+                    rv_queue=rv_queue, name=name, version=version,
+                    fileset_id=fileset_id, jobrun_id=jobrun.id)
+
+
+def _bulk_insertable(instance):
+    """Whether instance has no relationships to persist besides its jobrun"""
+    state = db.inspect(instance)
+    return not any(x.key in state.dict for x in state.mapper.relationships
+                   if x.key != 'jobrun')
+
+
+def _flush_results(jobrun, instances):
+    """Insert instances yielded for jobrun, in bulk as far as possible"""
+    bulk = []
+    for instance in instances:
+        instance.jobrun_id = jobrun.id
+        if _bulk_insertable(instance):
+            bulk.append(instance)
+        else:
+            db.session.bulk_save_objects(bulk)
+            del bulk[:]
+            instance.jobrun = jobrun
+            db.session.add(instance)
+            db.session.flush()
+    db.session.bulk_save_objects(bulk)
+    del instances[:]
+
+
+def _save_series(jobrun, series):
+    """Store rows of series yielded for jobrun as jobfiles"""
+    for cls, rows in series.items():
+        cls.save(jobrun, rows)
+        db.session.add(Jobfile(name=cls.filename, jobrun=jobrun))
+    series.clear()
+
+
+def async_job_milker(app, async_job, batch_size=MILK_BATCH_SIZE,
+                     interval=MILK_INTERVAL):
+    """Persist results of async job and its outcome on its jobrun
+
+    Yielded model instances are buffered and inserted in bulk once
+    batch_size of them are pending or interval seconds passed since the
+    first one. Rows of series, see bb.job_array, are collected and
+    stored as one array each. The last batch and the series are
+    committed together with the jobrun being marked succeeded or failed
+    and cached widgets of the job being dropped.
+    """
+    from .arrays import Series
+    from .serializer import invalidate_widget_cache
     with app.app_context():
         db.create_all()
         jobrun = Jobrun.query.filter(Jobrun.id == async_job.jobrun_id).first()
+        pending = []
+        series = OrderedDict()
+        flush_at = None
         try:
             while True:
-                res = async_job.rv_queue.get()
+                try:
+                    timeout = None if flush_at is None else \
+                        max(0, flush_at - time.time())
+                    res = async_job.rv_queue.get(timeout=timeout)
+                except Empty:
+                    res = None
                 if isinstance(res, EffectiveConfig):
                     jobrun.config = json.dumps(res.cfg)
                     continue
+                if isinstance(res, Series):
+                    series.setdefault(type(res), []).append(res.values)
+                    continue
                 if res is Done:
+                    _flush_results(jobrun, pending)
+                    _save_series(jobrun, series)
                     jobrun.succeeded = True
+                    invalidate_widget_cache(jobrun)
                     db.session.commit()
                     break
                 if res is Failed:
+                    _flush_results(jobrun, pending)
+                    _save_series(jobrun, series)
                     jobrun.failed = True
+                    invalidate_widget_cache(jobrun)
                     db.session.commit()
                     break
-                instance = res
-                instance.jobrun = jobrun
-                db.session.add(instance)
-                db.session.commit()
+                if res is not None:
+                    pending.append(res)
+                    if flush_at is None:
+                        flush_at = time.time() + interval
+                if len(pending) >= batch_size or time.time() >= flush_at:
+                    _flush_results(jobrun, pending)
+                    db.session.commit()
+                    flush_at = None
         except:
             import traceback
             traceback.print_exc()  # noqa #pragma nocoverage
+            db.session.rollback()
+            jobrun = Jobrun.query.get(async_job.jobrun_id)
             jobrun.failed = True
+            invalidate_widget_cache(jobrun)
             db.session.commit()
         finally:
             db.session.remove()
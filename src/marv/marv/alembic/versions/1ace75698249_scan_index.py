@@ -0,0 +1,47 @@
+"""scan index
+
+Revision ID: 1ace75698249
+Revises: ffed5bb40d0
+Create Date: 2016-07-04 10:12:31.418207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1ace75698249'
+down_revision = 'ffed5bb40d0'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'scan_dir',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('path', sa.String(), nullable=False),
+        sa.Column('mtime', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_scan_dir_path'), 'scan_dir', ['path'], unique=True)
+    op.create_table(
+        'scan_file',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('dir_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=126), nullable=False),
+        sa.Column('inode', sa.BigInteger(), nullable=True),
+        sa.Column('size', sa.BigInteger(), nullable=True),
+        sa.Column('mtime', sa.Float(), nullable=True),
+        sa.Column('md5_mtime', sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(['dir_id'], ['scan_dir.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_scan_file_dir_id'), 'scan_file', ['dir_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_scan_file_dir_id'), table_name='scan_file')
+    op.drop_table('scan_file')
+    op.drop_index(op.f('ix_scan_dir_path'), table_name='scan_dir')
+    op.drop_table('scan_dir')
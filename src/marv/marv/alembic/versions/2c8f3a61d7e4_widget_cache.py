@@ -0,0 +1,40 @@
+"""widget cache
+
+Revision ID: 2c8f3a61d7e4
+Revises: 4b1d0e5c9a27
+Create Date: 2016-07-18 11:03:47.213580
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2c8f3a61d7e4'
+down_revision = '4b1d0e5c9a27'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'widget_cache',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('fileset_id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.String(length=126), nullable=False),
+        sa.Column('job', sa.String(length=126), nullable=False),
+        sa.Column('jobrun_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.String(length=14), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(['fileset_id'], ['fileset.id'], ),
+        sa.ForeignKeyConstraint(['jobrun_id'], ['jobrun.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('fileset_id', 'key')
+    )
+    op.create_index(op.f('ix_widget_cache_job'), 'widget_cache', ['job'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_widget_cache_job'), table_name='widget_cache')
+    op.drop_table('widget_cache')
@@ -0,0 +1,45 @@
+"""job queue
+
+Revision ID: 4b1d0e5c9a27
+Revises: 1ace75698249
+Create Date: 2016-07-11 14:22:05.604911
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1d0e5c9a27'
+down_revision = '1ace75698249'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'job_queue_item',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('fileset_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=126), nullable=False),
+        sa.Column('version', sa.String(length=14), nullable=False),
+        sa.Column('state', sa.String(length=8), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('max_attempts', sa.Integer(), nullable=False),
+        sa.Column('lease_owner', sa.String(length=126), nullable=True),
+        sa.Column('lease_expires', sa.TIMESTAMP(), nullable=True),
+        sa.Column('jobrun_id', sa.Integer(), nullable=True),
+        sa.Column('time_added', sa.TIMESTAMP(), nullable=False),
+        sa.Column('time_updated', sa.TIMESTAMP(), nullable=False),
+        sa.ForeignKeyConstraint(['fileset_id'], ['fileset.id'], ),
+        sa.ForeignKeyConstraint(['jobrun_id'], ['jobrun.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('fileset_id', 'name', 'version')
+    )
+    op.create_index(op.f('ix_job_queue_item_state'), 'job_queue_item', ['state'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_job_queue_item_state'), table_name='job_queue_item')
+    op.drop_table('job_queue_item')
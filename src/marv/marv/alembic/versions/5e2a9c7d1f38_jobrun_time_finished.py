@@ -0,0 +1,28 @@
+"""jobrun time finished
+
+Revision ID: 5e2a9c7d1f38
+Revises: 2c8f3a61d7e4
+Create Date: 2016-07-25 10:41:12.308264
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e2a9c7d1f38'
+down_revision = '2c8f3a61d7e4'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('jobrun', sa.Column('time_finished', sa.TIMESTAMP(), nullable=True))
+    op.create_index(op.f('ix_jobrun_time_finished'), 'jobrun', ['time_finished'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_jobrun_time_finished'), table_name='jobrun')
+    with op.batch_alter_table('jobrun') as batch_op:
+        batch_op.drop_column('time_finished')
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""Columnar storage of numeric series yielded by jobs
+
+Rows of a series class, see bb.job_array, yielded by a job are
+collected by async_job_milker and stored as one structured array per
+jobrun in a .npy jobfile, instead of one database row each. Series
+are read back as memory-mapped NumPy arrays, e.g.::
+
+    samples = Trajectory.load(jobrun)
+    samples['x'].max()
+
+NumPy is only needed to store and load series.
+"""
+
+from __future__ import absolute_import, division
+
+import itertools
+import os
+from .job import jobfile_dir
+
+
+_counter = itertools.count()
+
+
+class ArrayColumn(object):
+    """Field of a series with NumPy dtype, e.g. 'f8' or 'i4'"""
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.order = next(_counter)
+
+
+class Series(object):
+    """Row of a series, columns are set by bb.job_array"""
+    __slots__ = ('values',)
+    columns = ()
+    filename = None
+
+    def __init__(self, **kw):
+        try:
+            self.values = tuple(kw.pop(name) for name, _ in self.columns)
+        except KeyError as e:
+            raise TypeError('Missing value for column {}'.format(e))
+        if kw:
+            raise TypeError('Unknown columns {}'.format(', '.join(sorted(kw))))
+
+    def __getstate__(self):
+        return self.values
+
+    def __setstate__(self, values):
+        self.values = values
+
+    @classmethod
+    def dtype(cls):
+        import numpy
+        return numpy.dtype([(name, dtype) for name, dtype in cls.columns])
+
+    @classmethod
+    def path(cls, jobrun):
+        group, name = jobrun.name.split('::')
+        return os.path.join(jobfile_dir(group, name, jobrun.id), cls.filename)
+
+    @classmethod
+    def save(cls, jobrun, rows):
+        """Store row values of jobrun, return path of created file"""
+        import numpy
+        path = cls.path(jobrun)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        numpy.save(path, numpy.array(rows, dtype=cls.dtype()))
+        return path
+
+    @classmethod
+    def load(cls, jobrun, mmap_mode='r'):
+        """Return structured array of jobrun's series or None if there is none"""
+        import numpy
+        path = cls.path(jobrun)
+        if not os.path.exists(path):
+            return None
+        return numpy.load(path, mmap_mode=mmap_mode)
@@ -23,7 +23,9 @@
 from __future__ import absolute_import, division
 
 from .decorators import fileset, job_model               # noqa
+from .decorators import job_array  # noqa
 from .decorators import summary, detail      # noqa
+from .serializer import has_jobfiles  # noqa
 from .decorators import table_widget, text_widget, image_widget   # noqa
 from .decorators import gallery_widget  # noqa
 from .decorators import osm_widget  # noqa
@@ -36,4 +38,5 @@ from .registry import job, reader, scanner, listing  # noqa
 from .globals import job_logger  # noqa
 
 from .model import db  # noqa
+from .arrays import ArrayColumn as array_column  # noqa
 from .job import make_job_file  # noqa
@@ -26,13 +26,14 @@ import inspect
 import re
 from flask.ext.sqlalchemy import _BoundDeclarativeMeta as model_metaclass
 
+from .arrays import ArrayColumn, Series
 from .job import MODELS
 from .model import db
 from .filtering import FILTER, Filter, FilterInput
 from .listing import ListingColumn
 from .registry import MODULE_NAME_MAP
 from .serializer import Detail, Summary
-from .serializer import DETAIL, SUMMARY
+from .serializer import SUMMARY, register_detail
 from .widget import Column, Image, Gallery, OSM, Row, Text, Table, Widget
 
 
@@ -104,6 +105,33 @@ def job_model():
     return decorator
 
 
+def job_array():
+    """Turn class with ArrayColumns into a series stored as .npy jobfile"""
+    def decorator(cls):
+        name = cls.__name__
+        package, jobname = cls.__module__.rsplit('.', 1)
+        group = MODULE_NAME_MAP['job'][package]
+        filename = '__'.join([
+            group,
+            jobname,
+            re.sub('([A-Z])', lambda x: '_{}'.format(x.group(1).lower()), name)[1:]
+        ]) + '.npy'
+        columns = sorted(((k, v) for k, v in cls.__dict__.items()
+                          if isinstance(v, ArrayColumn)),
+                         key=lambda x: x[1].order)
+        class_dict = {
+            '__doc__': cls.__doc__,
+            '__module__': cls.__module__,
+            '__slots__': (),
+            'columns': tuple((k, v.dtype) for k, v in columns),
+            'filename': filename,
+        }
+        class_dict.update((k, v) for k, v in cls.__dict__.items()
+                          if k[0] != '_' and not isinstance(v, ArrayColumn))
+        return type(name, (Series,), class_dict)
+    return decorator
+
+
 #
 # register callbacks/widgets for specific views
 #
@@ -112,7 +140,7 @@ def detail(namespace=None, name=None, cls=Detail, **kw):
     """Register widget as detail serializer"""
     def decorator(widget):
         serializer = cls(namespace, name, widget, **kw)
-        DETAIL.append(serializer)
+        register_detail(serializer)
         return serializer
     return decorator
 
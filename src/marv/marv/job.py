@@ -35,15 +35,23 @@ from .widgeting import ParameterBase, WidgetBase
 MODELS = []
 
 
+def jobfile_dir(group, name, jobrun_id):
+    """Return directory of jobfiles of a jobrun"""
+    return os.path.join(current_app.instance_path,
+                        'jobruns', group, name, str(jobrun_id))
+
+
 class JobContext(object):
+    # set in job processes to send jobfiles for persistence
+    send_jobfile = None
+
     def __init__(self, jobrun_id, group, name):
         logger_name = '{}.{}.{}'.format(__name__, group, name)
         self.jobrun_id = jobrun_id
         self.group = group
         self.name = name
         self.logger = logging.getLogger(logger_name)
-        self.jobfile_dir = os.path.join(current_app.instance_path,
-                                        'jobruns', group, name, str(jobrun_id))
+        self.jobfile_dir = jobfile_dir(group, name, jobrun_id)
         os.makedirs(self.jobfile_dir)
 
 
@@ -93,11 +101,14 @@ def make_job_file(name):
     """Create a file associated with the current job"""
     # associate with jobrun
     jobctx = _job_ctx_stack.top
-    jobrun = Jobrun.query.filter(Jobrun.id == jobctx.jobrun_id).first()
-    jobfile = Jobfile(name=name, jobrun=jobrun)
     path = os.path.join(jobctx.jobfile_dir, name)
     assert not os.path.exists(path)  # just a precaution, not a race-safe check
     open(path, 'w').close()
+    if jobctx.send_jobfile is not None:
+        jobctx.send_jobfile(Jobfile(name=name))
+        return path
+    jobrun = Jobrun.query.filter(Jobrun.id == jobctx.jobrun_id).first()
+    jobfile = Jobfile(name=name, jobrun=jobrun)
     db.session.add(jobfile)
     db.session.commit()
     return path
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Job queue stored in the database
+
+Items are claimed by workers with conditional updates, so any number
+of workers on any number of hosts may share a queue, also with SQLite.
+A claimed item is leased to its worker until the lease expires; the
+worker renews it while running the job. Items of crashed workers are
+claimed again once their lease expired; failed items are retried
+until max_attempts.
+"""
+
+from __future__ import absolute_import, division
+
+import os
+import socket
+from datetime import datetime, timedelta
+from .model import db, JobQueueItem as Item
+
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LEASE = 300
+DEFAULT_MAX_ATTEMPTS = 3
+IN_CHUNK_SIZE = 500
+
+
+def default_owner():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def enqueue(items, max_attempts=DEFAULT_MAX_ATTEMPTS, reset=False):
+    """Queue (fileset_id, name, version) items, return number queued
+
+    Items queued before are skipped, or with reset, pending again
+    unless currently leased.
+    """
+    items = set(items)
+    now = datetime.utcnow()
+    existing = {}
+    fileset_ids = sorted({x[0] for x in items})
+    for i in range(0, len(fileset_ids), IN_CHUNK_SIZE):
+        chunk = fileset_ids[i:i + IN_CHUNK_SIZE]
+        query = db.session.query(Item.id, Item.fileset_id, Item.name, Item.version,
+                                 Item.state)\
+                          .filter(Item.fileset_id.in_(chunk))
+        for id, fileset_id, name, version, state in query:
+            existing[fileset_id, name, version] = id, state
+
+    new = [dict(fileset_id=fileset_id, name=name, version=version, state=PENDING,
+                attempts=0, max_attempts=max_attempts,
+                time_added=now, time_updated=now)
+           for fileset_id, name, version in sorted(items)
+           if (fileset_id, name, version) not in existing]
+    if new:
+        db.session.execute(Item.__table__.insert(), new)
+
+    requeue = [id for key, (id, state) in existing.items()
+               if reset and key in items and state in (DONE, FAILED)]
+    for i in range(0, len(requeue), IN_CHUNK_SIZE):
+        Item.query.filter(Item.id.in_(requeue[i:i + IN_CHUNK_SIZE]))\
+                  .filter(Item.state.in_((DONE, FAILED)))\
+                  .update({Item.state: PENDING, Item.attempts: 0,
+                           Item.max_attempts: max_attempts, Item.jobrun_id: None,
+                           Item.time_updated: now}, synchronize_session=False)
+    db.session.commit()
+    return len(new) + len(requeue)
+
+
+def _claimable(now):
+    return (Item.attempts < Item.max_attempts) & (
+        (Item.state == PENDING) |
+        ((Item.state == LEASED) & (Item.lease_expires < now)))
+
+
+def claim(owner, lease=DEFAULT_LEASE):
+    """Lease claimable items of one fileset to owner and return them
+
+    The fileset is the one of the oldest claimable item. Items are
+    claimed one by one with a conditional update; those claimed by
+    others in the meantime are skipped.
+    """
+    while True:
+        now = datetime.utcnow()
+        # expired leases without attempts left
+        Item.query.filter(Item.state == LEASED, Item.lease_expires < now,
+                          Item.attempts >= Item.max_attempts)\
+                  .update({Item.state: FAILED, Item.lease_owner: None,
+                           Item.lease_expires: None, Item.time_updated: now},
+                          synchronize_session=False)
+        db.session.commit()
+
+        first = Item.query.filter(_claimable(now)).order_by(Item.id).first()
+        if first is None:
+            return []
+        ids = [id for id, in db.session.query(Item.id)
+               .filter(Item.fileset_id == first.fileset_id)
+               .filter(_claimable(now))
+               .order_by(Item.id)]
+        claimed = []
+        expires = now + timedelta(seconds=lease)
+        for id in ids:
+            count = Item.query.filter(Item.id == id, _claimable(now))\
+                              .update({Item.state: LEASED,
+                                       Item.lease_owner: owner,
+                                       Item.lease_expires: expires,
+                                       Item.attempts: Item.attempts + 1,
+                                       Item.time_updated: now},
+                                      synchronize_session=False)
+            db.session.commit()
+            if count:
+                claimed.append(id)
+        if claimed:
+            return Item.query.filter(Item.id.in_(claimed)).order_by(Item.id).all()
+
+
+def heartbeat(ids, owner, lease=DEFAULT_LEASE):
+    """Renew lease of owner's items, return number of items still leased"""
+    now = datetime.utcnow()
+    count = Item.query.filter(Item.id.in_(ids), Item.state == LEASED,
+                              Item.lease_owner == owner)\
+                      .update({Item.lease_expires: now + timedelta(seconds=lease),
+                               Item.time_updated: now},
+                              synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def complete(id, owner, succeeded, jobrun_id=None, retry=True):
+    """Finish owner's item, failed ones are pending again while attempts left
+
+    Without retry failed items are not pending again, e.g. for jobs
+    that are not known. Return whether owner still held the lease.
+    """
+    now = datetime.utcnow()
+    if succeeded:
+        state = DONE
+    elif not retry:
+        state = FAILED
+    else:
+        state = db.case([(Item.attempts < Item.max_attempts, PENDING)], else_=FAILED)
+    count = Item.query.filter(Item.id == id, Item.state == LEASED,
+                              Item.lease_owner == owner)\
+                      .update({Item.state: state, Item.jobrun_id: jobrun_id,
+                               Item.lease_owner: None, Item.lease_expires: None,
+                               Item.time_updated: now},
+                              synchronize_session=False)
+    db.session.commit()
+    return bool(count)
+
+
+def release(ids, owner):
+    """Return owner's items to the queue without counting the attempt"""
+    now = datetime.utcnow()
+    Item.query.filter(Item.id.in_(ids), Item.state == LEASED,
+                      Item.lease_owner == owner)\
+              .update({Item.state: PENDING, Item.attempts: Item.attempts - 1,
+                       Item.lease_owner: None, Item.lease_expires: None,
+                       Item.time_updated: now},
+                      synchronize_session=False)
+    db.session.commit()
@@ -22,22 +22,45 @@
 
 from __future__ import absolute_import, division
 
+import fcntl
+import hashlib
 import json
 import os
 import re
 import requests
+import sys
 from collections import OrderedDict
 from flask import current_app as app
 from flask.ext.sqlalchemy import _BoundDeclarativeMeta as model_metaclass, inspect
-from .model import db, Fileset
+from sqlalchemy.orm import load_only, subqueryload, subqueryload_all
+from .model import db, Fileset, Jobrun
 from ._utils import title_from_name
 
 
 LISTING_CALLBACKS = OrderedDict()
+LISTING_SCHEMA = 2  # bump on changes to how entries are stored
+LISTING_BATCH_SIZE = 500
+LISTING_STATE_ID = 1
 ListingEntry = None
 Relations = {}
 
 
+class ListingCacheOutdated(Exception):
+    """Listing cache needs to be rebuilt, see sync_listing_cache"""
+
+
+class ListingState(db.Model):
+    """Version and high-water marks of the persistent listing cache
+
+    There is only one row, with id LISTING_STATE_ID.
+    """
+    __bind_key__ = 'cache'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.String(40), nullable=False)
+    fileset_mark = db.Column(db.TIMESTAMP)  # latest fileset update/read, jobrun finish
+    jobrun_mark = db.Column(db.Integer)  # first jobrun id not yet seen
+
+
 def related_model(name):
     return Relations[name]
 
@@ -48,7 +71,8 @@ def related_field(name):
 
 class ListingColumn(object):
     def __init__(self, name, title=None, formatter='string',
-                 type=db.String, json=False, hidden=False, relation=False, list=False):
+                 type=db.String, json=False, hidden=False, relation=False, list=False,
+                 sortable=None):
         self.name = name
         self.title = title \
             if title is not None \
@@ -60,6 +84,7 @@ class ListingColumn(object):
         self.hidden = hidden
         self.relation = relation
         self.list = list
+        self.sortable = not (json or relation) if sortable is None else sortable
 
 
 class ListingCallback(object):
@@ -73,8 +98,9 @@ class ListingCallback(object):
             if self.namespace else self.name
 
     def __init__(self, name, callback, params, namespace=None,
-                 help=None, title=None, type=None):
+                 help=None, title=None, type=None, load=()):
         self.name = name or 'foo'
+        self.load = tuple(load)  # relationship paths from Fileset used by callback
         self.namespace = namespace
         self.help = help
         self.type = type \
@@ -113,7 +139,7 @@ def generate_listing_model():
                 assert col.name not in Relations
                 relcols.append(col)
             else:
-                class_dict[col.name] = db.Column(col.type)
+                class_dict[col.name] = db.Column(col.type, index=col.sortable)
     ListingEntry = model_metaclass(name, bases, class_dict)
     for col in relcols:
         Relations[col.name] = generate_relation_model(col)
@@ -133,14 +159,14 @@ def generate_relation_model(col):
             ListingEntry, uselist=False,
             backref=db.backref(col.name,
                                cascade='save-update, delete, delete-orphan, merge')),
-        'listing_entry_id': db.Column(db.Integer, db.ForeignKey('listing_entry.id')),
+        'listing_entry_id': db.Column(db.String, db.ForeignKey('listing_entry.id')),
         'value': db.Column(col.type),
     }
     Relation = model_metaclass(name, bases, class_dict)
     return Relation
 
 
-def add_listing_entry(fileset):
+def make_listing_entry(fileset):
     entry_dict = {'id': fileset.md5,  # same md5 from remotes is ignored
                   'remote': None,
                   'fileset_id': fileset.id,  # not unique within listing
@@ -158,16 +184,65 @@ def add_listing_entry(fileset):
                 Relation = Relations[col.name]
                 value = [Relation(value=x) for x in value]
             entry_dict[col.name] = value
-    entry = ListingEntry(**entry_dict)
-    db.session.add(entry)
+    return ListingEntry(**entry_dict)
+
+
+def add_listing_entry(fileset):
+    db.session.add(make_listing_entry(fileset))
     db.session.flush()
 
 
+def listing_load_options():
+    """Eager loads of relationships listing callbacks declared to use"""
+    paths = sorted(set(path for callback in LISTING_CALLBACKS.values()
+                       for path in callback.load))
+    return [subqueryload_all(path) for path in paths]
+
+
+def add_listing_entries(filesets, batch_size=LISTING_BATCH_SIZE):
+    """Add listing entries for query of filesets in batches
+
+    The relationships declared by listing callbacks are loaded for a
+    whole batch at once, as are latest jobruns, resulting in a fixed
+    number of queries per batch instead of several per fileset.
+    """
+    ids = [x.id for x in filesets.with_entities(Fileset.id).order_by(Fileset.id)]
+    options = listing_load_options()
+    for start in range(0, len(ids), batch_size):
+        batch = Fileset.query.filter(Fileset.id.in_(ids[start:start + batch_size]))\
+                             .options(subqueryload('jobruns'), *options)\
+                             .all()
+        for fileset in batch:
+            fileset.prime_latest_jobruns()
+            db.session.add(make_listing_entry(fileset))
+        db.session.commit()
+        for fileset in batch:
+            del fileset._latest_jobruns
+
+
+def delete_listing_entries(ids=None, synchronize_session=False):
+    """Delete listing entries by id, all if ids is None
+
+    Bulk deletes skip the cascade to relation tables, their rows are
+    deleted explicitly; left behind they would attach to new entries
+    with the same id.
+    """
+    for Relation in Relations.values():
+        query = Relation.query
+        if ids is not None:
+            query = query.filter(Relation.listing_entry_id.in_(ids))
+        query.delete(synchronize_session=False)
+    query = ListingEntry.query
+    if ids is not None:
+        query = query.filter(ListingEntry.id.in_(ids))
+    query.delete(synchronize_session=synchronize_session)
+
+
 def remove_listing_entry(fileset=None, fileset_id=None):
     assert fileset is not None or fileset_id is not None
     if fileset is None:
         fileset = Fileset.query.filter_by(id=fileset_id).first()
-    ListingEntry.query.filter(ListingEntry.id == fileset.md5).delete()
+    delete_listing_entries([fileset.md5], synchronize_session='fetch')
     db.session.commit()
 
 
@@ -181,9 +256,16 @@ def update_listing_entry(fileset=None, fileset_id=None):
     db.session.commit()
 
 
-def update_listing_entries(ids):
-    for id in ids:
-        update_listing_entry(fileset_id=id)
+def update_listing_entries(ids, batch_size=LISTING_BATCH_SIZE):
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        md5s = [x.md5 for x in db.session.query(Fileset.md5)
+                .filter(Fileset.id.in_(batch))]
+        if md5s:
+            delete_listing_entries(md5s)
+        add_listing_entries(Fileset.query.filter(Fileset.id.in_(batch))
+                                         .filter(Fileset.deleted.isnot(True)))
+    db.session.commit()
 
 
 def remove_listing_entries(ids):
@@ -217,22 +299,109 @@ def trigger_remove_listing_entries(ids):
         pass
 
 
+def listed_filesets():
+    return Fileset.query.filter(Fileset.type == 'bag')\
+                        .filter(Fileset.deleted.isnot(True))
+
+
 def populate_listing_cache():
     # Delete all existing
-    ListingEntry.query.delete()
+    delete_listing_entries()
 
     # Load ours
-    for fileset in Fileset.query.filter(Fileset.type == 'bag')\
-                                .filter(Fileset.deleted.isnot(True)):
-        add_listing_entry(fileset)
-    db.session.commit()
+    add_listing_entries(listed_filesets())
 
     # Add remotes
     remotepath = os.path.join(app.instance_path, '.marv', 'remotes')
-    for name in os.listdir(remotepath):
+    for name in os.listdir(remotepath) if os.path.isdir(remotepath) else ():
         load_remote_listing(name)
 
 
+def listing_version():
+    """Hash of cache layout and listing callbacks with their versions"""
+    sha = hashlib.sha1(str(LISTING_SCHEMA))
+    for key, callback in LISTING_CALLBACKS.items():
+        module = sys.modules.get(callback.callback.__module__)
+        sha.update(repr((key, getattr(module, '__version__', None))))
+        for col in callback.columns:
+            sha.update(repr((col.name, getattr(col.type, '__name__', col.type),
+                             col.json, col.relation, col.sortable)))
+    return sha.hexdigest()
+
+
+def _listing_marks():
+    updated, read = db.session.query(db.func.max(Fileset.time_updated),
+                                     db.func.max(Fileset.time_read)).one()
+    last_id, finished = db.session.query(db.func.max(Jobrun.id),
+                                         db.func.max(Jobrun.time_finished)).one()
+    times = [x for x in (updated, read, finished) if x is not None]
+    fileset_mark = max(times) if times else None
+    return fileset_mark, (last_id or 0) + 1
+
+
+def sync_listing_cache(rebuild=True):
+    """Bring persistent listing cache up to date
+
+    The cache is rebuilt if it is empty or was built for other listing
+    callbacks or versions of them, see listing_version. Otherwise only
+    entries of filesets updated, read or with jobruns started or finished
+    since the last sync are updated, and entries of filesets no longer
+    listed removed. Returns number of entries updated or removed.
+
+    Processes of an instance sync one at a time, holding an exclusive
+    lock on _listing_cache.lock in the instance path. Unless rebuild is
+    true, ListingCacheOutdated is raised instead of rebuilding the
+    cache, which other processes might be serving from meanwhile.
+    """
+    path = os.path.join(app.instance_path, '_listing_cache.lock')
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # released on close
+        return _sync_listing_cache(rebuild)
+
+
+def _sync_listing_cache(rebuild):
+    version = listing_version()
+    state = ListingState.query.get(LISTING_STATE_ID)
+    fileset_mark, jobrun_mark = _listing_marks()
+    if state is None or state.version != version:
+        if not rebuild:
+            raise ListingCacheOutdated('Listing cache needs to be rebuilt, '
+                                       'run: bagbunker admin sync-listing')
+        db.session.commit()
+        if state is not None:
+            db.session.expunge(state)  # its row is dropped with the tables
+        db.drop_all(bind='cache')
+        db.create_all(bind='cache')
+        populate_listing_cache()
+        db.session.add(ListingState(id=LISTING_STATE_ID, version=version,
+                                    fileset_mark=fileset_mark,
+                                    jobrun_mark=jobrun_mark))
+        db.session.commit()
+        return ListingEntry.query.count()
+
+    changed = set(x.fileset_id for x in db.session.query(Jobrun.fileset_id)
+                  .filter(Jobrun.id >= state.jobrun_mark).distinct())
+    if state.fileset_mark is None:
+        changed.update(x.id for x in db.session.query(Fileset.id))
+    else:
+        changed.update(x.id for x in db.session.query(Fileset.id).filter(
+            (Fileset.time_updated >= state.fileset_mark) |
+            (Fileset.time_read >= state.fileset_mark)))
+        changed.update(x.fileset_id for x in db.session.query(Jobrun.fileset_id)
+                       .filter(Jobrun.time_finished >= state.fileset_mark)
+                       .distinct())
+    listed = set(x.id for x in listed_filesets().with_entities(Fileset.id))
+    entries = db.session.query(ListingEntry.fileset_id)\
+                        .filter(ListingEntry.remote.is_(None))
+    gone = set(x.fileset_id for x in entries) - listed
+    update_listing_entries(sorted(changed & listed))
+    remove_listing_entries(sorted(gone))
+    state.fileset_mark = fileset_mark
+    state.jobrun_mark = jobrun_mark
+    db.session.commit()
+    return len(changed & listed) + len(gone)
+
+
 def serialize_listing_entry(entry):
     columns = [{
         'formatter': 'icon',
@@ -265,6 +434,110 @@ def serialize_listing_entry(entry):
     }
 
 
+LISTING_CHUNK_SIZE = 1000
+
+# Listings are sorted by this column unless requested otherwise
+DEFAULT_SORT = 'endtime'
+
+
+def _location_column(remote):
+    return json.dumps({
+        'formatter': 'icon',
+        'name': 'Location',
+        'title': '',
+        'value': {
+            'icon': 'hdd',
+            'title': 'Location: {}'.format(remote or 'local'),
+            'classes': 'text-warning' if remote else 'text-success'
+        }
+    })
+
+
+def listing_columns(names=None):
+    """Visible listing columns, restricted to names if given"""
+    columns = [col for callback in LISTING_CALLBACKS.values()
+               for col in callback.columns if not col.hidden]
+    if names is None:
+        return columns
+    unknown = set(names) - {col.name for col in columns}
+    if unknown:
+        raise ValueError('Unknown columns: {}'.format(', '.join(sorted(unknown))))
+    return [col for col in columns if col.name in names]
+
+
+def default_sort():
+    """DEFAULT_SORT if it is a sortable column, None otherwise"""
+    return DEFAULT_SORT if any(x.name == DEFAULT_SORT and x.sortable
+                               for x in listing_columns()) else None
+
+
+def page_listing_entries(entries, sort=None, ascending=False, columns=None,
+                         offset=0, limit=None):
+    """Sort, project and page query of listing entries in the database
+
+    Entries are ordered by sort column, ties broken by md5, which also
+    orders entries if there is no sort column. Only the given visible
+    columns are loaded. Raise ValueError for invalid arguments.
+    """
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError('Negative offset or limit')
+    if sort is not None:
+        col = {x.name: x for x in listing_columns()}.get(sort)
+        if col is None or not col.sortable:
+            raise ValueError('Cannot sort by {}'.format(sort))
+        order = getattr(ListingEntry, sort)
+        entries = entries.order_by(order.asc() if ascending else order.desc())
+    entries = entries.order_by(ListingEntry.id)
+    if columns is not None:
+        names = [x.name for x in listing_columns(columns)]
+        entries = entries.options(load_only(
+            'id', 'remote', 'fileset_id', 'storage_id', 'type', *names))
+    if offset:
+        entries = entries.offset(offset)
+    if limit is not None:
+        entries = entries.limit(limit)
+    return entries
+
+
+def stream_listing_entries(entries, columns=None, **head):
+    """Yield JSON of listing response in fragments, like serialize_listing_entry
+
+    The response's rows are preceded by the fields in head and restricted
+    to the given columns plus location. Entries are fetched in chunks
+    from a server-side cursor where the database supports it. Values of
+    json columns are stored serialised and spliced in as they are, for
+    other columns only the value is encoded per entry.
+    """
+    fields = []
+    for col in listing_columns(columns):
+        prefix = json.dumps({
+            'formatter': col.formatter,
+            'name': col.name,
+            'list': col.list,
+            'title': col.title,
+        })
+        fields.append((col.name, col.json, prefix[:-1] + ', "value": '))
+    locations = {}
+
+    yield json.dumps(head)[:-1] + (', ' if head else '') + '"rows": ['
+    sep = ''
+    for entry in entries.yield_per(LISTING_CHUNK_SIZE):
+        location = locations.get(entry.remote)
+        if location is None:
+            location = locations[entry.remote] = _location_column(entry.remote)
+        fragments = [location]
+        for name, is_json, prefix in fields:
+            value = getattr(entry, name)
+            if not is_json or value is None:
+                value = json.dumps(value)
+            fragments.append(prefix + value + '}')
+        yield '{}{{"id": {}, "type": {}, "storage_id": {}, "columns": [{}]}}'.format(
+            sep, json.dumps(entry.fileset_id), json.dumps(entry.type),
+            json.dumps(entry.storage_id), ', '.join(fragments))
+        sep = ', '
+    yield ']}'
+
+
 def get_local_listing():
     entries = ListingEntry.query.filter(ListingEntry.remote.is_(None))
     results = {}
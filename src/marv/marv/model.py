@@ -23,8 +23,10 @@
 from __future__ import absolute_import, division
 
 import os
+import flask
 import flask.ext.sqlalchemy
 from datetime import datetime
+from sqlalchemy import event
 
 
 db = flask.ext.sqlalchemy.SQLAlchemy()
@@ -83,20 +85,46 @@ class Fileset(db.Model):
     @property
     def failed_job_names(self):
         # check latest jobruns for failed flag and list them
-        jobs = {}
-        for jobrun in self.jobruns:
-            if jobrun.id > jobs.setdefault(jobrun.name, jobrun).id:
-                jobs[jobrun.name] = jobrun
+        return sorted(name for name, jobrun in self.latest_jobruns.items()
+                      if jobrun.failed)
 
-        return [name for name in sorted(
-            job.name for job in jobs.values() if job.failed)]
+    @property
+    def latest_jobruns(self):
+        """Latest jobrun by job name
+
+        Loaded with one query and, within a request, once per fileset;
+        detail widgets of many jobs look up their jobrun in it.
+        """
+        primed = self.__dict__.get('_latest_jobruns')
+        if primed is not None:
+            return primed
+        ctx = flask._request_ctx_stack.top
+        if ctx is None:
+            return self._query_latest_jobruns()
+        cache = ctx.__dict__.setdefault('marv_latest_jobruns', {})
+        if self.id not in cache:
+            cache[self.id] = self._query_latest_jobruns()
+        return cache[self.id]
+
+    def _query_latest_jobruns(self):
+        latest = db.session.query(db.func.max(Jobrun.id))\
+                           .filter(Jobrun.fileset_id == self.id)\
+                           .group_by(Jobrun.name)
+        return {x.name: x for x in Jobrun.query.filter(Jobrun.id.in_(latest))}
+
+    def prime_latest_jobruns(self):
+        """Derive latest jobruns from loaded jobruns instead of querying
+
+        Used by bulk listing, which eager loads jobruns of many filesets.
+        """
+        latest = {}
+        for jobrun in self.jobruns:
+            if jobrun.name not in latest or jobrun.id > latest[jobrun.name].id:
+                latest[jobrun.name] = jobrun
+        self._latest_jobruns = latest
 
-    # XXX: latest_jobrun like current_app
     def get_latest_jobrun(self, name):
-        jobrun = Jobrun.query.filter(Jobrun.fileset_id == self.id)\
-                             .filter(Jobrun.name == name) \
-                             .order_by(Jobrun.id.desc()).first()
-        return jobrun
+        return self.latest_jobruns.get(name)
 
 
 class File(db.Model):
@@ -121,6 +149,25 @@ class File(db.Model):
             self.name, self.md5, self.size)
 
 
+class ScanDir(db.Model):
+    """Directory as seen by the last indexed scan"""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String, unique=True, index=True, nullable=False)
+    mtime = db.Column(db.Float)  # None forces a rescan
+
+
+class ScanFile(db.Model):
+    """Stat of a fileset file and its md5 file as seen by the last indexed scan"""
+    id = db.Column(db.Integer, primary_key=True)
+    dir_id = db.Column(db.Integer, db.ForeignKey('scan_dir.id'), index=True,
+                       nullable=False)
+    name = db.Column(db.String(126), nullable=False)
+    inode = db.Column(db.BigInteger)
+    size = db.Column(db.BigInteger)
+    mtime = db.Column(db.Float)
+    md5_mtime = db.Column(db.Float)
+
+
 fileset_tags = db.Table(
     'fileset_tags',
     db.Column('fileset_id', db.Integer, db.ForeignKey('fileset.id'), nullable=False),
@@ -174,6 +221,14 @@ class Jobrun(db.Model):
     config = db.Column(db.String)  # json serialised job config
     failed = db.Column(db.Boolean)
     succeeded = db.Column(db.Boolean)
+    time_finished = db.Column(db.TIMESTAMP, index=True)
+
+
+@event.listens_for(Jobrun.failed, 'set')
+@event.listens_for(Jobrun.succeeded, 'set')
+def _jobrun_finished(target, value, oldvalue, initiator):
+    if value and target.time_finished is None:
+        target.time_finished = datetime.utcnow()
 
 
 class Jobfile(db.Model):
@@ -183,6 +238,51 @@ class Jobfile(db.Model):
     jobrun_id = db.Column(db.Integer, db.ForeignKey('jobrun.id'), nullable=False)
 
 
+class JobQueueItem(db.Model):
+    """Job to be run for a fileset by a worker
+
+    Workers lease items and renew the lease while running them; items
+    whose lease expired are claimed again, failed ones are retried
+    until max_attempts.
+    """
+    __table_args__ = (db.UniqueConstraint('fileset_id', 'name', 'version'),)
+    id = db.Column(db.Integer, primary_key=True)
+    fileset = db.relationship('Fileset', uselist=False)
+    fileset_id = db.Column(db.Integer, db.ForeignKey('fileset.id'), nullable=False)
+    name = db.Column(db.String(126), nullable=False)
+    version = db.Column(db.String(14), nullable=False)
+    state = db.Column(db.String(8), index=True, nullable=False)  # see jobqueue
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    lease_owner = db.Column(db.String(126))
+    lease_expires = db.Column(db.TIMESTAMP)
+    jobrun_id = db.Column(db.Integer, db.ForeignKey('jobrun.id'))
+    time_added = db.Column(db.TIMESTAMP, nullable=False)
+    time_updated = db.Column(db.TIMESTAMP, nullable=False)
+
+    def __repr__(self):
+        return '<{} {} "{}" version={} fileset={} state={} attempts={}>'.format(
+            self.__class__.__name__, self.id, self.name, self.version,
+            self.fileset_id, self.state, self.attempts)
+
+
+class WidgetCache(db.Model):
+    """Rendered detail widget of a fileset, see serializer
+
+    Valid as long as the latest jobrun of the widget's job and the job
+    version match; the milker drops entries of a job once it finished a
+    new jobrun of it.
+    """
+    __table_args__ = (db.UniqueConstraint('fileset_id', 'key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    fileset_id = db.Column(db.Integer, db.ForeignKey('fileset.id'), nullable=False)
+    key = db.Column(db.String(126), nullable=False)
+    job = db.Column(db.String(126), index=True, nullable=False)
+    jobrun_id = db.Column(db.Integer, db.ForeignKey('jobrun.id'), nullable=False)
+    version = db.Column(db.String(14), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # json serialised widget
+
+
 # class Listing(db.Model):
 #     __bind_key__ = 'cachedb'
 #     id = db.Column(db.Integer, primary_key=True)
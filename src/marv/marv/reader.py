@@ -27,12 +27,25 @@ from .widgeting import make_register, WidgetBase
 
 
 class Reader(WidgetBase):
+    read_info = None
+
     def __init__(self, **kw):
         kw['name'] = kw['name'].__tablename__
         super(Reader, self).__init__(**kw)
 
-    def read(self, fileset):
-        return self.callback(fileset)
+    def read(self, fileset, info=None):
+        if info is None:
+            return self.callback(fileset)
+        return self.callback(fileset, info=info)
+
+    def info_reader(self, func):
+        """Register func(paths) returning plain, picklable fileset info
+
+        It may be run in a worker process, its result is passed as info
+        to the reader callback to create the model instance.
+        """
+        self.read_info = func
+        return func
 
     def http_messages_generator(self, generator):
         def http_messages(fileset, **kw):
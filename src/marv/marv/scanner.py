@@ -24,11 +24,12 @@ from __future__ import absolute_import, division
 
 import hashlib
 import os
-from collections import namedtuple
+import time
+from collections import defaultdict, namedtuple
 from datetime import datetime
 from fnmatch import fnmatch
 from logging import getLogger
-from .model import File, Fileset
+from .model import db, File, Fileset, ScanDir, ScanFile
 from ._utils import multiplex
 from .widgeting import make_register, WidgetBase
 
@@ -49,6 +50,7 @@ scanner = make_register('scanner', namespace='', registry=SCANNER, cls=Scanner)
 
 FileInfo = namedtuple('FileInfo', ('dirpath', 'name'))
 FilesetInfo = namedtuple('FilesetInfo', ('type', 'dirpath', 'name', 'indexed_files'))
+FileStat = namedtuple('FileStat', ('inode', 'size', 'mtime', 'md5_mtime'))
 
 
 class BrokenFileset(Exception):
@@ -68,18 +70,193 @@ class EmptyFile(BrokenFileset):
     pass
 
 
-def detect_filesets(basedir, scanners):
-    """Walk basedir using scanners to detect filesets, return filesetinfos"""
+class ScanIndex(object):
+    """Persistent index of directory mtimes and fileset file stats
+
+    Directories whose mtime did not change since the last indexed scan
+    are not listed again, their subdirectories are taken from the
+    index. Within changed directories only filesets with new or
+    changed files are reported. Directories that vanished are recorded
+    in changed_dirs as well.
+
+    A file rewritten in place does not change the mtime of its
+    directory and is only noticed by a full scan, which ignores but
+    rebuilds the index.
+    """
+    # mtimes this close to the start of the scan are not trusted, the
+    # directory or file might still be written to within the same tick
+    RACY_SECONDS = 2
+
+    def __init__(self, full=False):
+        self.full = full
+        self.started = time.time()
+        self.changed_dirs = set()
+        self._dirs = {}
+        self._subdirs = defaultdict(list)
+        self._listed = {}
+        self._known = {}
+        self._stats = defaultdict(dict)
+
+    def load(self, basedir):
+        """Load index entries for basedir and its subdirectories"""
+        prefix = os.path.join(basedir, '')
+        query = ScanDir.query.with_entities(ScanDir.id, ScanDir.path, ScanDir.mtime)\
+                             .filter((ScanDir.path == basedir) |
+                                     ScanDir.path.startswith(prefix))
+        for id, path, mtime in query:
+            # LIKE wildcards in basedir may return unrelated directories
+            if path != basedir and not path.startswith(prefix):
+                continue
+            self._dirs[path] = (id, mtime)
+            if path != basedir:
+                self._subdirs[os.path.dirname(path)].append(os.path.basename(path))
+
+    def walk(self, basedir):
+        """Like os.walk, yielding None as filenames of unchanged directories"""
+        self.load(basedir)
+        seen = set()
+        for x in self._walk(basedir, seen):
+            yield x
+
+        prefix = os.path.join(basedir, '')
+        for path in self._dirs.keys():
+            if path not in seen and (path == basedir or path.startswith(prefix)):
+                self.changed_dirs.add(path)
+
+    def _walk(self, dirpath, seen):
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            return
+        seen.add(dirpath)
+
+        known = self._dirs.get(dirpath)
+        if not self.full and known is not None and known[1] == mtime:
+            subdirs = self._subdirs[dirpath]
+            filenames = None
+        else:
+            try:
+                names = os.listdir(dirpath)
+            except OSError:
+                return
+            subdirs = []
+            filenames = []
+            for name in names:
+                if os.path.isdir(os.path.join(dirpath, name)):
+                    subdirs.append(name)
+                else:
+                    filenames.append(name)
+            self.changed_dirs.add(dirpath)
+            self._listed[dirpath] = self._trusted(mtime)
+
+        yield dirpath, subdirs, filenames
+
+        for name in subdirs:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                continue
+            for x in self._walk(path, seen):
+                yield x
+
+    def _trusted(self, mtime):
+        return mtime if mtime < self.started - self.RACY_SECONDS else None
+
+    def _stat(self, fileinfo):
+        path = os.path.join(fileinfo.dirpath, fileinfo.name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        try:
+            md5_mtime = self._trusted(os.stat('{}.md5'.format(path)).st_mtime)
+        except OSError:
+            md5_mtime = None
+        return FileStat(inode=stat.st_ino, size=stat.st_size,
+                        mtime=self._trusted(stat.st_mtime), md5_mtime=md5_mtime)
+
+    def _known_stats(self, dirpath):
+        if dirpath not in self._known:
+            known = self._dirs.get(dirpath)
+            query = ScanFile.query.with_entities(ScanFile.name, ScanFile.inode,
+                                                 ScanFile.size, ScanFile.mtime,
+                                                 ScanFile.md5_mtime)\
+                                  .filter(ScanFile.dir_id == known[0]) \
+                if known is not None else ()
+            self._known[dirpath] = {x[0]: FileStat(*x[1:]) for x in query}
+        return self._known[dirpath]
+
+    def changed(self, filesetinfo):
+        """Record stats of fileset files, return whether any of them changed"""
+        changed = self.full
+        for _, fileinfo in filesetinfo.indexed_files:
+            stats = self._stats[fileinfo.dirpath]
+            stat = stats[fileinfo.name] = self._stat(fileinfo)
+            if changed:
+                continue
+            known = self._known_stats(fileinfo.dirpath)
+            if stat is None or stat.mtime is None or stat.md5_mtime is None or \
+               known.get(fileinfo.name) != stat:
+                changed = True
+        return changed
+
+    def failed(self, dirpath):
+        """Have dirpath listed again by next scan, a fileset in it failed"""
+        if dirpath in self._listed:
+            self._listed[dirpath] = None
+        self._stats.pop(dirpath, None)
+
+    def save(self):
+        """Persist stats of listed directories and drop vanished ones"""
+        vanished = [self._dirs[x][0] for x in self.changed_dirs
+                    if x in self._dirs and x not in self._listed]
+        relisted = [self._dirs[x][0] for x in self._listed if x in self._dirs]
+        for ids in (vanished, relisted):
+            if ids:
+                ScanFile.query.filter(ScanFile.dir_id.in_(ids))\
+                              .delete(synchronize_session=False)
+        if vanished:
+            ScanDir.query.filter(ScanDir.id.in_(vanished))\
+                         .delete(synchronize_session=False)
+
+        for dirpath, mtime in self._listed.items():
+            known = self._dirs.get(dirpath)
+            if known is None:
+                scandir = ScanDir(path=dirpath, mtime=mtime)
+                db.session.add(scandir)
+                db.session.flush()
+                dir_id = scandir.id
+            else:
+                dir_id = known[0]
+                ScanDir.query.filter(ScanDir.id == dir_id)\
+                             .update({'mtime': mtime}, synchronize_session=False)
+            db.session.add_all([
+                ScanFile(dir_id=dir_id, name=name, **stat._asdict())
+                for name, stat in self._stats[dirpath].items()
+                if stat is not None
+            ])
+        db.session.commit()
+
+
+def detect_filesets(basedir, scanners, index=None):
+    """Walk basedir using scanners to detect filesets, return filesetinfos
+
+    With an index, unchanged directories and filesets are skipped.
+    """
     logger = getLogger(__name__)
     assert os.path.isdir(basedir)
     assert len(scanners) > 0
-    for dirpath, subdirs, filenames in os.walk(basedir):
+    walk = os.walk(basedir) if index is None else index.walk(basedir)
+    for dirpath, subdirs, filenames in walk:
+        if filenames is None:
+            continue
         logger.debug('Scanning %s', dirpath)
         fileinfos = (FileInfo(dirpath, filename)
                      for filename in filenames
                      if filename[0] != '.' and     # skip hidden files
                      filename[-4:] != '.md5')      # skip md5 files
         for filesetinfo in list(multiplex(fileinfos, scanners, dont_catch=True)):
+            if index is not None and not index.changed(filesetinfo):
+                continue
             yield filesetinfo
 
 
@@ -122,11 +299,11 @@ def make_fileset(filesetinfo):
                    files=files, time_added=now, time_updated=now)
 
 
-def scan(basedir, scanner=SCANNER):
+def scan(basedir, scanner=SCANNER, index=None):
     """Scan basedir, return Fileset models, log warning for broken sets"""
     logger = getLogger(__name__)
     scanners = scanner.values()
-    for filesetinfo in detect_filesets(basedir, scanners):
+    for filesetinfo in detect_filesets(basedir, scanners, index=index):
         try:
             fileset = make_fileset(filesetinfo)
         except BrokenFileset as e:
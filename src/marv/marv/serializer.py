@@ -22,9 +22,14 @@
 
 from __future__ import absolute_import, division
 
+import flask
 import inspect
+import json
 import logging
 from flask_restless.serialization import DefaultSerializer
+from sqlalchemy.exc import SQLAlchemyError
+from .model import db, WidgetCache
+from .registry import JOB
 
 
 DETAIL = []
@@ -34,12 +39,33 @@ logger = logging.getLogger(__name__)
 
 
 class Base(object):
-    def __init__(self, namespace, name, widget, state=None):
+    def __init__(self, namespace, name, widget, state=None, job=None, applies=None):
         self.namespace = inspect.getmodule(widget.callback).__name__ \
             if namespace is None else namespace
         self.name = name
         self.widget = widget
         self.widget.state = state
+        self.job = job
+        self.applies = applies
+        self.key = '::'.join([self.namespace, name or widget.name])
+
+    def applicable(self, fileset):
+        """Cheaply tell whether widget may render anything for fileset
+
+        A widget of a job applies only to filesets with a jobrun of the
+        job, applies is an optional further predicate.
+        """
+        if self.job is not None and fileset.get_latest_jobrun(self.job) is None:
+            return False
+        return self.applies is None or bool(self.applies(fileset))
+
+    def manifest(self):
+        return {
+            'key': self.key,
+            'title': self.widget.title,
+            'type': self.widget.type,
+            'state': self.widget.state,
+        }
 
     def __call__(self, fileset):
         try:
@@ -54,11 +80,82 @@ class Summary(Base):
 
 
 class Detail(Base):
-    pass
+    def render(self, fileset, cache):
+        """Render widget for fileset, through cache for widgets of a job
+
+        cache maps widget keys to the fileset's WidgetCache entries.
+        Entries are used if made for the latest jobrun and current
+        version of the job, new ones are added for finished jobruns.
+        """
+        jobrun = self.job and fileset.get_latest_jobrun(self.job)
+        if not jobrun:
+            return self(fileset)
+        version = job_version(self.job, jobrun)
+        entry = cache.get(self.key)
+        if entry is not None and entry.jobrun_id == jobrun.id and \
+           entry.version == version:
+            return json.loads(entry.payload)
+        rv = self(fileset)
+        if rv is None or not (jobrun.succeeded or jobrun.failed):
+            return rv
+        try:
+            payload = json.dumps(rv, cls=flask.json.JSONEncoder)
+        except TypeError:
+            logger.warn('not caching unserializable widget %s', self.key)
+            return rv
+        if entry is None:
+            entry = WidgetCache(fileset_id=fileset.id, key=self.key, job=self.job)
+            db.session.add(entry)
+            cache[self.key] = entry
+        entry.jobrun_id = jobrun.id
+        entry.version = version
+        entry.payload = payload
+        return rv
+
+
+def job_version(name, jobrun):
+    """Version of registered job, of the jobrun if job is not loaded"""
+    job = JOB.get(name)
+    return jobrun.version if job is None else job.version
+
+
+def load_widget_cache(fileset, key=None):
+    """Load cached widgets of fileset, by key"""
+    query = WidgetCache.query.filter(WidgetCache.fileset_id == fileset.id)
+    if key is not None:
+        query = query.filter(WidgetCache.key == key)
+    return {x.key: x for x in query}
+
+
+def store_widget_cache():
+    """Commit widgets cached while rendering
+
+    A concurrent request may have cached the same widgets meanwhile,
+    which is fine to lose against, as is failing to write at all: the
+    rendered widgets are served nevertheless.
+    """
+    if not (db.session.new or db.session.dirty):
+        return
+    try:
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        logger.warn('not caching widgets: %s', e)
+
+
+def invalidate_widget_cache(jobrun):
+    """Drop cached widgets of jobrun's job for its fileset"""
+    WidgetCache.query\
+        .filter(WidgetCache.fileset_id == jobrun.fileset_id)\
+        .filter(WidgetCache.job == jobrun.name)\
+        .delete(synchronize_session=False)
 
 
 def fileset_detail(fileset, only=None):
-    return {
+    cache = load_widget_cache(fileset)
+    widgets = filter(None, [proxy.render(fileset, cache) for proxy in DETAIL
+                            if proxy.applicable(fileset)])
+    rv = {
         'id': fileset.id,
         'type': fileset.type,
         'name': fileset.name,
@@ -69,10 +166,60 @@ def fileset_detail(fileset, only=None):
                      for x in fileset.comments],
         'tags': [{'id': x.id, 'label': x.label}
                  for x in fileset.tags],
-        'widgets': filter(None, [proxy(fileset) for proxy in DETAIL])
+        'widgets': widgets,
+    }
+    store_widget_cache()
+    return rv
+
+
+def has_jobfiles(job, prefix=''):
+    """Predicate for detail applies: latest jobrun of job has a jobfile
+    whose name starts with prefix"""
+    def applies(fileset):
+        jobrun = fileset.get_latest_jobrun(job)
+        return jobrun is not None and \
+            any(x.name.startswith(prefix) for x in jobrun.jobfiles)
+    return applies
+
+
+def register_detail(proxy):
+    """Add detail proxy, its key has to be unique among registered ones
+
+    Keys identify widgets in URLs and the widget cache; widgets
+    registered in a loop need an explicit name each.
+    """
+    if any(x.key == proxy.key for x in DETAIL):
+        raise ValueError('Detail widget {} registered twice'.format(proxy.key))
+    DETAIL.append(proxy)
+
+
+def fileset_widgets(fileset):
+    """Manifest of detail widgets applicable to fileset, without payloads"""
+    return {
+        'id': fileset.id,
+        'name': fileset.name,
+        'widgets': [proxy.manifest() for proxy in DETAIL
+                    if proxy.applicable(fileset)]
     }
 
 
+def fileset_widget(fileset, key):
+    """Render detail widget with key for fileset, None if not applicable
+
+    Raises KeyError for unknown keys.
+    """
+    for proxy in DETAIL:
+        if proxy.key == key:
+            break
+    else:
+        raise KeyError(key)
+    if not proxy.applicable(fileset):
+        return None
+    rv = proxy.render(fileset, load_widget_cache(fileset, key))
+    store_widget_cache()
+    return rv
+
+
 def fileset_summary(filesets):
     if not filesets.count():
         return {'widgets': []}
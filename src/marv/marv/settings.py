@@ -52,6 +52,7 @@ class Testing(_Base):
     MARV_SIGNAL_URL = None
     SQLALCHEMY_ECHO = bool(os.environ.get('SQLALCHEMY_ECHO', False))
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    LISTING_CACHE_URI = 'sqlite://'
     DB_SQLITE = None
     TESTING = True
     DB_CREATE_ALL = True
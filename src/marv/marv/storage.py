@@ -22,24 +22,60 @@
 
 from __future__ import absolute_import, division
 
-import subprocess
 import os
+from collections import defaultdict
 from datetime import datetime
-from itertools import chain
+from itertools import chain, islice, izip, repeat
 from logging import getLogger
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from uuid import uuid4
 from . import queries
-from .listing import trigger_remove_listing_entries, trigger_update_listing_entries
-from .model import db, Fileset
+from .listing import trigger_update_listing_entries
+from .model import db, File, Fileset
 from .model import Storage as _Storage
 from .reader import READER
-from .scanner import SCANNER, scan
+from .scanner import SCANNER, ScanIndex, scan
+from .verify import MD5Verifier
+
+
+_read_worker_reader = None
+
+
+def _init_read_worker(reader):
+    global _read_worker_reader
+    _read_worker_reader = reader
+
+
+def _read_info(task):
+    """Read plain info of a fileset in a worker process"""
+    if task is None:
+        return None
+    type, paths = task
+    try:
+        return True, _read_worker_reader[type].read_info(paths)
+    except Exception as e:
+        import traceback
+        return False, (unicode(e) or 'unknown', traceback.format_exc())
+
+
+def _listdir(dirpath):
+    try:
+        return set(os.listdir(dirpath))
+    except OSError:
+        return set()
 
 
 class Storage(object):
-    def __init__(self, reader=None, scanner=None):
+    LISTDIR_JOBS = 8
+    READ_BATCH_SIZE = 50
+    SCAN_CHUNK_SIZE = 500
+    UPDATE_CHUNK_SIZE = 500
+
+    def __init__(self, reader=None, scanner=None, verifier=None):
         self.reader = READER if reader is None else reader
         self.scanner = SCANNER if scanner is None else scanner
+        self.verifier = MD5Verifier() if verifier is None else verifier
         # XXX: we probably can get rid of model.Storage as we do not
         # need it for sync anymore
         storages = _Storage.query.all()
@@ -50,11 +86,11 @@ class Storage(object):
             raise ValueError('No storage defined')
 
     @classmethod
-    def new_storage(cls, reader=None, scanner=None):
+    def new_storage(cls, reader=None, scanner=None, verifier=None):
         uuid = str(uuid4())
         db.session.add(_Storage(uuid=uuid))
         db.session.commit()
-        return cls(reader=reader, scanner=scanner)
+        return cls(reader=reader, scanner=scanner, verifier=verifier)
 
     @property
     def filesets(self):
@@ -82,118 +118,306 @@ class Storage(object):
     def uuid(self):
         return self.instance.uuid
 
-    def _detect_missing(self, logger):
-        """Detect missing files for active filesets"""
-        need_update = set()
-        for fileset in self.active_filesets:
-            for file in fileset.files:
-                missing = not os.path.exists(file.path)
-                if missing ^ (file.missing or False):
-                    if missing:
-                        logger.warn('Lost file %r of %r', file, fileset)
-                    else:
-                        logger.info('Found missing file %r of %r', file, fileset)
-                    file.missing = missing
-                    need_update.add(fileset.id)
+    def _detect_missing(self, logger, dirpaths=None):
+        """Detect missing files for active filesets, optionally limited to dirpaths
+
+        Files are fetched as plain rows and checked against one listing
+        per directory, directories are listed in parallel. Files whose
+        missing flag flips are updated in bulk and logged from plain rows,
+        both in chunks; their filesets are marked as updated.
+        """
+        query = db.session.query(File.id, File.name, File.missing, Fileset.dirpath)\
+                          .join(Fileset)\
+                          .filter(Fileset.storage_id == self.instance.id)\
+                          .filter(Fileset.deleted.isnot(True))
+        if dirpaths is None:
+            queries = [query]
+        else:
+            dirpaths = list(dirpaths)
+            queries = [query.filter(Fileset.dirpath.in_(
+                dirpaths[i:i + self.UPDATE_CHUNK_SIZE]))
+                for i in range(0, len(dirpaths), self.UPDATE_CHUNK_SIZE)]
+            if not queries:
+                return
+
+        by_dirpath = defaultdict(list)
+        for query in queries:
+            for file_id, name, missing, dirpath in \
+                    query.yield_per(self.UPDATE_CHUNK_SIZE):
+                by_dirpath[dirpath].append((file_id, name, missing or False))
+
+        pool = ThreadPool(self.LISTDIR_JOBS)
+        try:
+            listings = pool.imap(_listdir, by_dirpath.keys())
+            flipped = {True: [], False: []}
+            for (dirpath, files), names in izip(by_dirpath.iteritems(), listings):
+                for file_id, name, missing in files:
+                    if (name not in names) ^ missing:
+                        flipped[not missing].append(file_id)
+        finally:
+            pool.close()
+            pool.join()
+
+        lost, found = flipped[True], flipped[False]
+        if not lost and not found:
+            return
+        file_count = db.session.query(db.func.count(File.id))\
+                               .filter(File.fileset_id == Fileset.id)\
+                               .correlate(Fileset)\
+                               .as_scalar()
+        query = db.session.query(File.id, File.name, File.md5, File.size,
+                                 File.fileset_id, Fileset.name, Fileset.type,
+                                 Fileset.dirpath, file_count, Fileset.md5)\
+                          .join(Fileset)
+        fileset_ids = set()
+        messages = []
+        for missing, ids in ((True, lost), (False, found)):
+            for i in range(0, len(ids), self.UPDATE_CHUNK_SIZE):
+                chunk = ids[i:i + self.UPDATE_CHUNK_SIZE]
+                for row in query.filter(File.id.in_(chunk)):
+                    fileset_ids.add(row[4])
+                    messages.append((row[0], missing, row[1:4] + row[5:]))
+                File.query.filter(File.id.in_(chunk))\
+                          .update({File.missing: missing}, synchronize_session=False)
+        # mark filesets as updated for the incremental listing sync
+        now = datetime.utcnow()
+        ids = list(fileset_ids)
+        for i in range(0, len(ids), self.UPDATE_CHUNK_SIZE):
+            Fileset.query.filter(Fileset.id.in_(ids[i:i + self.UPDATE_CHUNK_SIZE]))\
+                         .update({Fileset.time_updated: now},
+                                 synchronize_session=False)
         db.session.commit()
-        trigger_update_listing_entries(list(need_update))
+        for _, missing, args in sorted(messages):
+            # same as reprs of File and Fileset
+            msg = '{} <File "{}" md5="{}" size={}> of ' \
+                  '<Fileset "{}" type="{}" dir="{}" files={} md5="{}">'
+            if missing:
+                logger.warn(msg.format('Lost file', *args))
+            else:
+                logger.info(msg.format('Found missing file', *args))
+        trigger_update_listing_entries(list(fileset_ids))
 
-    def read_pending(self, logger=getLogger(__name__)):
-        reader = self.reader
-        for fileset in self.pending_filesets:
-            try:
-                logger.info('reading %r', fileset)
-                instance = reader[fileset.type].read(fileset)
-                # # XXX: this is probably non-functional
-                # existing = getattr(fileset, fileset.type, None)
-                # if existing is not None:
-                #     db.session.delete(existing)
-                #     db.session.flush()
-                setattr(fileset, fileset.type, instance)
-                fileset.time_read = datetime.utcnow()
-                fileset.read_succeeded = True
-                db.session.commit()
-                trigger_update_listing_entries([fileset.id])
-                logger.debug('read %r', fileset)
-            except Exception as e:
-                import traceback
-                logger.error('skipped %r due to exception\n%s',
-                             fileset, traceback.format_exc())
-                db.session.rollback()
-                fileset.time_read = datetime.utcnow()
-                fileset.read_succeeded = False
-                fileset.read_error = unicode(e) or 'unknown'
-                db.session.commit()
+    def read_pending(self, workers=1, logger=getLogger(__name__)):
+        """Read pending filesets and persist them in batches
+
+        With workers > 1 readers providing read_info have it run in a
+        process pool; only the model instances are created from the
+        returned plain data in this process. Should a batch fail, its
+        filesets are retried one by one, recording the error of the
+        offending ones.
+        """
+        filesets = self.pending_filesets.all()
+        pool = None
+        if workers > 1:
+            tasks = [(x.type, [y.path for y in x.files])
+                     if x.type in self.reader and
+                     self.reader[x.type].read_info is not None else None
+                     for x in filesets]
+            pool = Pool(workers, _init_read_worker, (self.reader,))
+            results = pool.imap(_read_info, tasks)
+        else:
+            results = repeat(None)
+        try:
+            pending = izip(filesets, results)
+            while True:
+                batch = list(islice(pending, self.READ_BATCH_SIZE))
+                if not batch:
+                    break
+                self._read_batch(batch, logger)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _read_batch(self, batch, logger):
+        for fileset, _ in batch:
+            logger.info('reading %r', fileset)
+        try:
+            read = [x for x, result in batch if self._read(x, result, logger)]
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            read = []
+            for fileset, result in batch:
+                try:
+                    if self._read(fileset, result, logger):
+                        read.append(fileset)
+                    db.session.commit()
+                except Exception as e:
+                    import traceback
+                    db.session.rollback()
+                    self._read_failed(fileset, unicode(e) or 'unknown',
+                                      traceback.format_exc(), logger)
+                    db.session.commit()
+        for fileset in read:
+            logger.debug('read %r', fileset)
+        if read:
+            trigger_update_listing_entries([x.id for x in read])
+
+    def _read(self, fileset, result, logger):
+        """Create model instance for fileset, return whether it succeeded
+
+        result is None if fileset is to be read here, otherwise the
+        (succeeded, info or (error, traceback)) tuple of a worker.
+        """
+        reader = self.reader.get(fileset.type)
+        if reader is None:
+            error = 'No reader for type {}'.format(fileset.type)
+            self._read_failed(fileset, error, error, logger)
+            return False
+        if result is None:
+            instance = reader.read(fileset)
+        else:
+            succeeded, info = result
+            if not succeeded:
+                self._read_failed(fileset, info[0], info[1], logger)
+                return False
+            instance = reader.read(fileset, info=info)
+        setattr(fileset, fileset.type, instance)
+        fileset.time_read = datetime.utcnow()
+        fileset.read_succeeded = True
+        return True
+
+    def _read_failed(self, fileset, error, tb, logger):
+        logger.error('skipped %r due to exception\n%s', fileset, tb)
+        fileset.time_read = datetime.utcnow()
+        fileset.read_succeeded = False
+        fileset.read_error = error
 
     def scan(self, basedir):
         return self.scan_all((basedir,))
 
-    def scan_all(self, basedirs, logger=getLogger(__name__)):
-        seen = set()
-        for found in chain.from_iterable(scan(x, self.scanner) for x in basedirs):
+    def scan_all(self, basedirs, use_index=False, full=False,
+                 logger=getLogger(__name__)):
+        """Scan basedirs and reconcile found filesets with the database
+
+        Found filesets are reconciled in chunks, each committed and
+        signalled to the listing at once. Should a chunk fail, its
+        filesets are retried one by one, skipping the offending ones.
+
+        With use_index only new or changed filesets are considered and
+        missing files are only looked for in changed directories. A
+        full scan does not skip anything, but rebuilds the index.
+        """
+        index = ScanIndex(full=full) if use_index else None
+        found = chain.from_iterable(scan(x, self.scanner, index=index)
+                                    for x in basedirs)
+        while True:
+            chunk = list(islice(found, self.SCAN_CHUNK_SIZE))
+            if not chunk:
+                break
             try:
-                active = self.active_filesets.filter_by(md5=found.md5).first()
-                if active is None:
-                    # New, duplicate, or superseding fileset
-                    active = self.active_filesets \
-                        .filter((Fileset.name == found.name) &
-                                (Fileset.type == found.type)).first()
-
-                    # New fileset?
-                    if active is None:
-                        if not self.verify_md5(found):
-                            logger.warn('skipped MD5 mismatch %r', found)
-                            continue
-
-                        self.instance.filesets.append(found)
-                        db.session.commit()
-                        trigger_update_listing_entries([found.id])
-                        logger.info('added new %r', found)
-                        seen.add(found.md5)
-                        continue
+                ids = self._reconcile(chunk, logger, index)
+            except:
+                db.session.rollback()
+                ids = []
+                for fileset in chunk:
+                    try:
+                        ids.extend(self._reconcile([fileset], logger, index))
+                    except:
+                        import traceback
+                        logger.error('skipped %r due to exception\n%s',
+                                     fileset, traceback.format_exc())
+                        db.session.rollback()
+                        if index is not None:
+                            index.failed(fileset.dirpath)
+            if ids:
+                trigger_update_listing_entries(ids)
+        dirpaths = index.changed_dirs if index is not None and not full else None
+        self._detect_missing(logger, dirpaths=dirpaths)
+        if index is not None:
+            index.save()
+
+    def _reconcile(self, chunk, logger, index=None):
+        """Reconcile chunk of found filesets, return ids needing listing update
+
+        Active filesets matching by md5 or by name are fetched with one
+        query each, filesets without match are verified together. The
+        found filesets are then handled in order, seeing the ones added
+        before them. Directories of skipped filesets are marked failed
+        in index, to be looked at again by the next scan.
+        """
+        by_md5 = {}
+        by_name = {}
+        active_filesets = self.active_filesets\
+                              .options(db.subqueryload(Fileset.files))\
+                              .order_by(Fileset.id)
+        md5s = list({x.md5 for x in chunk})
+        names = list({x.name for x in chunk})
+        for active in active_filesets.filter(Fileset.md5.in_(md5s)):
+            by_md5.setdefault(active.md5, active)
+        for active in active_filesets.filter(Fileset.name.in_(names)):
+            by_name.setdefault((active.name, active.type), active)
+
+        unknown = [x for x in chunk
+                   if x.md5 not in by_md5 and (x.name, x.type) not in by_name]
+        verified = dict(zip([id(x) for x in unknown], self.verifier.verify(unknown)))
+
+        changed = []
+        messages = []
+        skipped = []
+        for found in chunk:
+            active = by_md5.get(found.md5)
+            if active is None:
+                # New, duplicate, or superseding fileset
+                active = by_name.get((found.name, found.type))
 
-                    # Duplicate?
-                    if active.files[0].path != found.files[0].path and \
-                       os.path.exists(active.files[0].path) and \
-                       os.path.exists(found.files[0].path):
-                        logger.warn('skipped duplicate %r keeping %r', found, active)
+                # New fileset?
+                if active is None:
+                    ok = verified.get(id(found))
+                    if not (self.verify_md5(found) if ok is None else ok):
+                        messages.append((logger.warn, 'skipped MD5 mismatch %r',
+                                         found))
+                        skipped.append(found)
                         continue
 
-                    # superseding
-                    active.deleted = True
-                    active.deleted_reason = '__superseded__'
                     self.instance.filesets.append(found)
-                    trigger_remove_listing_entries([found.id])
-                    db.session.commit()
-                    logger.info('%r superseds %r', found, active)
-                    seen.add(found.md5)
+                    by_md5[found.md5] = by_name[found.name, found.type] = found
+                    changed.append(found)
+                    messages.append((logger.info, 'added new %r', found))
                     continue
 
-                # Duplicate?
-                if active.files[0].path != found.files[0].path and \
-                   os.path.exists(active.files[0].path) and \
-                   os.path.exists(found.files[0].path):
-                    logger.warn('skipped duplicate %r keeping %r', found, active)
+                if self._is_duplicate(active, found):
+                    messages.append((logger.warn, 'skipped duplicate %r keeping %r',
+                                     found, active))
+                    skipped.append(found)
                     continue
 
-                changed_attrs = active.update_from(found)
-                if changed_attrs:
-                    db.session.commit()
-                    trigger_update_listing_entries([active.id])
-                    logger.info('updated %s: %s', ', '.join(changed_attrs), active)
-                seen.add(found.md5)
-            except:
-                import traceback
-                logger.error('skipped %r due to exception\n%s',
-                             found, traceback.format_exc())
-                db.session.rollback()
-        self._detect_missing(logger)
+                # superseding
+                active.deleted = True
+                active.deleted_reason = '__superseded__'
+                self.instance.filesets.append(found)
+                by_md5[found.md5] = by_name[found.name, found.type] = found
+                changed.extend((active, found))
+                messages.append((logger.info, '%r superseds %r', found, active))
+                continue
+
+            if self._is_duplicate(active, found):
+                messages.append((logger.warn, 'skipped duplicate %r keeping %r',
+                                 found, active))
+                skipped.append(found)
+                continue
+
+            changed_attrs = active.update_from(found)
+            if changed_attrs:
+                by_name[active.name, active.type] = active
+                changed.append(active)
+                messages.append((logger.info, 'updated %s: %s',
+                                 ', '.join(changed_attrs), active))
+
+        db.session.commit()
+        for log, msg, args in ((x[0], x[1], x[2:]) for x in messages):
+            log(msg, *args)
+        if index is not None:
+            for found in skipped:
+                index.failed(found.dirpath)
+        return [x.id for x in changed]
+
+    @staticmethod
+    def _is_duplicate(active, found):
+        return active.files[0].path != found.files[0].path and \
+            os.path.exists(active.files[0].path) and \
+            os.path.exists(found.files[0].path)
 
     def verify_md5(self, fileset):
-        for file in fileset.files:
-            if subprocess.call(['md5sum', '-c', '{}.md5'.format(file.name)],
-                               cwd=fileset.dirpath,
-                               stderr=subprocess.PIPE,
-                               stdout=subprocess.PIPE) != 0:
-                return False
-        return True
+        return self.verifier.verify([fileset])[0]
@@ -25,7 +25,9 @@ from __future__ import absolute_import, division
 import flask_testing
 import hashlib
 import os
+import re
 import shutil
+import time
 from flask import Flask
 from testfixtures import LogCapture
 from .. import bb
@@ -49,12 +51,19 @@ class Bar(object):
 
 
 @bb.reader(Foo, registry=TEST_READER)
-def foo_reader(fileset):
+def foo_reader(fileset, info=None):
+    if info is None:
+        info = foo_read_info([x.path for x in fileset.files])
+    return Foo(count=info)
+
+
+@foo_reader.info_reader
+def foo_read_info(paths):
     count = 0
-    for file in fileset.files:
-        with open(file.path) as f:
+    for path in paths:
+        with open(path) as f:
             count += len(f.read())
-    return Foo(count=count)
+    return count
 
 
 @bb.reader(Bar, registry=TEST_READER)
@@ -99,10 +108,10 @@ class TestCase(flask_testing.TestCase):
         with LogCapture('marv') as log:
             storage.scan_all((path1, path2))
             log.check(('marv.scanner', 'DEBUG', 'Scanning %s' % path1),
+                      ('marv.scanner', 'DEBUG', 'Scanning %s' % path2),
                       ('marv.storage', 'INFO',
                        'added new <Fileset "set0" type="foo" dir="%s"'
                        ' files=3 md5="03ed01292b64595cf975353d93fb1fdb">' % path1),
-                      ('marv.scanner', 'DEBUG', 'Scanning %s' % path2),
                       ('marv.storage', 'INFO',
                        'added new <Fileset "set0" type="bar" dir="%s"'
                        ' files=3 md5="be8da9c3332394489de53e33c0fdbc63">' % path2))
@@ -121,12 +130,12 @@ class TestCase(flask_testing.TestCase):
             log.check(('marv.storage', 'INFO', 'reading'
                        ' <Fileset "set0" type="foo" dir="%s"'
                        ' files=3 md5="03ed01292b64595cf975353d93fb1fdb">' % path1),
-                      ('marv.storage', 'DEBUG', 'read'
-                       ' <Fileset "set0" type="foo" dir="%s"'
-                       ' files=3 md5="03ed01292b64595cf975353d93fb1fdb">' % path1),
                       ('marv.storage', 'INFO', 'reading'
                        ' <Fileset "set0" type="bar" dir="%s"'
                        ' files=3 md5="be8da9c3332394489de53e33c0fdbc63">' % path2),
+                      ('marv.storage', 'DEBUG', 'read'
+                       ' <Fileset "set0" type="foo" dir="%s"'
+                       ' files=3 md5="03ed01292b64595cf975353d93fb1fdb">' % path1),
                       ('marv.storage', 'DEBUG', 'read'
                        ' <Fileset "set0" type="bar" dir="%s"'
                        ' files=3 md5="be8da9c3332394489de53e33c0fdbc63">' % path2))
@@ -134,6 +143,51 @@ class TestCase(flask_testing.TestCase):
         self.assertEqual(len(list(storage.filesets)), 2)
         self.assertEqual(len(list(storage.pending_filesets)), 0)
 
+    @default_from_self
+    def test_read_pending_workers(self, path, storage):
+        """Filesets are read in worker processes, errors are recorded"""
+        path1 = os.path.join(path, 'one')
+        path2 = os.path.join(path, 'two')
+        path3 = os.path.join(path, 'three')
+        for x in (path1, path2, path3):
+            os.mkdir(x)
+        make_fileset(path1)
+        make_fileset(path2, format='bar')
+        make_fileset(path3, set_idx=1)
+        storage.scan_all((path1, path2, path3))
+        os.unlink(os.path.join(path3, 'set1.file0.foo'))
+
+        with LogCapture('marv.storage') as log:
+            storage.read_pending(workers=2)
+            self.assertEqual([x.levelname for x in log.records],
+                             ['INFO', 'INFO', 'INFO', 'ERROR', 'DEBUG', 'DEBUG'])
+        self.assertEqual(len(list(storage.pending_filesets)), 0)
+        set0, bar, set1 = storage.filesets
+        self.assertEqual(set0.foo.count, 66)
+        self.assertEqual(bar.bar.count, 9)
+        self.assertTrue(set0.read_succeeded)
+        self.assertTrue(bar.read_succeeded)
+        self.assertFalse(set1.read_succeeded)
+        self.assertIn('No such file', set1.read_error)
+
+    @default_from_self
+    def test_read_pending_unknown_type(self, path, storage):
+        """Filesets without reader are recorded as failed, others read"""
+        make_fileset(path)
+        make_fileset(path, set_idx=1)
+        storage.scan(path)
+        storage.filesets[0].type = 'unknown'
+        db.session.commit()
+
+        with LogCapture('marv.storage') as log:
+            storage.read_pending(workers=2)
+            self.assertEqual([x.levelname for x in log.records],
+                             ['INFO', 'INFO', 'ERROR', 'DEBUG'])
+        unknown, set1 = storage.filesets
+        self.assertFalse(unknown.read_succeeded)
+        self.assertEqual(unknown.read_error, 'No reader for type unknown')
+        self.assertTrue(set1.read_succeeded)
+
     @default_from_self
     def test_set_moved(self, path, storage):
         """Update moved set"""
@@ -284,10 +338,10 @@ class TestCase(flask_testing.TestCase):
         with LogCapture('marv') as log:
             storage.scan(path)
             log.check(('marv.scanner', 'DEBUG', 'Scanning %s' % path),
+                      ('marv.scanner', 'DEBUG', 'Scanning %s' % subdir),
                       ('marv.storage', 'INFO', 'added new'
                        ' <Fileset "set0" type="foo" dir="%s"'
                        ' files=3 md5="03ed01292b64595cf975353d93fb1fdb">' % path),
-                      ('marv.scanner', 'DEBUG', 'Scanning %s' % subdir),
                       ('marv.storage', 'WARNING', 'skipped duplicate'
                        ' <Fileset "set0" type="foo" dir="%s"'
                        ' files=3 md5="03ed01292b64595cf975353d93fb1fdb">'
@@ -329,10 +383,10 @@ class TestCase(flask_testing.TestCase):
         with LogCapture('marv') as log:
             storage.scan(path)
             log.check(('marv.scanner', 'DEBUG', 'Scanning %s' % path),
+                      ('marv.scanner', 'DEBUG', 'Scanning %s' % subdir),
                       ('marv.storage', 'INFO', 'added new'
                        ' <Fileset "set0" type="foo" dir="%s"'
                        ' files=3 md5="fa5fdfa3e91db83f6f0bcbc01a4257b3">' % path),
-                      ('marv.scanner', 'DEBUG', 'Scanning %s' % subdir),
                       ('marv.storage', 'WARNING', 'skipped duplicate'
                        ' <Fileset "set0" type="foo" dir="%s"'
                        ' files=3 md5="1cc962eab33bb3e5e135ca2afaa945bb">'
@@ -434,3 +488,118 @@ class TestCase(flask_testing.TestCase):
         self.assertEqual(len(list(storage.filesets)), 2)
         self.assertEqual(len(list(storage.active_filesets)), 1)
         self.assertEqual(storage.filesets[0].deleted_reason, 'foo')
+
+    @default_from_self
+    def test_indexed_scan(self, path, storage):
+        """Indexed rescan skips unchanged directories and filesets"""
+        subdir = os.path.join(path, 'subdir')
+        os.mkdir(subdir)
+        make_fileset(path)
+        make_fileset(subdir, set_idx=1)
+
+        def age(*paths):
+            # mtimes of the last seconds are not trusted by the index
+            past = time.time() - 60
+            for x in paths:
+                os.utime(x, (past, past))
+
+        age(path, subdir, *[os.path.join(d, x)
+                            for d in (path, subdir) for x in os.listdir(d)
+                            if not os.path.isdir(os.path.join(d, x))])
+
+        with LogCapture('marv') as log:
+            storage.scan_all((path,), use_index=True)
+            log.check(('marv.scanner', 'DEBUG', 'Scanning %s' % path),
+                      ('marv.scanner', 'DEBUG', 'Scanning %s' % subdir),
+                      ('marv.storage', 'INFO', 'added new'
+                       ' <Fileset "set0" type="foo" dir="%s"'
+                       ' files=3 md5="03ed01292b64595cf975353d93fb1fdb">' % path),
+                      ('marv.storage', 'INFO', 'added new'
+                       ' <Fileset "set1" type="foo" dir="%s"'
+                       ' files=3 md5="4250772def17d13015ce7bb4df3b6a31">' % subdir))
+
+        # nothing changed, nothing scanned
+        with LogCapture('marv') as log:
+            storage.scan_all((path,), use_index=True)
+            log.check()
+
+        # only the changed directory is scanned and only the new set reported
+        make_fileset(subdir, set_idx=2)
+        with LogCapture('marv') as log:
+            storage.scan_all((path,), use_index=True)
+            log.check(('marv.scanner', 'DEBUG', 'Scanning %s' % subdir),
+                      ('marv.storage', 'INFO', 'added new'
+                       ' <Fileset "set2" type="foo" dir="%s"'
+                       ' files=3 md5="1c83476ded06bfba613aebf8e40c6aa1">' % subdir))
+
+        # vanished files are detected in changed directories
+        shutil.rmtree(subdir)
+        with LogCapture('marv.storage') as log:
+            storage.scan_all((path,), use_index=True)
+            lost = [re.match('Lost file <File "(set\d\.file\d\.foo)".*'
+                             ' of <Fileset "(set\d)" type="foo" dir="([^"]*)"',
+                             x.getMessage()).groups()
+                    for x in log.records if x.levelname == 'WARNING']
+        self.assertEqual(sorted(lost),
+                         [('set{}.file{}.foo'.format(i, j), 'set{}'.format(i), subdir)
+                          for i in (1, 2) for j in range(3)])
+        self.assertEqual(len(list(storage.active_intact_filesets)), 1)
+
+        # full scan does not skip anything
+        with LogCapture('marv') as log:
+            storage.scan_all((path,), use_index=True, full=True)
+            log.check(('marv.scanner', 'DEBUG', 'Scanning %s' % path),)
+
+    @default_from_self
+    def test_indexed_scan_retries_failed(self, path, storage):
+        """Directories of filesets failing to reconcile are scanned again"""
+        make_fileset(path)
+        past = time.time() - 60
+        for x in [path] + [os.path.join(path, x) for x in os.listdir(path)]:
+            os.utime(x, (past, past))
+
+        def fail(chunk, logger, index=None):
+            raise Exception('reconcile failed')
+        storage._reconcile = fail
+        with LogCapture('marv.storage') as log:
+            storage.scan_all((path,), use_index=True)
+            self.assertEqual([x.levelname for x in log.records], ['ERROR'])
+        del storage._reconcile
+
+        with LogCapture('marv.storage') as log:
+            storage.scan_all((path,), use_index=True)
+            log.check(('marv.storage', 'INFO', 'added new'
+                       ' <Fileset "set0" type="foo" dir="%s"'
+                       ' files=3 md5="03ed01292b64595cf975353d93fb1fdb">' % path),)
+
+    @default_from_self
+    def test_indexed_scan_retries_skipped(self, path, storage):
+        """Directories of skipped duplicates are scanned again"""
+        subdir = os.path.join(path, 'subdir')
+        os.mkdir(subdir)
+        make_fileset(path)
+        make_fileset(subdir)
+        past = time.time() - 60
+        for dirpath, _, filenames in os.walk(path):
+            for x in [dirpath] + [os.path.join(dirpath, x) for x in filenames]:
+                os.utime(x, (past, past))
+
+        for _ in range(2):
+            with LogCapture('marv.storage') as log:
+                storage.scan_all((path,), use_index=True)
+                self.assertIn('WARNING', [x.levelname for x in log.records])
+
+    @default_from_self
+    def test_lost_files_in_chunks(self, path, storage):
+        """Lost files are updated and logged in chunks"""
+        make_fileset(path)
+        storage.scan(path)
+        storage.UPDATE_CHUNK_SIZE = 2
+        for file in storage.filesets[0].files:
+            os.unlink(file.path)
+        with LogCapture('marv.storage') as log:
+            storage.scan(path)
+            self.assertEqual([x.getMessage()[:27] for x in log.records],
+                             ['Lost file <File "set0.file{}'.format(i)
+                              for i in range(3)])
+        self.assertTrue(all(x.missing for x in storage.filesets[0].files))
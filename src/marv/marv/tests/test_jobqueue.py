@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import, division
+
+import flask_testing
+import os
+from datetime import datetime, timedelta
+from flask import Flask
+from .. import jobqueue
+from ..model import db, Fileset, JobQueueItem
+
+
+class TestCase(flask_testing.TestCase):
+    SQLALCHEMY_ECHO = bool(os.environ.get('SQLALCHEMY_ECHO', False))
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config.from_object(self)
+        db.init_app(app)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        now = datetime.utcnow()
+        for name in ('set0', 'set1'):
+            db.session.add(Fileset(storage_id=1, md5=name, name=name, dirpath='',
+                                   type='foo', time_added=now, time_updated=now))
+        db.session.commit()
+
+    def states(self):
+        db.session.expire_all()
+        return [(x.fileset_id, x.name, x.state, x.attempts)
+                for x in JobQueueItem.query.order_by(JobQueueItem.id)]
+
+    def test_enqueue(self):
+        items = [(1, 'a', '1'), (1, 'b', '1'), (2, 'a', '1')]
+        self.assertEqual(jobqueue.enqueue(items), 3)
+        self.assertEqual(jobqueue.enqueue(items + [(2, 'a', '2')]), 1)
+        self.assertEqual(len(self.states()), 4)
+
+        claimed = jobqueue.claim('w1')
+        jobqueue.complete(claimed[0].id, 'w1', succeeded=True)
+        self.assertEqual(jobqueue.enqueue(items), 0)
+        self.assertEqual(jobqueue.enqueue(items, reset=True), 1)
+        self.assertEqual(self.states()[0], (1, 'a', jobqueue.PENDING, 0))
+
+    def test_claim(self):
+        jobqueue.enqueue([(1, 'a', '1'), (1, 'b', '1'), (2, 'a', '1')])
+        claimed = jobqueue.claim('w1')
+        self.assertEqual([(x.fileset_id, x.name) for x in claimed],
+                         [(1, 'a'), (1, 'b')])
+        claimed = jobqueue.claim('w2')
+        self.assertEqual([(x.fileset_id, x.name) for x in claimed], [(2, 'a')])
+        self.assertEqual(jobqueue.claim('w3'), [])
+
+        self.assertEqual(jobqueue.heartbeat([1, 2, 3], 'w1'), 2)
+        self.assertTrue(jobqueue.complete(1, 'w1', succeeded=True))
+        self.assertFalse(jobqueue.complete(3, 'w1', succeeded=True))
+        jobqueue.release([3], 'w2')
+        self.assertEqual(self.states(), [
+            (1, 'a', jobqueue.DONE, 1),
+            (1, 'b', jobqueue.LEASED, 1),
+            (2, 'a', jobqueue.PENDING, 0),
+        ])
+
+    def test_retry(self):
+        jobqueue.enqueue([(1, 'a', '1')], max_attempts=2)
+        item, = jobqueue.claim('w1')
+        self.assertTrue(jobqueue.complete(item.id, 'w1', succeeded=False))
+        self.assertEqual(self.states(), [(1, 'a', jobqueue.PENDING, 1)])
+
+        # worker dies, lease expires
+        item, = jobqueue.claim('w1')
+        self.assertEqual(jobqueue.claim('w2'), [])
+        JobQueueItem.query.update({
+            JobQueueItem.lease_expires: datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        self.assertEqual(jobqueue.claim('w2'), [])
+        self.assertEqual(self.states(), [(1, 'a', jobqueue.FAILED, 2)])
+        self.assertFalse(jobqueue.complete(item.id, 'w1', succeeded=True))
+
+    def test_no_retry(self):
+        jobqueue.enqueue([(1, 'a', '1')])
+        item, = jobqueue.claim('w1')
+        self.assertTrue(jobqueue.complete(item.id, 'w1', succeeded=False, retry=False))
+        self.assertEqual(self.states(), [(1, 'a', jobqueue.FAILED, 1)])
+        self.assertEqual(jobqueue.claim('w2'), [])
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+from __future__ import absolute_import, division
+
+import fcntl
+import flask_testing
+import json
+import os
+import time
+from datetime import datetime
+from flask import Flask
+from logging import getLogger
+from sqlalchemy import event
+from threading import Thread
+from .. import view  # noqa -- registers base listing
+from .. import listing
+from ..model import db, Comment, File, Fileset, Jobrun, Tag
+from ..storage import Storage
+from ..testing import create_tempdir
+
+
+class TestCase(flask_testing.TestCase):
+    TESTING = True
+    SQLALCHEMY_BINDS = {'cache': 'sqlite://'}
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config.from_object(self)
+        db.init_app(app)
+        return app
+
+    def setUp(self):
+        ListingEntry, _ = listing.generate_listing_model()
+        db.create_all(bind='cache')
+        db.session.add(ListingEntry(
+            id='a', fileset_id=1, storage_id=1, type='bag', abbr_md5='a', size=1,
+            name=json.dumps({'route': 'detail', 'id': 1, 'title': u'b\xe4g'}),
+            status=json.dumps([]), tags=json.dumps(['x'])))
+        db.session.add(ListingEntry(id='b', fileset_id=2, storage_id=1, type='bag',
+                                    remote='there', name='null', status='[]',
+                                    tags='[]'))
+        db.session.commit()
+
+    def test_relation_key_type(self):
+        key = listing.ListingEntry.__table__.c.id
+        for Relation in listing.Relations.values():
+            column = Relation.__table__.c.listing_entry_id
+            self.assertEqual([x.column for x in column.foreign_keys], [key])
+            self.assertIsInstance(column.type, type(key.type))
+
+    def test_stream_listing(self):
+        ListingEntry = listing.ListingEntry
+        entries = ListingEntry.query.order_by(ListingEntry.id)
+        rv = json.loads(''.join(listing.stream_listing_entries(
+            entries, sort='endtime', ascending=False)))
+        self.assertEqual(rv, {
+            'sort': 'endtime',
+            'ascending': False,
+            'rows': [listing.serialize_listing_entry(x) for x in entries],
+        })
+
+    def test_stream_empty(self):
+        entries = listing.ListingEntry.query.filter(listing.ListingEntry.id == 'c')
+        self.assertEqual(json.loads(''.join(listing.stream_listing_entries(entries))),
+                         {'rows': []})
+
+    def test_page_listing(self):
+        entries = listing.ListingEntry.query
+
+        def page(**kw):
+            query = listing.page_listing_entries(entries, **kw)
+            rv = json.loads(''.join(listing.stream_listing_entries(
+                query, kw.get('columns'))))
+            return [(x['id'], [c['name'] for c in x['columns']]) for x in rv['rows']]
+
+        self.assertEqual([x[0] for x in page(sort='size', ascending=True)], [2, 1])
+        self.assertEqual([x[0] for x in page(sort='size')], [1, 2])
+        self.assertEqual(page(columns=['size', 'name'], offset=1, limit=1),
+                         [(2, ['Location', 'name', 'size'])])
+        with self.assertRaises(ValueError):
+            page(sort='status')
+        with self.assertRaises(ValueError):
+            page(columns=['size', 'comments_relation'])
+        with self.assertRaises(ValueError):
+            page(offset=-1)
+        with self.assertRaises(ValueError):
+            page(limit=-1)
+
+    def test_default_sort(self):
+        # base listing has no endtime column
+        self.assertIsNone(listing.default_sort())
+        self.addCleanup(setattr, listing, 'DEFAULT_SORT', listing.DEFAULT_SORT)
+        listing.DEFAULT_SORT = 'size'
+        self.assertEqual(listing.default_sort(), 'size')
+        listing.DEFAULT_SORT = 'status'  # json columns are not sortable
+        self.assertIsNone(listing.default_sort())
+
+
+class SyncTestCase(flask_testing.TestCase):
+    TESTING = True
+    SQLALCHEMY_BINDS = {'cache': 'sqlite://'}
+
+    def create_app(self):
+        self.instance_path, self.cleanup = create_tempdir()
+        app = Flask(__name__, instance_path=self.instance_path)
+        app.config.from_object(self)
+        db.init_app(app)
+        return app
+
+    def setUp(self):
+        listing.generate_listing_model()
+        db.create_all()
+        for name in ('a', 'b'):
+            self.add_fileset(name)
+        db.session.commit()
+
+    def tearDown(self):
+        self.cleanup()
+
+    def add_fileset(self, name):
+        now = datetime.utcnow()
+        db.session.add(Fileset(storage_id=1, md5=name, name=name, dirpath='',
+                               type='bag', time_added=now, time_updated=now))
+
+    def sync(self):
+        with self.app.test_request_context():
+            return listing.sync_listing_cache()
+
+    def names(self):
+        return sorted(x.id for x in listing.ListingEntry.query)
+
+    def test_sync(self):
+        self.assertEqual(self.sync(), 2)
+        self.assertEqual(self.names(), ['a', 'b'])
+        state = listing.ListingState.query.one()
+        self.assertEqual(state.version, listing.listing_version())
+        self.assertEqual(state.jobrun_mark, 1)
+
+        # nothing changed, the most recently updated fileset is revisited
+        self.assertEqual(self.sync(), 1)
+        self.add_fileset('c')
+        db.session.add(Jobrun(fileset_id=1, name='x', version='1'))
+        db.session.commit()
+        self.assertEqual(self.sync(), 3)
+        self.assertEqual(self.names(), ['a', 'b', 'c'])
+        self.assertEqual(listing.ListingState.query.one().jobrun_mark, 2)
+
+        Jobrun.query.get(1).succeeded = True
+        Fileset.query.get(2).deleted = True
+        db.session.commit()
+        self.assertEqual(self.sync(), 3)
+        self.assertEqual(self.names(), ['a', 'c'])
+        self.assertEqual(listing.ListingEntry.query.get('a').job_count, 1)
+        self.assertEqual(listing.ListingState.query.one().jobrun_mark, 2)
+
+    def test_sync_abandoned_jobrun(self):
+        # a jobrun that never finishes does not keep its fileset changed
+        db.session.add(Jobrun(fileset_id=1, name='x', version='1'))
+        db.session.commit()
+        self.sync()
+        self.assertEqual(self.sync(), 1)
+        self.assertEqual(self.sync(), 1)
+        db.session.add(Jobrun(fileset_id=2, name='x', version='1', failed=True))
+        db.session.commit()
+        self.assertEqual(self.sync(), 1)
+        self.assertEqual(listing.ListingState.query.one().jobrun_mark, 3)
+
+    def test_update_keeps_relations(self):
+        fileset = Fileset.query.get(1)
+        fileset.tags.append(Tag(label='x'))
+        db.session.commit()
+        self.sync()
+        Tags = listing.Relations['tags_relation']
+        with self.app.test_request_context():
+            listing.update_listing_entries([1])
+            listing.update_listing_entry(fileset_id=1)
+        self.assertEqual([x.value for x in Tags.query], ['x'])
+        self.assertEqual(len(listing.ListingEntry.query.get('a').tags_relation), 1)
+        with self.app.test_request_context():
+            listing.remove_listing_entry(fileset_id=1)
+        self.assertEqual(Tags.query.count(), 0)
+
+    def test_sync_without_rebuild(self):
+        with self.assertRaises(listing.ListingCacheOutdated):
+            with self.app.test_request_context():
+                listing.sync_listing_cache(rebuild=False)
+        self.sync()
+        self.add_fileset('c')
+        db.session.commit()
+        with self.app.test_request_context():
+            self.assertEqual(listing.sync_listing_cache(rebuild=False), 2)
+        self.assertEqual(self.names(), ['a', 'b', 'c'])
+        state = listing.ListingState.query.one()
+        self.assertEqual(state.id, listing.LISTING_STATE_ID)
+
+    def test_sync_locked(self):
+        self.addCleanup(setattr, listing, '_sync_listing_cache',
+                        listing._sync_listing_cache)
+        listing._sync_listing_cache = lambda rebuild: 'synced'
+        synced = []
+
+        def sync():
+            with self.app.app_context():
+                synced.append(listing.sync_listing_cache())
+
+        with open(os.path.join(self.instance_path, '_listing_cache.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            thread = Thread(target=sync)
+            thread.start()
+            time.sleep(0.1)
+            self.assertEqual(synced, [])
+        thread.join()
+        self.assertEqual(synced, ['synced'])
+
+    def test_sync_missing_files(self):
+        # missing files are detected without signalling the listing
+        fileset = Fileset.query.get(1)
+        fileset.dirpath = self.instance_path
+        fileset.time_updated = datetime(2016, 1, 1)
+        fileset.files.append(File(md5='a', name='a.bag', size=1))
+        db.session.commit()
+        self.sync()
+
+        def icons():
+            status = json.loads(listing.ListingEntry.query.get('a').status)
+            return [x['icon'] for x in status]
+        self.assertEqual(icons(), ['time'])
+        Storage.new_storage()._detect_missing(getLogger(__name__))
+        self.sync()
+        self.assertEqual(icons(), ['hdd', 'time'])
+
+    def test_rebuild_on_version_change(self):
+        Fileset.query.get(2).time_updated = datetime(2016, 1, 1)
+        db.session.commit()
+        self.sync()
+        listing.ListingEntry.query.filter_by(id='b').delete()
+        db.session.commit()
+        self.sync()
+        self.assertEqual(self.names(), ['a'])
+        listing.ListingState.query.one().version = 'outdated'
+        db.session.commit()
+        self.sync()
+        self.assertEqual(self.names(), ['a', 'b'])
+
+    def test_bulk_queries(self):
+        def populate(count):
+            for i in range(count):
+                name = 'x{}-{}'.format(count, i)
+                self.add_fileset(name)
+                fileset = Fileset.query.filter_by(md5=name).one()
+                fileset.files.append(File(md5=name, name=name, size=i))
+                fileset.tags.append(Tag(label=name))
+                fileset.comments.append(Comment(author_id=1, text=name))
+                db.session.add(Jobrun(fileset=fileset, name='x', version='1'))
+                db.session.add(Jobrun(fileset=fileset, name='x', version='1',
+                                      failed=bool(i % 2)))
+            db.session.commit()
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                if statement.startswith('SELECT'):
+                    statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                with self.app.test_request_context():
+                    listing.populate_listing_cache()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            return len(statements)
+
+        self.assertEqual(populate(2), populate(20))
+        entry = listing.ListingEntry.query.get('x20-3')
+        self.assertEqual((entry.file_count, entry.job_count, entry.comment_count,
+                          entry.size, entry.tags),
+                         (1, 2, 1, 3, '["x20-3"]'))
+        self.assertEqual([x['title'] for x in json.loads(entry.status)],
+                         ['This fileset has not yet been processed',
+                          'Failed jobs: x'])
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+from __future__ import absolute_import, division
+
+import flask_testing
+import os
+from datetime import datetime
+from flask import Flask
+from sqlalchemy import event
+from ..model import db, Fileset, Jobrun
+
+
+class TestCase(flask_testing.TestCase):
+    SQLALCHEMY_ECHO = bool(os.environ.get('SQLALCHEMY_ECHO', False))
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config.from_object(self)
+        db.init_app(app)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        now = datetime.utcnow()
+        db.session.add(Fileset(storage_id=1, md5='set', name='set', dirpath='',
+                               type='foo', time_added=now, time_updated=now))
+        for name, failed in [('a', True), ('a', False), ('b', True)]:
+            db.session.add(Jobrun(fileset_id=1, name=name, version='1',
+                                  failed=failed))
+        db.session.commit()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_latest_jobruns(self):
+        fileset = Fileset.query.get(1)
+        with self.app.test_request_context():
+            del self.statements[:]
+            self.assertEqual(fileset.get_latest_jobrun('a').id, 2)
+            self.assertEqual(fileset.get_latest_jobrun('b').id, 3)
+            self.assertIsNone(fileset.get_latest_jobrun('c'))
+            self.assertEqual(fileset.failed_job_names, ['b'])
+            self.assertEqual(len(self.statements), 1)
+
+        db.session.add(Jobrun(fileset_id=1, name='a', version='1', failed=True))
+        db.session.commit()
+        with self.app.test_request_context():
+            self.assertEqual(fileset.failed_job_names, ['a', 'b'])
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+from __future__ import absolute_import, division
+
+import flask_testing
+from datetime import datetime
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from ..decorators import detail, text_widget
+from ..model import db, Fileset, Jobfile, Jobrun, WidgetCache
+from ..serializer import DETAIL, fileset_detail, fileset_widget, fileset_widgets
+from ..serializer import has_jobfiles, invalidate_widget_cache
+
+
+class TestCase(flask_testing.TestCase):
+    TESTING = True
+
+    def create_app(self):
+        app = Flask(__name__)
+        app.config.from_object(self)
+        db.init_app(app)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        now = datetime.utcnow()
+        db.session.add(Fileset(storage_id=1, md5='set', name='set', dirpath='',
+                               type='foo', time_added=now, time_updated=now))
+        db.session.add(Jobrun(fileset_id=1, name='test::a', version='1'))
+        db.session.add(Jobfile(jobrun_id=1, name='topic_foo.jpg'))
+        db.session.commit()
+
+        self.saved_detail = DETAIL[:]
+        del DETAIL[:]
+        self.calls = []
+
+        def make_view(name, job=None, **kw):
+            @detail(namespace='test', name=name, job=job, **kw)
+            @text_widget()
+            def view(fileset):
+                self.calls.append(job)
+                return 'text'
+
+        self.make_view = make_view
+        make_view('a', 'test::a')
+        make_view('foo', 'test::a', applies=has_jobfiles('test::a', 'topic_foo'))
+        make_view('bar', 'test::a', applies=has_jobfiles('test::a', 'topic_bar'))
+        make_view('b', 'test::b')
+        make_view('none')
+
+    def tearDown(self):
+        DETAIL[:] = self.saved_detail
+
+    def test_manifest(self):
+        fileset = Fileset.query.get(1)
+        manifest = fileset_widgets(fileset)
+        self.assertEqual([x['key'] for x in manifest['widgets']],
+                         ['test::a', 'test::foo', 'test::none'])
+        self.assertEqual(manifest['widgets'][0],
+                         {'key': 'test::a', 'title': 'View', 'type': 'text',
+                          'state': None})
+        self.assertEqual(self.calls, [])
+
+    def test_render_single_widget(self):
+        fileset = Fileset.query.get(1)
+        self.assertEqual(fileset_widget(fileset, 'test::foo')['text'], 'text')
+        self.assertEqual(self.calls, ['test::a'])
+        self.assertIsNone(fileset_widget(fileset, 'test::b'))
+        self.assertEqual(self.calls, ['test::a'])
+        with self.assertRaises(KeyError):
+            fileset_widget(fileset, 'test::missing')
+
+    def test_duplicate_key(self):
+        with self.assertRaises(ValueError):
+            self.make_view('a')
+        self.assertEqual(len(DETAIL), 5)
+
+    def test_detail_skips_inapplicable(self):
+        fileset = Fileset.query.get(1)
+        self.assertEqual(len(fileset_detail(fileset)['widgets']), 3)
+        self.assertEqual(self.calls, ['test::a', 'test::a', None])
+
+    def test_widget_cache(self):
+        fileset = Fileset.query.get(1)
+        fileset_widget(fileset, 'test::a')
+        self.assertEqual(WidgetCache.query.count(), 0)
+
+        Jobrun.query.get(1).succeeded = True
+        db.session.commit()
+        fileset_detail(fileset)
+        self.assertEqual(self.calls, ['test::a', 'test::a', 'test::a', None])
+        self.assertEqual(sorted(x.key for x in WidgetCache.query),
+                         ['test::a', 'test::foo'])
+
+        del self.calls[:]
+        self.assertEqual(fileset_widget(fileset, 'test::a')['text'], 'text')
+        self.assertEqual(len(fileset_detail(fileset)['widgets']), 3)
+        self.assertEqual(self.calls, [None])
+
+        jobrun = Jobrun(fileset_id=1, name='test::a', version='1', succeeded=True)
+        db.session.add(jobrun)
+        invalidate_widget_cache(jobrun)
+        db.session.commit()
+        self.assertEqual(WidgetCache.query.count(), 0)
+        with self.app.test_request_context():
+            fileset_widget(fileset, 'test::a')
+        self.assertEqual(WidgetCache.query.one().jobrun_id, jobrun.id)
+
+    def test_widget_cache_write_failing(self):
+        def fail(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO widget_cache'):
+                raise OperationalError(statement, None, Exception('locked'))
+
+        Jobrun.query.get(1).succeeded = True
+        db.session.commit()
+        fileset = Fileset.query.get(1)
+        event.listen(db.engine, 'before_cursor_execute', fail)
+        try:
+            self.assertEqual(fileset_widget(fileset, 'test::a')['text'], 'text')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', fail)
+        self.assertEqual(WidgetCache.query.count(), 0)
@@ -22,12 +22,29 @@
 
 from __future__ import absolute_import, division
 
+import flask_testing
 import inspect
+import json
+import time
 import unittest
+from collections import namedtuple
+from flask import Flask
 from logging import getLogger
+from Queue import Queue
+from sqlalchemy import event
+from threading import Thread
 from testfixtures import LogCapture
 
-from .._utils import multiplex
+from .._utils import Done, JobProcessPool, MeteredQueue, Slots, async_job_milker
+from .._utils import make_process_job, multiplex, put_message
+from ..arrays import Series
+from ..globals import _job_ctx_stack
+from ..model import db, Fileset, Jobfile, Jobrun
+from ..testing import create_tempdir
+
+
+AsyncJob = namedtuple('AsyncJob', ['thread', 'msg_queue'])
+MilkedJob = namedtuple('MilkedJob', ['rv_queue', 'jobrun_id'])
 
 
 class TestCase(unittest.TestCase):
@@ -60,3 +77,165 @@ class TestCase(unittest.TestCase):
         with LogCapture(self.id()) as log:
             self.assertEquals(list(outputs), [0, 100, 2, 4, 6])
             self.assertEquals(len(log.records), 2)
+
+    def test_put_message(self):
+        queue = MeteredQueue(2)
+        consumed = []
+
+        def consume():
+            time.sleep(0.2)
+            for _ in range(3):
+                consumed.append(queue.get())
+
+        thread = Thread(target=consume)
+        thread.start()
+        job = AsyncJob(thread=thread, msg_queue=queue)
+        for msg in range(3):
+            self.assertTrue(put_message(job, msg, poll=0.01))
+        thread.join()
+        self.assertEqual(consumed, [0, 1, 2])
+        self.assertEqual(queue.peak, 2)
+        self.assertEqual(queue.stalls, 1)
+        self.assertGreater(queue.stalled, 0.1)
+
+        # ended job does not block the producer
+        for msg in range(2):
+            self.assertTrue(put_message(job, msg))
+        self.assertFalse(put_message(job, 2))
+        self.assertEqual(queue.stalls, 2)
+
+    def test_slots(self):
+        slots = Slots(3)
+        self.assertEqual(slots.acquire(2), 2)
+        acquired = []
+        thread = Thread(target=lambda: acquired.append(slots.acquire(5)))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(acquired, [])
+        slots.release(2)
+        thread.join()
+        self.assertEqual(acquired, [3])
+        self.assertEqual(slots.free, 0)
+
+
+class JobContext(object):
+    send_jobfile = None
+
+
+def process_job(jobrun_id, messages, factor):
+    _job_ctx_stack.push(JobContext())
+
+    def results():
+        for x in messages:
+            if x < 0:
+                raise ValueError
+            yield Jobfile(name=str(x))
+    return {'factor': factor}, results()
+
+
+def resolve_process_job(spec):
+    return process_job, lambda x: x * spec
+
+
+class Samples(Series):
+    __slots__ = ()
+    columns = (('t', 'f8'), ('x', 'f4'))
+    filename = 'samples.npy'
+
+
+class ProcessJobTestCase(flask_testing.TestCase):
+    TESTING = True
+
+    def create_app(self):
+        self.path, self.cleanup = create_tempdir()
+        app = Flask(__name__, instance_path=self.path)
+        app.config.from_object(self)
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///{}/db.sqlite'.format(self.path)
+        db.init_app(app)
+        return app
+
+    def setUp(self):
+        db.create_all()
+        fileset = Fileset(storage_id=1, md5='', name='', dirpath='', type='',
+                          time_added=db.func.now(), time_updated=db.func.now())
+        db.session.add(fileset)
+        db.session.commit()
+        self.fileset_id = fileset.id
+        self.pool = JobProcessPool(self.app, 1, resolve_process_job)
+
+    def tearDown(self):
+        self.pool.close()
+        db.session.remove()
+        db.drop_all()
+        self.cleanup()
+
+    def run_job(self, messages):
+        async_job = make_process_job(self.pool, 'job', 2, topics=(),
+                                     group='test', version='1',
+                                     config={'factor': 2},
+                                     fileset_id=self.fileset_id)
+        for msg in messages:
+            put_message(async_job, msg)
+        put_message(async_job, Done)
+        async_job_milker(self.app, async_job)
+        return Jobrun.query.get(async_job.jobrun_id)
+
+    def test_process_job(self):
+        jobrun = self.run_job(range(3))
+        self.assertTrue(jobrun.succeeded)
+        self.assertEqual(json.loads(jobrun.config), {'factor': 2})
+        self.assertEqual([x.name for x in jobrun.jobfiles], ['0', '2', '4'])
+
+    def test_milker_batches(self):
+        jobrun = Jobrun(name='job', version='1', fileset_id=self.fileset_id)
+        db.session.add(jobrun)
+        db.session.commit()
+        jobrun_id = jobrun.id
+        rv_queue = Queue()
+        for i in range(5):
+            rv_queue.put(Jobfile(name=str(i)))
+        rv_queue.put(Done)
+        inserts = []
+        listener = lambda conn, cursor, statement, *args: \
+            inserts.append(statement) if statement.startswith('INSERT') else None
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            async_job_milker(self.app, MilkedJob(rv_queue, jobrun_id), batch_size=2)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len(inserts), 3)
+        jobrun = Jobrun.query.get(jobrun_id)
+        self.assertTrue(jobrun.succeeded)
+        self.assertEqual([x.name for x in jobrun.jobfiles], map(str, range(5)))
+
+    def test_milker_series(self):
+        jobrun = Jobrun(name='test::job', version='1', fileset_id=self.fileset_id)
+        db.session.add(jobrun)
+        db.session.commit()
+        jobrun_id = jobrun.id
+        rv_queue = Queue()
+        for i in range(3):
+            rv_queue.put(Samples(t=i, x=i * 0.5))
+        rv_queue.put(Done)
+        async_job_milker(self.app, MilkedJob(rv_queue, jobrun_id))
+        jobrun = Jobrun.query.get(jobrun_id)
+        self.assertEqual([x.name for x in jobrun.jobfiles], ['samples.npy'])
+        samples = Samples.load(jobrun)
+        self.assertEqual(samples.dtype.names, ('t', 'x'))
+        self.assertEqual(list(samples['x']), [0, 0.5, 1])
+
+    def test_process_job_failing(self):
+        jobrun = self.run_job([1, -1, 2])
+        self.assertTrue(jobrun.failed)
+        self.assertEqual([x.name for x in jobrun.jobfiles], ['2'])
+
+    def test_process_reused(self):
+        # messages the failing job did not consume are drained
+        pid = self.pool.processes[0].pid
+        self.assertTrue(self.run_job([1, -1, 2, 3]).failed)
+        jobrun = self.run_job(range(2))
+        self.assertTrue(jobrun.succeeded)
+        self.assertEqual([x.name for x in jobrun.jobfiles], ['0', '2'])
+        self.assertEqual(self.pool.processes[0].pid, pid)
+        self.assertTrue(self.pool.processes[0].is_alive())
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import, division
+
+import os
+import unittest
+from functools import partial
+from ..scanner import scan as _scan
+from ..testing import create_tempdir, make_fileset
+from ..verify import MD5Verifier, read_md5file
+from .test_scanner import TEST_SCANNER
+
+
+scan = partial(_scan, scanner=TEST_SCANNER)
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.path, self.cleanup = create_tempdir()
+
+    def tearDown(self):
+        self.cleanup()
+
+    def test_read_md5file(self):
+        path = os.path.join(self.path, 'x.md5')
+        with open(path, 'wb') as f:
+            f.write('d41d8cd98f00b204e9800998ecf8427e  a\n'
+                    'broken line\n'
+                    'D41D8CD98F00B204E9800998ECF8427E *b c\r\n')
+        self.assertEqual(read_md5file(path),
+                         [('d41d8cd98f00b204e9800998ecf8427e', 'a'),
+                          ('d41d8cd98f00b204e9800998ecf8427e', 'b c')])
+
+    def test_verify(self):
+        for i in range(3):
+            make_fileset(self.path, set_idx=i)
+        filesets = list(scan(self.path))
+        with open(filesets[1].files[2].path, 'ab') as f:
+            f.write('corrupt')
+        os.unlink('{}.md5'.format(filesets[2].files[0].path))
+
+        for jobs in (1, 4):
+            verifier = MD5Verifier(jobs=jobs)
+            self.assertEqual(verifier.verify(filesets), [True, False, False])
+            verifier.close()
+            self.assertEqual(verifier.bytes, 22 * 3 + 22 * 2 + 29 + 22 * 2)
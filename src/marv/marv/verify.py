@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Ternaris, Munich, Germany
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import absolute_import, division
+
+import hashlib
+import os
+import time
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+
+
+CHUNK_SIZE = 4 * 2**20
+DEFAULT_JOBS = 4
+
+
+def read_md5file(path):
+    """Return (md5, filename) tuples of properly formatted lines of md5 file"""
+    entries = []
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            md5, sep, name = line[:32], line[32:34], line[34:]
+            if len(md5) != 32 or sep not in ('  ', ' *') or not name:
+                continue
+            try:
+                int(md5, 16)
+            except ValueError:
+                continue
+            entries.append((md5.lower(), name))
+    return entries
+
+
+def md5_file(path, chunk_size=CHUNK_SIZE):
+    """Return md5 hexdigest and size of file read in chunks"""
+    md5 = hashlib.md5()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            md5.update(chunk)
+            size += len(chunk)
+    return md5.hexdigest(), size
+
+
+def check_md5file(args):
+    """Verify files listed in md5 file like ``md5sum -c``
+
+    Return whether all listed files match and the number of bytes read.
+    """
+    dirpath, md5file = args
+    logger = getLogger(__name__)
+    try:
+        entries = read_md5file(os.path.join(dirpath, md5file))
+    except IOError as e:
+        logger.debug('%s: %s', md5file, e)
+        return False, 0
+    if not entries:
+        logger.debug('%s: no properly formatted MD5 checksum lines found', md5file)
+        return False, 0
+
+    ok = True
+    nbytes = 0
+    for md5, name in entries:
+        try:
+            actual, size = md5_file(os.path.join(dirpath, name))
+        except IOError as e:
+            logger.debug('%s: %s', name, e)
+            ok = False
+            continue
+        nbytes += size
+        if actual != md5:
+            logger.debug('%s: MD5 mismatch', os.path.join(dirpath, name))
+            ok = False
+    return ok, nbytes
+
+
+class MD5Verifier(object):
+    """Verify fileset files against their md5 files on a thread pool
+
+    Files are hashed in chunks; hashlib releases the GIL, so reading
+    and hashing of multiple files, also across filesets, proceeds in
+    parallel. Bytes read and time spent are accumulated for reporting.
+    """
+    def __init__(self, jobs=DEFAULT_JOBS):
+        assert jobs > 0
+        self.jobs = jobs
+        self.bytes = 0
+        self.seconds = 0.
+        self._pool = None
+
+    @property
+    def throughput(self):
+        """Average throughput in bytes per second"""
+        return self.bytes / self.seconds if self.seconds else 0.
+
+    def _map(self, func, iterable):
+        if self.jobs == 1:
+            return map(func, iterable)
+        if self._pool is None:
+            self._pool = ThreadPool(self.jobs)
+        return self._pool.map(func, iterable, chunksize=1)
+
+    def verify(self, filesets):
+        """Return for each fileset whether all its files verified"""
+        tasks = [(fileset.dirpath, '{}.md5'.format(file.name))
+                 for fileset in filesets
+                 for file in fileset.files]
+        start = time.time()
+        results = iter(self._map(check_md5file, tasks))
+        self.seconds += time.time() - start
+
+        verified = []
+        for fileset in filesets:
+            ok = True
+            for _ in fileset.files:
+                file_ok, nbytes = next(results)
+                self.bytes += nbytes
+                ok = ok and file_ok
+            verified.append(ok)
+        return verified
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
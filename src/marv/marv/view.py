@@ -51,7 +51,7 @@ def fileset_size(fileset):
 #     }]
 
 
-@bb.listing()
+@bb.listing(load=('comments', 'files', 'jobruns', 'tags'))
 @bb.listing_column('name', formatter='route', json=True)
 @bb.listing_column('abbr_md5', title='Abbr. MD5')
 @bb.listing_column('size', formatter='size', type=db.Integer)